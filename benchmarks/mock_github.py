@@ -0,0 +1,427 @@
+#!/usr/bin/env python
+
+""" A local stand-in for the Github API and the Google Code issue tracker API.
+
+The server keeps a Github repository in memory and implements the parts of the REST API
+used by migrateissues.py (under /api), and serves a synthetic Google Code project as Atom
+feeds (under /feeds), so whole migrations can be run and measured without the network.
+
+Responses carry X-RateLimit headers from a configurable quota, which is enforced with the
+same 403 response Github gives, and each request can be delayed by a fixed latency to
+model the round trip to the real API.  Requests are counted per endpoint, with issue
+numbers and names replaced by placeholders.
+
+"""
+
+import hashlib
+import json
+import optparse
+import re
+import threading
+import time
+import urlparse
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+import synthetic_gcode
+
+GITHUB_PER_PAGE = 30
+GITHUB_MAX_PER_PAGE = 100
+
+
+class MockState(object):
+
+    """ The data behind the mock server: a Github repository, a Google Code project and counters. """
+
+    def __init__(self, base_url, owner, repo, project_name, project, latency = 0.0, quota = 5000, reset_interval = 3600):
+        self.base_url = base_url
+        self.owner = owner
+        self.repo = repo
+        self.project_name = project_name
+        self.project = project
+        self.gcode_issues = dict((issue["id"], issue) for issue in project)
+        self.latency = latency
+        self.quota = quota
+        self.reset_interval = reset_interval
+        self.lock = threading.RLock()
+        self.clear()
+
+    def clear(self):
+
+        """ Empties the Github repository and resets the counters and the quota. """
+
+        with self.lock:
+            self.issues = []
+            self.comments = {}
+            self.labels = {}
+            self.imports = []
+            self.counts = {}
+            self.not_modified = 0
+            self.remaining = self.quota
+            self.reset_at = int(time.time()) + self.reset_interval
+
+    def count(self, endpoint):
+        with self.lock:
+            self.counts[endpoint] = self.counts.get(endpoint, 0) + 1
+
+    def take_request(self):
+
+        """ Uses up one request of the quota, returning False if none are left. """
+
+        with self.lock:
+            if time.time() >= self.reset_at:
+                self.remaining = self.quota
+                self.reset_at = int(time.time()) + self.reset_interval
+            if self.remaining <= 0:
+                return False
+            self.remaining -= 1
+            return True
+
+    def totals(self):
+
+        """ Returns the number of Github and Google Code requests served so far. """
+
+        with self.lock:
+            github = sum(count for endpoint, count in self.counts.items() if not endpoint.startswith("GET /feeds"))
+            return github, sum(self.counts.values()) - github
+
+    @property
+    def repo_url(self):
+        return "%s/repos/%s/%s" % (self.base_url, self.owner, self.repo)
+
+    # JSON representations, with the attributes PyGithub reads
+
+    def user_json(self, login):
+        return { "login": login, "id": abs(hash(login)) % 100000, "type": "User",
+                 "url": "%s/users/%s" % (self.base_url, login) }
+
+    def repo_json(self):
+        return { "id": 1, "name": self.repo, "full_name": "%s/%s" % (self.owner, self.repo),
+                 "owner": self.user_json(self.owner), "url": self.repo_url, "has_issues": True,
+                 "open_issues": len([ issue for issue in self.issues if issue["state"] == "open" ]) }
+
+    def label_json(self, label):
+        return { "name": label["name"], "color": label["color"],
+                 "url": "%s/labels/%s" % (self.repo_url, label["name"]) }
+
+    def issue_json(self, issue):
+        data = dict((key, value) for key, value in issue.items() if key != "label_names")
+        data["labels"] = [ self.label_json(self.labels[name.lower()]) for name in issue["label_names"] if name.lower() in self.labels ]
+        data["comments"] = len(self.comments[issue["number"]])
+        return data
+
+    def comment_json(self, number, comment):
+        return dict(comment, issue_url = "%s/issues/%d" % (self.repo_url, number))
+
+    # Github operations
+
+    def add_labels(self, names):
+        for name in names:
+            if name.lower() not in self.labels:
+                self.labels[name.lower()] = { "name": name, "color": "ffffff" }
+
+    def create_issue(self, data):
+        number = len(self.issues) + 1
+        now = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+        issue = { "number": number, "id": number, "title": data.get("title", ""), "body": data.get("body"),
+                  "state": "closed" if data.get("closed") else "open", "user": self.user_json(self.owner),
+                  "assignee": self.user_json(data["assignee"]) if data.get("assignee") else None,
+                  "label_names": list(data.get("labels") or []), "created_at": data.get("created_at", now),
+                  "updated_at": now, "closed_at": now if data.get("closed") else None,
+                  "url": "%s/issues/%d" % (self.repo_url, number),
+                  "html_url": "https://github.com/%s/%s/issues/%d" % (self.owner, self.repo, number) }
+        self.add_labels(issue["label_names"])
+        self.issues.append(issue)
+        self.comments[number] = []
+        return issue
+
+    def create_comment(self, number, body, created_at = None):
+        cid = sum(len(comments) for comments in self.comments.values()) + 1
+        now = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+        comment = { "id": cid, "body": body, "user": self.user_json(self.owner), "created_at": created_at or now,
+                    "updated_at": now, "url": "%s/issues/comments/%d" % (self.repo_url, cid) }
+        self.comments[number].append(comment)
+        self.issues[number - 1]["updated_at"] = now
+        return comment
+
+
+class MockServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+
+class MockHandler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def state(self):
+        return self.server.state
+
+    def send(self, status, data = None, content_type = "application/json", headers = {}):
+        if data is None:
+            body = ""
+        elif content_type == "application/json":
+            body = json.dumps(data)
+        else:
+            body = data
+
+        # Github answers conditional requests for unchanged data with 304 Not Modified,
+        # which doesn't count against the rate limit
+
+        etag = None
+        if self.command == "GET" and status == 200 and self.path.startswith("/api"):
+            etag = '"%s"' % hashlib.sha1(body).hexdigest()
+            if self.headers.get("If-None-Match") == etag:
+                status, body = 304, ""
+                with self.state.lock:
+                    self.state.remaining += 1
+                    self.state.not_modified += 1
+        self.send_response(status)
+        self.send_header("Content-Type", content_type + "; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        if etag:
+            self.send_header("ETag", etag)
+        if self.path.startswith("/api"):
+            self.send_header("X-RateLimit-Limit", str(self.state.quota))
+            self.send_header("X-RateLimit-Remaining", str(self.state.remaining))
+            self.send_header("X-RateLimit-Reset", str(self.state.reset_at))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length)) if length else {}
+
+    def paginate(self, url, items, query):
+        page = int(query.get("page", ["1"])[0])
+        per_page = min(int(query.get("per_page", [str(GITHUB_PER_PAGE)])[0]), GITHUB_MAX_PER_PAGE)
+        pages = max((len(items) + per_page - 1) // per_page, 1)
+        links = []
+        base = url + ("&" if "?" in url else "?")
+        if page < pages:
+            links.append('<%spage=%d&per_page=%d>; rel="next"' % (base, page + 1, per_page))
+            links.append('<%spage=%d&per_page=%d>; rel="last"' % (base, pages, per_page))
+        headers = { "Link": ", ".join(links) } if links else {}
+        self.send(200, items[(page - 1) * per_page:page * per_page], headers = headers)
+
+    def handle_any(self, verb):
+        parsed = urlparse.urlparse(self.path)
+        path, query = parsed.path.rstrip("/"), urlparse.parse_qs(parsed.query)
+
+        if path.startswith("/feeds/"):
+            self.state.count("GET " + re.sub(r"/\d+/", "/:id/", path))
+            time.sleep(self.state.latency)
+            return self.google(path, query)
+
+        endpoint = re.sub(r"/(issues|comments)/\d+", r"/\1/:n", path[len("/api"):])
+        endpoint = re.sub(r"/labels/[^/]+$", "/labels/:name", endpoint)
+        endpoint = re.sub(r"^/(users|orgs)/[^/]+", r"/\1/:login", endpoint)
+        endpoint = re.sub(r"^/repos/[^/]+/[^/]+", "/repos/:repo", endpoint)
+        self.state.count("%s %s" % (verb, endpoint))
+        time.sleep(self.state.latency)
+
+        # Rate limit checks don't use up the quota, as on Github
+
+        if endpoint == "/rate_limit":
+            core = { "limit": self.state.quota, "remaining": self.state.remaining, "reset": self.state.reset_at }
+            return self.send(200, { "resources": { "core": core }, "rate": core })
+        if not self.state.take_request():
+            return self.send(403, { "message": "API rate limit exceeded for %s." % self.state.owner,
+                                    "documentation_url": "https://developer.github.com/v3/#rate-limiting" })
+
+        try:
+            with self.state.lock:
+                return self.github(verb, path[len("/api"):], query)
+        except (KeyError, IndexError, ValueError):
+            return self.send(404, { "message": "Not Found" })
+
+    def github(self, verb, path, query):
+        state = self.state
+        repo_prefix = "/repos/%s/%s" % (state.owner, state.repo)
+
+        if path == "/user":
+            return self.send(200, state.user_json(state.owner))
+        match = re.match(r"^/users/([^/]+)$", path)
+        if match:
+            return self.send(200, state.user_json(match.group(1)))
+        if path.startswith("/orgs/"):
+            return self.send(404, { "message": "Not Found" })
+        if path == repo_prefix:
+            return self.send(200, state.repo_json())
+        if not path.startswith(repo_prefix + "/"):
+            return self.send(404, { "message": "Not Found" })
+
+        path = path[len(repo_prefix):]
+        url = state.base_url + repo_prefix + path
+
+        if path == "/labels":
+            if verb == "POST":
+                data = self.read_json()
+                if data["name"].lower() in state.labels:
+                    return self.send(422, { "message": "Validation Failed", "errors": [ { "code": "already_exists" } ] })
+                state.labels[data["name"].lower()] = { "name": data["name"], "color": data.get("color", "ffffff") }
+                return self.send(201, state.label_json(state.labels[data["name"].lower()]))
+            return self.paginate(url, [ state.label_json(label) for label in sorted(state.labels.values()) ], query)
+
+        match = re.match(r"^/labels/(.+)$", path)
+        if match:
+            return self.send(200, state.label_json(state.labels[urlparse.unquote(match.group(1)).lower()]))
+
+        if path == "/issues":
+            if verb == "POST":
+                return self.send(201, state.issue_json(state.create_issue(self.read_json())))
+            wanted = query.get("state", ["open"])[0]
+            issues = [ issue for issue in state.issues if wanted == "all" or issue["state"] == wanted ]
+            if query.get("direction", ["desc"])[0] == "desc":
+                issues = issues[::-1]
+            url = "%s?state=%s&direction=%s" % (url, wanted, query.get("direction", ["desc"])[0])
+            return self.paginate(url, [ state.issue_json(issue) for issue in issues ], query)
+
+        match = re.match(r"^/issues/(\d+)$", path)
+        if match:
+            issue = state.issues[int(match.group(1)) - 1]
+            if verb == "PATCH":
+                data = self.read_json()
+                for key in ("title", "body", "state"):
+                    if key in data:
+                        issue[key] = data[key]
+                if "assignee" in data:
+                    issue["assignee"] = state.user_json(data["assignee"]) if data["assignee"] else None
+                if "labels" in data:
+                    issue["label_names"] = list(data["labels"])
+                    state.add_labels(issue["label_names"])
+            return self.send(200, state.issue_json(issue))
+
+        match = re.match(r"^/issues/(\d+)/comments$", path)
+        if match:
+            number = int(match.group(1))
+            if verb == "POST":
+                return self.send(201, state.comment_json(number, state.create_comment(number, self.read_json()["body"])))
+            comments = state.comments[number]
+            if "since" in query:
+                comments = [ comment for comment in comments if comment["updated_at"] >= query["since"][0] ]
+            return self.paginate(url, [ state.comment_json(number, comment) for comment in comments ], query)
+
+        match = re.match(r"^/issues/(\d+)/labels$", path)
+        if match:
+            issue = state.issues[int(match.group(1)) - 1]
+            names = self.read_json() if verb == "POST" else []
+            issue["label_names"].extend(name for name in names if name not in issue["label_names"])
+            state.add_labels(names)
+            return self.send(200, [ state.label_json(state.labels[name.lower()]) for name in issue["label_names"] ])
+
+        if path == "/import/issues":
+            if verb == "POST":
+                return self.send(202, self.import_issue(self.read_json(), url))
+            since = query.get("since", [""])[0]
+            return self.send(200, [ record for record in state.imports if record["updated_at"] >= since ])
+
+        match = re.match(r"^/import/issues/(\d+)$", path)
+        if match:
+            return self.send(200, state.imports[int(match.group(1)) - 1])
+
+        return self.send(404, { "message": "Not Found" })
+
+    def import_issue(self, data, url):
+
+        """ Imports an issue with its comments at once; the import completes immediately. """
+
+        state = self.state
+        issue = state.create_issue(data["issue"])
+        for comment in data.get("comments", []):
+            state.create_comment(issue["number"], comment["body"], comment.get("created_at"))
+        iid = len(state.imports) + 1
+        record = { "id": iid, "status": "imported", "url": "%s/%d" % (url, iid),
+                   "issue_url": issue["url"], "created_at": issue["created_at"], "updated_at": issue["updated_at"] }
+        state.imports.append(record)
+        return record
+
+    def google(self, path, query):
+        state = self.state
+        start_index = int(query.get("start-index", ["1"])[0])
+        max_results = int(query.get("max-results", ["25"])[0])
+        updated_min = query.get("updated-min", [None])[0]
+
+        match = re.match(r"^/feeds/issues/p/([^/]+)/issues/full$", path)
+        if match and match.group(1) == state.project_name:
+            feed = synthetic_gcode.issues_feed(state.project_name, state.project, start_index, max_results, updated_min)
+            return self.send(200, feed, content_type = "application/atom+xml")
+
+        match = re.match(r"^/feeds/issues/p/([^/]+)/issues/(\d+)/comments/full$", path)
+        if match and match.group(1) == state.project_name and int(match.group(2)) in state.gcode_issues:
+            issue = state.gcode_issues[int(match.group(2))]
+            feed = synthetic_gcode.comments_feed(state.project_name, issue, start_index, max_results, updated_min)
+            return self.send(200, feed, content_type = "application/atom+xml")
+
+        return self.send(404, "Not found", content_type = "text/plain")
+
+    def do_GET(self):
+        self.handle_any("GET")
+
+    def do_POST(self):
+        self.handle_any("POST")
+
+    def do_PATCH(self):
+        self.handle_any("PATCH")
+
+    def do_DELETE(self):
+        self.handle_any("DELETE")
+
+
+def start_server(state, port = 0):
+
+    """ Starts serving 'state' in a background thread, returning the server.
+
+    The server's base URLs are 'http://localhost:<port>/api' for the Github API and
+    'http://localhost:<port>' for the Google Code API.
+
+    """
+
+    server = MockServer(("127.0.0.1", port), MockHandler)
+    server.state = state
+    state.base_url = "http://localhost:%d/api" % server.server_address[1]
+    thread = threading.Thread(target = server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+if __name__ == "__main__":
+
+    usage = "usage: %prog [options] <google project> <github owner> <github repo>"
+    description = "Serve a mock Github API and a synthetic Google Code project until interrupted."
+    parser = optparse.OptionParser(usage = usage, description = description)
+
+    parser.add_option("-p", "--port", type = "int", dest = "port", help = "Port to listen on (default: %default)", default = 8000)
+    parser.add_option("-n", "--issues", type = "int", dest = "issues", help = "Number of Google Code issues (default: %default)", default = 1000)
+    parser.add_option("--latency", type = "float", dest = "latency", help = "Seconds to delay each request (default: %default)", default = 0.0)
+    parser.add_option("--quota", type = "int", dest = "quota", help = "Github requests allowed per reset interval (default: %default)", default = 5000)
+    parser.add_option("--seed", type = "int", dest = "seed", help = "Random seed (default: %default)", default = 1)
+
+    options, args = parser.parse_args()
+
+    if len(args) != 3:
+        parser.print_help()
+        raise SystemExit(1)
+
+    project = synthetic_gcode.generate_project(args[0], options.issues, options.seed)
+    state = MockState(None, args[1], args[2], args[0], project, options.latency, options.quota)
+    server = start_server(state, options.port)
+    print "Github API at %s, Google Code at http://localhost:%d" % (state.base_url, options.port)
+
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        github, google = state.totals()
+        print "%d Github requests, %d Google Code requests" % (github, google)
+        for endpoint, count in sorted(state.counts.items()):
+            print "  %6d  %s" % (count, endpoint)
@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+
+""" Compares the cost of reading Google Code feeds through gdata and through migrateissues.py.
+
+The issues and comments feeds of a synthetic project (see synthetic_gcode.py) are written
+out as fixture pages, exactly as the issue tracker API would serve them, and then read by
+each parser in a separate process, which reports its wall time and peak memory use:
+
+  gdata  Parse each page into gdata's IssuesFeed and CommentsFeed objects, convert their
+         entries into GoogleIssue and GoogleComment records and format their dates with
+         strptime, as migrateissues.py used to.
+  lean   Read each page with the script's own incremental Atom parser and date decoder.
+
+Both parsers must produce the same records; a digest of them is compared after each run.
+
+"""
+
+import hashlib
+import json
+import optparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from cStringIO import StringIO
+from datetime import datetime
+
+import synthetic_gcode
+
+SCRIPT_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, SCRIPT_DIRECTORY)
+
+import migrateissues
+
+PARSERS = ("gdata", "lean")
+
+# The page size of the issue tracker API, as requested by migrateissues.py
+
+PAGE_SIZE = migrateissues.GOOGLE_MAX_RESULTS
+
+
+def write_fixtures(directory, name, project):
+
+    """ Writes every page of the project's issues and comments feeds into 'directory'. """
+
+    def write(kind, index, feed):
+        with open(os.path.join(directory, "%s-%06d.atom" % (kind, index)), "w") as page:
+            page.write(feed)
+
+    for start in range(1, len(project) + 1, PAGE_SIZE):
+        write("issues", start, synthetic_gcode.issues_feed(name, project, start, PAGE_SIZE))
+    for issue in project:
+        for start in range(1, len(issue["comments"]) + 1, PAGE_SIZE):
+            write("comments", issue["id"] * 100000 + start, synthetic_gcode.comments_feed(name, issue, start, PAGE_SIZE))
+
+
+def gdata_parser(migrateissues):
+
+    """ Returns functions reading issues and comments from a page through gdata's object model. """
+
+    import atom.core
+    import gdata.projecthosting.data
+
+    class MergedIntoUpdate(atom.core.XmlElement):
+        _qname = gdata.projecthosting.data.ISSUES_TEMPLATE % 'mergedIntoUpdate'
+    gdata.projecthosting.data.Updates.mergedIntoUpdate = MergedIntoUpdate
+
+    def attachments(entry):
+        return [ migrateissues.enclosure_attachment(link.href, link.title, link.length)
+                 for link in entry.link if link.rel == "enclosure" and link.href ]
+
+    def issues(page):
+        for entry in atom.core.parse(page, gdata.projecthosting.data.IssuesFeed).entry:
+            yield migrateissues.GoogleIssue(
+                id = migrateissues.parse_gcode_id(entry.id.text),
+                title = entry.title.text,
+                status = entry.status.text if entry.status else "",
+                state = entry.state.text,
+                link = entry.link[1].href,
+                author = entry.author[0].name.text,
+                published = entry.published.text,
+                updated = entry.updated.text,
+                content = entry.content.text,
+                labels = [ label.text for label in entry.label ],
+                owner = entry.owner.username.text if entry.owner else None,
+                attachments = attachments(entry))
+
+    def comments(page):
+        for entry in atom.core.parse(page, gdata.projecthosting.data.CommentsFeed).entry:
+            merged_into = entry.updates.mergedIntoUpdate if entry.updates else None
+            yield migrateissues.GoogleComment(
+                id = migrateissues.parse_gcode_id(entry.id.text),
+                author = entry.author[0].name.text,
+                published = entry.published.text,
+                content = entry.content.text,
+                merged_into = int(merged_into.text) if merged_into is not None and merged_into.text else None,
+                attachments = attachments(entry))
+
+    def date(date_text):
+        return datetime.strptime(date_text, migrateissues.GOOGLE_DATE_FORMAT).strftime("%B %d, %Y %H:%M:%S")
+
+    return issues, comments, date
+
+
+def lean_parser(migrateissues):
+
+    """ Returns functions reading issues and comments from a page as migrateissues.py does. """
+
+    def issues(page):
+        for entry in migrateissues.iter_atom_entries(StringIO(page)):
+            yield migrateissues.issue_from_atom(entry)
+
+    def comments(page):
+        for entry in migrateissues.iter_atom_entries(StringIO(page)):
+            yield migrateissues.comment_from_atom(entry)
+
+    return issues, comments, migrateissues.parse_gcode_date
+
+
+def parse_fixtures(parser, directory, repeat):
+
+    """ Reads every fixture page 'repeat' times, returning the record count, mean time per read and a digest of the records. """
+
+    issues, comments, date = (gdata_parser if parser == "gdata" else lean_parser)(migrateissues)
+    pages = sorted(os.listdir(directory))
+
+    started = time.time()
+    for iteration in range(repeat):
+        digest = hashlib.sha1()
+        records = 0
+        for name in pages:
+            with open(os.path.join(directory, name)) as page:
+                data = page.read()
+            if name.startswith("issues-"):
+                for issue in issues(data):
+                    fields = [ issue.id, issue.title, issue.status, issue.state, issue.link, issue.author,
+                               date(issue.published), issue.updated, issue.content, issue.labels, issue.owner ]
+                    digest.update(json.dumps(fields))
+                    records += 1
+            else:
+                for comment in comments(data):
+                    fields = [ comment.id, comment.author, date(comment.published), comment.content, comment.merged_into ]
+                    digest.update(json.dumps(fields))
+                    records += 1
+    elapsed = time.time() - started
+
+    return { "records": records, "seconds": elapsed / repeat, "digest": digest.hexdigest() }
+
+
+def run_parser(parser, directory, repeat):
+
+    """ Runs one parser in its own process, returning its report with the peak RSS in KiB added. """
+
+    command = [ sys.executable, os.path.abspath(__file__), "--parse", parser, "--repeat", str(repeat), directory ]
+    process = subprocess.Popen(command, stdout = subprocess.PIPE)
+    output = process.stdout.read()
+    pid, status, usage = os.wait4(process.pid, 0)
+    if status:
+        return { "parser": parser, "status": status }
+
+    # ru_maxrss is in KiB on Linux, but in bytes on OS X
+
+    result = json.loads(output)
+    result.update(parser = parser, status = status,
+                  peak_rss_kib = usage.ru_maxrss / 1024 if sys.platform == "darwin" else usage.ru_maxrss)
+    return result
+
+
+def print_results(results, pages):
+    print "%d feed pages" % pages
+    print
+    print "%-8s %8s %10s %12s %12s" % ("parser", "seconds", "records", "per second", "peak RSS")
+    for result in results:
+        if result["status"]:
+            print "%-8s (exit status %d)" % (result["parser"], result["status"])
+            continue
+        print "%-8s %8.2f %10d %12d %9d KiB" % (result["parser"], result["seconds"], result["records"],
+                                                 result["records"] / max(result["seconds"], 0.001), result["peak_rss_kib"])
+
+    digests = set(result["digest"] for result in results if not result["status"])
+    if len(digests) > 1:
+        print
+        print "The parsers read different records!"
+
+
+if __name__ == "__main__":
+
+    usage = "usage: %prog [options] [parser ...]"
+    description = "Compare reading Google Code feeds through gdata and through migrateissues.py. Parsers: %s (default: all)." % ", ".join(PARSERS)
+    parser = optparse.OptionParser(usage = usage, description = description)
+
+    parser.add_option("-n", "--issues", type = "int", dest = "issues", help = "Number of Google Code issues (default: %default)", default = 2000)
+    parser.add_option("-c", "--mean-comments", type = "float", dest = "mean_comments", help = "Mean comments per issue (default: %default)", default = 4)
+    parser.add_option("-r", "--repeat", type = "int", dest = "repeat", help = "Times to read the fixture feeds (default: %default)", default = 3)
+    parser.add_option("--seed", type = "int", dest = "seed", help = "Random seed (default: %default)", default = 1)
+    parser.add_option("--json", dest = "json", help = "Also write the results to FILE", default = None)
+    parser.add_option("--parse", dest = "parse", help = "Internal: read the fixtures in the given directory with PARSER", metavar = "PARSER", default = None)
+
+    options, args = parser.parse_args()
+
+    if options.parse:
+        print json.dumps(parse_fixtures(options.parse, args[0], options.repeat))
+        raise SystemExit(0)
+
+    parsers = args or list(PARSERS)
+    for name in parsers:
+        if name not in PARSERS:
+            parser.error("unknown parser '%s'" % name)
+
+    project = synthetic_gcode.generate_project("benchmark", options.issues, options.seed, mean_comments = options.mean_comments)
+    directory = tempfile.mkdtemp(prefix = "migrateissues-feeds-")
+    try:
+        write_fixtures(directory, "benchmark", project)
+        pages = len(os.listdir(directory))
+        results = [ run_parser(name, directory, options.repeat) for name in parsers ]
+    finally:
+        shutil.rmtree(directory)
+
+    print_results(results, pages)
+
+    if options.json:
+        with open(options.json, "w") as output:
+            json.dump({ "issues": len(project), "pages": pages, "repeat": options.repeat, "seed": options.seed,
+                        "results": results }, output, indent = 2, sort_keys = True)
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+
+""" Runs migrateissues.py against the mock Github API and reports what each run costs.
+
+Each scenario runs the script as a separate process, with its Github and Google Code URLs
+pointed at a local mock server (see mock_github.py) holding a synthetic Google Code
+project, and measures the wall time, the number of requests made to each API and the peak
+memory use of the process.  Because the project is generated from a fixed seed, the
+numbers are comparable between runs and between versions of the script.
+
+The scenarios are:
+
+  fresh            Migrate the whole project into an empty repository.
+  rerun            Run again over the finished migration, which should change nothing.
+  synchronize-ids  Migrate into an empty repository with --synchronize-ids.
+  ordered-plan     Compile a plan with --synchronize-ids, then apply it to an empty
+                   repository with --execute-plan.
+  assign-ids       Rewrite the issue references of the finished migration with --assign-ids.
+  archive          Migrate from an Atom archive export instead of the live feeds.
+  import-api       Migrate into an empty repository with --import-api.
+  assign-owner     Migrate into an empty repository with --assign-owner.
+
+"""
+
+import json
+import optparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import mock_github
+import synthetic_gcode
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "migrateissues.py")
+
+SCENARIOS = ("fresh", "rerun", "synchronize-ids", "ordered-plan", "assign-ids", "archive", "import-api", "assign-owner")
+
+# Options, and whether the scenario starts from an empty repository
+
+SCENARIO_SETTINGS = {
+    "fresh": ([], True),
+    "rerun": ([], False),
+    "synchronize-ids": (["--synchronize-ids"], True),
+    "ordered-plan": (["--synchronize-ids"], True),
+    "assign-ids": (["--assign-ids"], False),
+    "archive": (["--archive", "%(archive)s"], True),
+    "import-api": (["--import-api"], True),
+    "assign-owner": (["--assign-owner"], True),
+}
+
+# Scenarios that run the script more than once, adding these options to each run in turn
+
+SCENARIO_PASSES = {
+    "ordered-plan": (["--plan", "%(plan)s"], ["--execute-plan", "%(plan)s"]),
+}
+
+
+def run_script(state, arguments, workdir):
+
+    """ Runs migrateissues.py to completion, returning its exit status, wall time and peak RSS in KiB. """
+
+    command = [ sys.executable, SCRIPT, "--github-api-url", state.base_url,
+                "--google-url", state.base_url[:-len("/api")] ] + arguments + [ state.project_name, state.owner, state.repo ]
+    environment = dict(os.environ, GITHUB_PASSWORD = "benchmark")
+
+    with open(os.path.join(workdir, "output.log"), "a") as log:
+        started = time.time()
+        process = subprocess.Popen(command, cwd = workdir, env = environment, stdout = log, stderr = subprocess.STDOUT)
+        pid, status, usage = os.wait4(process.pid, 0)
+        elapsed = time.time() - started
+
+    # ru_maxrss is in KiB on Linux, but in bytes on OS X
+
+    peak = usage.ru_maxrss / 1024 if sys.platform == "darwin" else usage.ru_maxrss
+    return status, elapsed, peak
+
+
+def run_scenario(state, scenario, options, workdir, archive):
+
+    """ Runs one scenario and returns its measurements. """
+
+    arguments, fresh = SCENARIO_SETTINGS[scenario]
+    arguments = arguments + [ "--workers", str(options.workers) ]
+    if options.http_cache:
+        arguments += [ "--http-cache", os.path.join(workdir, "github.cache") ]
+
+    if fresh:
+        state.clear()
+        if os.path.exists(os.path.join(workdir, "%s-%s.state" % (state.project_name, state.repo))):
+            os.remove(os.path.join(workdir, "%s-%s.state" % (state.project_name, state.repo)))
+    else:
+        with state.lock:
+            state.counts = {}
+            state.not_modified = 0
+
+    # A run that fails ends the scenario, with its exit status
+
+    paths = { "archive": archive, "plan": os.path.join(workdir, "%s.plan" % scenario) }
+    status, elapsed, peak = 0, 0.0, 0
+    for extra in SCENARIO_PASSES.get(scenario, ([],)):
+        status, seconds, rss = run_script(state, [ argument % paths for argument in arguments + list(extra) ], workdir)
+        elapsed, peak = elapsed + seconds, max(peak, rss)
+        if status:
+            break
+    github, google = state.totals()
+    issues = len(state.project)
+
+    return { "scenario": scenario, "status": status, "seconds": round(elapsed, 2), "github_requests": github,
+             "google_requests": google, "not_modified": state.not_modified,
+             "requests_per_issue": round(float(github) / issues, 2),
+             "peak_rss_kib": peak, "endpoints": dict(state.counts) }
+
+
+def print_results(results, issues, comments):
+    print "%d issues, %d comments" % (issues, comments)
+    print
+    print "%-16s %8s %10s %10s %12s %12s" % ("scenario", "seconds", "github", "google", "per issue", "peak RSS")
+    for result in results:
+        failed = " (exit status %d)" % result["status"] if result["status"] else ""
+        print "%-16s %8.2f %10d %10d %12.2f %9d KiB%s" % (result["scenario"], result["seconds"], result["github_requests"],
+                                                           result["google_requests"], result["requests_per_issue"],
+                                                           result["peak_rss_kib"], failed)
+
+
+if __name__ == "__main__":
+
+    usage = "usage: %prog [options] [scenario ...]"
+    description = "Benchmark migrateissues.py against a mock Github API. Scenarios: %s (default: all)." % ", ".join(SCENARIOS)
+    parser = optparse.OptionParser(usage = usage, description = description)
+
+    parser.add_option("-n", "--issues", type = "int", dest = "issues", help = "Number of Google Code issues (default: %default)", default = 500)
+    parser.add_option("-c", "--mean-comments", type = "float", dest = "mean_comments", help = "Mean comments per issue (default: %default)", default = 4)
+    parser.add_option("-w", "--workers", type = "int", dest = "workers", help = "Value of migrateissues.py --workers (default: %default)", default = 1)
+    parser.add_option("--latency", type = "float", dest = "latency", help = "Seconds to delay each mock request (default: %default)", default = 0.0)
+    parser.add_option("--quota", type = "int", dest = "quota", help = "Github requests allowed per hour (default: %default)", default = 1000000)
+    parser.add_option("--seed", type = "int", dest = "seed", help = "Random seed (default: %default)", default = 1)
+    parser.add_option("--http-cache", action = "store_true", dest = "http_cache", help = "Run the script with --http-cache, kept across scenarios", default = False)
+    parser.add_option("--json", dest = "json", help = "Also write the results, with per-endpoint request counts, to FILE", default = None)
+    parser.add_option("--keep", action = "store_true", dest = "keep", help = "Keep the working directory, with the script's output", default = False)
+
+    options, args = parser.parse_args()
+
+    scenarios = args or list(SCENARIOS)
+    for scenario in scenarios:
+        if scenario not in SCENARIOS:
+            parser.error("unknown scenario '%s'" % scenario)
+
+    project = synthetic_gcode.generate_project("benchmark", options.issues, options.seed, mean_comments = options.mean_comments)
+    state = mock_github.MockState(None, "benchmarker", "benchmark", "benchmark", project,
+                                  latency = options.latency, quota = options.quota)
+    server = mock_github.start_server(state)
+
+    workdir = tempfile.mkdtemp(prefix = "migrateissues-benchmark-")
+    archive = os.path.join(workdir, "benchmark.atom")
+    synthetic_gcode.write_archive(archive, "benchmark", project)
+
+    results = []
+    try:
+        for scenario in scenarios:
+            results.append(run_scenario(state, scenario, options, workdir, archive))
+    finally:
+        server.shutdown()
+        if options.keep:
+            print "Working directory: %s" % workdir
+        else:
+            shutil.rmtree(workdir)
+
+    print_results(results, len(project), sum(len(issue["comments"]) for issue in project))
+
+    if options.json:
+        with open(options.json, "w") as output:
+            json.dump({ "issues": len(project), "workers": options.workers, "latency": options.latency,
+                        "seed": options.seed, "results": results }, output, indent = 2, sort_keys = True)
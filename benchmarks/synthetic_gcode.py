@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+
+""" Generates synthetic Google Code projects for benchmarking migrateissues.py.
+
+Projects are generated deterministically from a seed, and can be rendered as the Atom
+feeds served by the Google Code issue tracker API (see mock_github.py, which serves them)
+or written to disk as an archive export for migrateissues.py --archive.
+
+The shape of a generated project follows real ones: comment counts are heavily skewed (most
+issues have a few comments, some have hundreds), some issue IDs are missing because their
+issues were deleted, some issues were merged into others as duplicates, and issue texts
+refer to each other as 'issue N' and '#N'.
+
+"""
+
+import optparse
+import random
+
+from datetime import datetime, timedelta
+from xml.sax.saxutils import escape, quoteattr
+
+FEED_TEMPLATE = """<?xml version='1.0' encoding='UTF-8'?>
+<feed xmlns='http://www.w3.org/2005/Atom' xmlns:openSearch='http://a9.com/-/spec/opensearch/1.1/' xmlns:issues='http://schemas.google.com/projecthosting/issues/2009'>
+<id>%(id)s</id>
+<updated>%(updated)s</updated>
+<title>%(title)s</title>
+<openSearch:totalResults>%(total)d</openSearch:totalResults>
+<openSearch:startIndex>%(start)d</openSearch:startIndex>
+<openSearch:itemsPerPage>%(count)d</openSearch:itemsPerPage>
+%(entries)s
+</feed>
+"""
+
+FEED_URL = "http://code.google.com/feeds/issues/p/%s/issues"
+ISSUE_URL = "http://code.google.com/p/%s/issues/detail?id=%d"
+
+STATUSES = (("New", "open", 30), ("Accepted", "open", 15), ("Started", "open", 5),
+            ("Fixed", "closed", 30), ("Verified", "closed", 5), ("WontFix", "closed", 5),
+            ("Invalid", "closed", 5), ("Done", "closed", 5))
+
+LABELS = ("Type-Defect", "Type-Enhancement", "Type-Task", "Priority-Critical", "Priority-High",
+          "Priority-Medium", "Priority-Low", "OpSys-All", "Component-UI", "Component-Docs")
+
+WORDS = ("the", "crash", "when", "opening", "file", "window", "button", "does", "not", "work",
+         "expected", "output", "error", "version", "please", "fix", "attached", "patch", "it",
+         "seems", "that", "after", "upgrade", "slow", "memory", "thanks", "same", "here")
+
+
+def text(rng, words):
+    return " ".join(rng.choice(WORDS) for i in range(words)).capitalize() + "."
+
+
+def feed_date(when):
+    return when.strftime("%Y-%m-%dT%H:%M:%S.000Z")
+
+
+def generate_project(name, issues = 1000, seed = 1, gap_rate = 0.03, merge_rate = 0.02,
+                     reference_rate = 0.1, mean_comments = 4, max_comments = 500):
+
+    """ Returns a synthetic project: a list of issue dictionaries, each with its comments.
+
+    Comment counts follow a Pareto distribution scaled to 'mean_comments'.  A 'gap_rate'
+    fraction of IDs is skipped, a 'merge_rate' fraction of issues are duplicates merged
+    into an earlier issue, and a 'reference_rate' fraction of texts refer to other issues.
+
+    """
+
+    rng = random.Random(seed)
+    started = datetime(2008, 1, 1)
+    project = []
+    gid = 0
+
+    while len(project) < issues:
+        gid += 1
+        if rng.random() < gap_rate:
+            continue
+
+        status, state, weight = rng.choice([ status for status in STATUSES for i in range(status[2]) ])
+        published = started + timedelta(hours = gid * 7)
+        content = text(rng, rng.randint(5, 80))
+        if project and rng.random() < reference_rate:
+            content += " See issue %d." % rng.choice(project)["id"]
+
+        # Comment counts are skewed: Pareto(1.5) has mean 3, which we rescale
+
+        count = min(int((rng.paretovariate(1.5) - 1) * mean_comments / 2.0), max_comments)
+        comments = []
+        for number in range(1, count + 1):
+            body = text(rng, rng.randint(3, 60))
+            if project and rng.random() < reference_rate:
+                body += " Same as #%d." % rng.choice(project)["id"]
+            comments.append({ "id": number, "author": "user%d" % rng.randint(1, 50),
+                              "published": published + timedelta(minutes = 30 * number),
+                              "content": body, "merged_into": None })
+
+        issue = { "id": gid, "title": text(rng, rng.randint(3, 10)), "status": status, "state": state,
+                  "author": "user%d" % rng.randint(1, 50), "published": published, "content": content,
+                  "labels": rng.sample(LABELS, rng.randint(0, 3)),
+                  "owner": "owner%d" % rng.randint(1, 5) if rng.random() < 0.4 else None,
+                  "comments": comments }
+
+        # Duplicates get a merged-into update, and their parent the automatic comment
+
+        if project and rng.random() < merge_rate:
+            parent = rng.choice(project)
+            issue["status"], issue["state"] = "Duplicate", "closed"
+            comments.append({ "id": len(comments) + 1, "author": issue["author"],
+                              "published": published + timedelta(days = 1), "content": None,
+                              "merged_into": parent["id"] })
+            parent["comments"].append({ "id": len(parent["comments"]) + 1, "author": issue["author"],
+                                        "published": published + timedelta(days = 1),
+                                        "content": "Issue %d has been merged into this issue." % gid,
+                                        "merged_into": None })
+
+        project.append(issue)
+
+    for issue in project:
+        last = max([ issue["published"] ] + [ comment["published"] for comment in issue["comments"] ])
+        issue["updated"] = last
+
+    return project
+
+
+def issue_entry(name, issue):
+
+    """ Returns the Atom <entry> for an issue, as in a Google Code issues feed. """
+
+    feed = FEED_URL % name
+    lines = [ "<entry>",
+              "<id>%s/full/%d</id>" % (feed, issue["id"]),
+              "<published>%s</published>" % feed_date(issue["published"]),
+              "<updated>%s</updated>" % feed_date(issue["updated"]),
+              "<title>%s</title>" % escape(issue["title"]),
+              "<content type='html'>%s</content>" % escape(issue["content"]),
+              "<link rel='replies' type='application/atom+xml' href=%s/>" % quoteattr("%s/%d/comments/full" % (feed, issue["id"])),
+              "<link rel='alternate' type='text/html' href=%s/>" % quoteattr(ISSUE_URL % (name, issue["id"])),
+              "<link rel='self' type='application/atom+xml' href=%s/>" % quoteattr("%s/full/%d" % (feed, issue["id"])),
+              "<author><name>%s</name><uri>/u/%s/</uri></author>" % (issue["author"], issue["author"]),
+              "<issues:id>%d</issues:id>" % issue["id"] ]
+    lines.extend("<issues:label>%s</issues:label>" % escape(label) for label in issue["labels"])
+    if issue["owner"]:
+        lines.append("<issues:owner><issues:uri>/u/%s/</issues:uri><issues:username>%s</issues:username></issues:owner>" % (issue["owner"], issue["owner"]))
+    lines.append("<issues:stars>0</issues:stars>")
+    lines.append("<issues:state>%s</issues:state>" % issue["state"])
+    lines.append("<issues:status>%s</issues:status>" % issue["status"])
+    lines.append("</entry>")
+    return "\n".join(lines)
+
+
+def comment_entry(name, issue, comment):
+
+    """ Returns the Atom <entry> for a comment, as in a Google Code comments feed. """
+
+    feed = FEED_URL % name
+    lines = [ "<entry>",
+              "<id>%s/%d/comments/full/%d</id>" % (feed, issue["id"], comment["id"]),
+              "<published>%s</published>" % feed_date(comment["published"]),
+              "<updated>%s</updated>" % feed_date(comment["published"]),
+              "<title>Comment %d by %s</title>" % (comment["id"], comment["author"]),
+              "<content type='html'>%s</content>" % escape(comment["content"] or ""),
+              "<link rel='self' type='application/atom+xml' href=%s/>" % quoteattr("%s/%d/comments/full/%d" % (feed, issue["id"], comment["id"])),
+              "<author><name>%s</name><uri>/u/%s/</uri></author>" % (comment["author"], comment["author"]) ]
+    if comment["merged_into"]:
+        lines.append("<issues:updates><issues:status>Duplicate</issues:status><issues:mergedIntoUpdate>%d</issues:mergedIntoUpdate></issues:updates>" % comment["merged_into"])
+    else:
+        lines.append("<issues:updates/>")
+    lines.append("</entry>")
+    return "\n".join(lines)
+
+
+def render_feed(name, title, entries, total, start):
+    return FEED_TEMPLATE % { "id": FEED_URL % name, "updated": feed_date(datetime.utcnow()), "title": title,
+                             "total": total, "start": start, "count": len(entries), "entries": "\n".join(entries) }
+
+
+def issues_feed(name, project, start_index = 1, max_results = 25, updated_min = None):
+
+    """ Returns a page of the project's issues feed, as served by the issue tracker API. """
+
+    issues = [ issue for issue in project if updated_min is None or feed_date(issue["updated"]) >= updated_min ]
+    page = issues[start_index - 1:start_index - 1 + max_results]
+    return render_feed(name, "Issues - %s" % name, [ issue_entry(name, issue) for issue in page ], len(issues), start_index)
+
+
+def comments_feed(name, issue, start_index = 1, max_results = 25, updated_min = None):
+
+    """ Returns a page of an issue's comments feed, as served by the issue tracker API. """
+
+    comments = [ comment for comment in issue["comments"] if updated_min is None or feed_date(comment["published"]) >= updated_min ]
+    page = comments[start_index - 1:start_index - 1 + max_results]
+    return render_feed(name, "Comments for issue %d" % issue["id"], [ comment_entry(name, issue, comment) for comment in page ],
+                       len(comments), start_index)
+
+
+def write_archive(path, name, project):
+
+    """ Writes the project as an Atom archive export, readable by migrateissues.py --archive. """
+
+    with open(path, "w") as archive:
+        archive.write(FEED_TEMPLATE.split("%(entries)s")[0] % { "id": FEED_URL % name, "updated": feed_date(datetime.utcnow()),
+                                                              "title": "Issues - %s" % name, "total": len(project),
+                                                              "start": 1, "count": len(project) })
+        for issue in project:
+            archive.write(issue_entry(name, issue) + "\n")
+            for comment in issue["comments"]:
+                archive.write(comment_entry(name, issue, comment) + "\n")
+        archive.write("</feed>\n")
+
+
+if __name__ == "__main__":
+
+    usage = "usage: %prog [options] <project name> <archive file>"
+    description = "Write a synthetic Google Code project as an Atom archive export."
+    parser = optparse.OptionParser(usage = usage, description = description)
+
+    parser.add_option("-n", "--issues", type = "int", dest = "issues", help = "Number of issues (default: %default)", default = 1000)
+    parser.add_option("-c", "--mean-comments", type = "float", dest = "mean_comments", help = "Mean comments per issue (default: %default)", default = 4)
+    parser.add_option("--seed", type = "int", dest = "seed", help = "Random seed (default: %default)", default = 1)
+
+    options, args = parser.parse_args()
+
+    if len(args) != 2:
+        parser.print_help()
+        raise SystemExit(1)
+
+    project = generate_project(args[0], options.issues, options.seed, mean_comments = options.mean_comments)
+    write_archive(args[1], args[0], project)
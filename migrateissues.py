@@ -1,15 +1,49 @@
 #!/usr/bin/env python
 
 import optparse
+import os
 import sys
 import re
 import logging
 import getpass
+import difflib
+import hashlib
+import Queue
+import json
+import gzip
+import sqlite3
+import zipfile
+import threading
+import time
+import contextlib
+import functools
+import httplib
+import socket
+import multiprocessing
+import posixpath
+import shutil
+import subprocess
+import tempfile
+import urllib
+import urllib2
+import urlparse
+
+from multiprocessing.pool import ThreadPool
+
+# datetime.strptime imports this lazily, which isn't thread-safe in Python 2 when the
+# first call happens in several --workers threads at once.
+import _strptime
 
 from datetime import datetime
+from itertools import islice
+from cStringIO import StringIO
+from xml.etree import cElementTree as ElementTree
 
 import github
-from atom.core import XmlElement
+import github.IssueComment
+import github.Label
+import github.PaginatedList
+import github.Requester
 
 import gdata.projecthosting.client
 import gdata.projecthosting.data
@@ -22,10 +56,55 @@ logging.basicConfig(level = logging.INFO)
 # The maximum number of records to retrieve from Google Code in a single request
 GOOGLE_MAX_RESULTS = 500
 
-# The minimum number of remaining Github rate-limited API requests before we pre-emptively
-# abort to avoid hitting the limit part-way through migrating an issue.
+# The default number of Google Code issues (with their comments) to read ahead of the
+# issues being written to Github, and the number of threads fetching comment feeds.
+GOOGLE_PREFETCH_ISSUES = 50
+GOOGLE_PREFETCH_THREADS = 4
+
+# The number of Github rate-limited API requests to keep in hand; when the remaining quota
+# drops to this, we wait for the hourly reset rather than risk hitting the limit part-way
+# through migrating an issue.
 GITHUB_SPARE_REQUESTS = 50
 
+# The number of Github requests that may be sent back-to-back before pacing kicks in
+GITHUB_BURST_REQUESTS = 20
+
+# The number of items to request per page when listing Github issues, comments and labels
+GITHUB_PER_PAGE = 100
+
+# The default size limit of the --http-cache file, in megabytes, and the number of idle
+# keep-alive connections to keep open to each host
+HTTP_CACHE_SIZE = 100
+HTTP_POOL_SIZE = 8
+
+# The default size limit of the --google-cache file, in megabytes
+GOOGLE_CACHE_SIZE = 500
+
+# The media type of Github's issue import API, how often to poll for pending imports, and
+# how many seconds to keep polling when none of them finishes
+GITHUB_IMPORT_ACCEPT = "application/vnd.github.golden-comet-preview+json"
+GITHUB_IMPORT_POLL_INTERVAL = 2
+GITHUB_IMPORT_TIMEOUT = 600
+
+# How many times to retry a Github request refused by a rate limit, and how long to wait
+# after a secondary ('abuse') rate limit that doesn't say when to retry.
+GITHUB_RATE_LIMIT_RETRIES = 5
+GITHUB_SECONDARY_LIMIT_WAIT = 60
+
+# The number of journalled operations after which the state file is synced to disk
+STATE_SYNC_OPERATIONS = 100
+
+# How often, in seconds, to rewrite the --metrics-file and --prometheus-file reports
+METRICS_INTERVAL = 30
+
+# Members of .zip exports are copied out to a temporary file before they're read, since
+# gzip needs to seek; the copy is kept in memory up to this many bytes
+ARCHIVE_SPOOL_SIZE = 16 * 1024 * 1024
+
+# Attachments are copied in chunks of this many bytes, by this many threads at once
+ATTACHMENT_CHUNK_SIZE = 64 * 1024
+ATTACHMENT_THREADS = 4
+
 # Edit this list, if you like to skip issues with the following status
 # values. You can also add your custom status values.
 # WARNING: CASE-SENSITIVE!
@@ -56,11 +135,30 @@ GOOGLE_STATUS_MAPPING = {
     #"Done"      :"done",
 }
 
+# Google Code statuses that mean an issue is closed, for sources that don't say explicitly
+GOOGLE_CLOSED_STATUSES = ("Fixed", "Verified", "Invalid", "Duplicate", "WontFix", "Done")
+
+# The format of dates in Google Code feeds
+GOOGLE_DATE_FORMAT = "%Y-%m-%dT%H:%M:%S.000Z"
+
+# The paths of a project's issues feed and of an issue's comments feed
+GOOGLE_ISSUES_FEED = "/feeds/issues/p/%s/issues/full"
+GOOGLE_COMMENTS_FEED = "/feeds/issues/p/%s/issues/%d/comments/full"
+
 GOOGLE_ISSUE_TEMPLATE = '_Original issue: %s_'
+GOOGLE_COMMENT_MARKER = '<!-- Google Code comment %d -->'
+GOOGLE_COMMENT_MARKER_RE = re.compile(r'\s*<!-- Google Code comment (\d+) -->\s*$')
 GOOGLE_URL    = 'http://code.google.com/p/%s/issues/detail?id=%d'
 GOOGLE_URL_RE = 'http://code.google.com/p/%s/issues/detail\?id=(\d+)'
 GOOGLE_ID_RE = GOOGLE_ISSUE_TEMPLATE % GOOGLE_URL_RE
 
+# Where the files attached to issues in a Google Code Archive export can be downloaded
+GOOGLE_ATTACHMENT_URL = 'https://storage.googleapis.com/google-code-attachments/%(project)s/issue-%(issue)d/comment-%(comment)03d/%(name)s'
+
+# References to Google Code issues rewritten by --assign-ids: 'issue 1', 'issue #1', '#1'
+# and issue links, other than the original issue footer and references already rewritten.
+GOOGLE_REFERENCE_RE = r"(?<![\w&])issue ?#?(\d+)(?!\d| \(Github)|(?<![\w&])(?<!Github: )#(\d+)(?!\d| \(Github)|(?<!_Original issue: )%s(?!\d| \(Github)"
+
 # Mapping from Google Code issue labels to Github labels. Uncomment the
 # default labels to map them, or add your custom labels to the array.
 GOOGLE_LABEL_MAPPING = {
@@ -89,473 +187,3752 @@ GOOGLE_LABEL_MAPPING = {
     #'Maintainability'       : 'Maintainability',
 }
 
-# Patch gdata's CommentEntry Updates object to include the merged-into field
-class MergedIntoUpdate(XmlElement):
-    _qname = gdata.projecthosting.data.ISSUES_TEMPLATE % 'mergedIntoUpdate'
-gdata.projecthosting.data.Updates.mergedIntoUpdate = MergedIntoUpdate
+# Optional: ijson lets us stream a Google Code Archive JSON file without loading it whole
+try: import ijson
+except ImportError: ijson = None
+
+ATOM_NS = "{http://www.w3.org/2005/Atom}"
+ISSUES_NS = gdata.projecthosting.data.ISSUES_TEMPLATE % ""
+OPENSEARCH_NS = "{http://a9.com/-/spec/opensearch/1.1/}"
+
+output_lock = threading.Lock()
 
 def output(string):
-    sys.stdout.write(string)
-    sys.stdout.flush()
+    with output_lock:
+        sys.stdout.write(string)
+        sys.stdout.flush()
 
-def github_label(name, color = "FFFFFF"):
+class MigrationState(object):
 
-    """ Returns the Github label with the given name, creating it if necessary. """
+    """ Persistent on-disk record of what has already been migrated to Github.
 
-    try: return label_cache[name]
-    except KeyError:
-        try: return label_cache.setdefault(name, github_repo.get_label(name))
-        except github.GithubException:
-            return label_cache.setdefault(name, github_repo.create_label(name, color))
+    Re-runs and --assign-ids read the Google ID -> Github issue map from here instead of
+    listing and regex-searching every issue on Github.  One row is kept per migrated issue
+    (its Github number, state and label set), plus one row per migrated comment, keyed by a
+    fingerprint of its Github body.  Copied attachments are recorded by their original URL.
 
+    The journal table is a write-ahead log of Github writes: every issue creation, comment,
+    state change and label creation is journalled before its request is sent,
+    and removed once its result has been recorded.  Whatever is left in the journal after
+    a crash is exactly what may or may not have reached Github, and replay_journal() sorts
+    it out on the next run.  The file is kept in WAL mode and synced to disk in batches of
+    STATE_SYNC_OPERATIONS operations, rather than on every write.
 
-def parse_gcode_id(id_text):
+    """
 
-    """ Returns the numeric part of a Google Code ID stringh. """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS issues (
+            google_id      INTEGER PRIMARY KEY,
+            github_number  INTEGER NOT NULL,
+            state          TEXT NOT NULL,
+            labels         TEXT NOT NULL DEFAULT '[]',
+            comments_known INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS comments (
+            google_id   INTEGER NOT NULL,
+            fingerprint TEXT NOT NULL,
+            PRIMARY KEY (google_id, fingerprint)
+        );
+        CREATE TABLE IF NOT EXISTS imports (
+            url       TEXT PRIMARY KEY,
+            google_id INTEGER NOT NULL,
+            created   TEXT NOT NULL,
+            state     TEXT NOT NULL,
+            labels    TEXT NOT NULL,
+            comments  TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS settings (
+            name  TEXT PRIMARY KEY,
+            value TEXT
+        );
+        CREATE TABLE IF NOT EXISTS attachments (
+            url    TEXT PRIMARY KEY,
+            path   TEXT NOT NULL,
+            sha256 TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS journal (
+            id        INTEGER PRIMARY KEY AUTOINCREMENT,
+            google_id INTEGER,
+            operation TEXT NOT NULL,
+            detail    TEXT,
+            started   TEXT NOT NULL
+        );
+    """
 
-    return int(re.search("\d+$", id_text).group(0))
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.RLock()   # Shared by all --workers threads
+        self.db = sqlite3.connect(path, check_same_thread = False)
+        self.db.execute("PRAGMA journal_mode = WAL")
+        self.db.execute("PRAGMA synchronous = NORMAL")
+        self.db.executescript(self.SCHEMA)
+        self.journaling = True          # Off in dry runs, which don't write to Github
+        self.unsynced = 0
 
+    def is_empty(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM issues").fetchone()[0] == 0
 
-def parse_gcode_date(date_text):
+    def clear(self):
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM issues")
+            self.db.execute("DELETE FROM comments")
 
-    """ Transforms a Google Code date into a more human readable stringh. """
+    def issues(self):
 
-    parsed = datetime.strptime(date_text, "%Y-%m-%dT%H:%M:%S.000Z")
-    return parsed.strftime("%B %d, %Y %H:%M:%S")
+        """ Returns a dictionary mapping Google Code IDs to (number, state, labels) tuples. """
 
+        with self.lock:
+            rows = self.db.execute("SELECT google_id, github_number, state, labels FROM issues").fetchall()
+        return dict((gid, (number, state, json.loads(labels))) for gid, number, state, labels in rows)
 
-def should_migrate_comment(comment):
+    def record_issue(self, gid, number, state, labels, comments_known = True):
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO issues VALUES (?, ?, ?, ?, ?)",
+                            (gid, number, state, json.dumps(sorted(labels)), int(comments_known)))
 
-    """ Returns True if the given comment should be migrated to Github, otherwise False.
+    def issue_state(self, gid):
+        with self.lock:
+            row = self.db.execute("SELECT state FROM issues WHERE google_id = ?", (gid,)).fetchone()
+        return row[0] if row else None
 
-    A comment should be migrated if it represents a duplicate-merged-into update, or if
-    it has a body that isn't the automated 'issue x has been merged into this issue'.
+    def record_state(self, gid, state):
+        with self.lock, self.db:
+            self.db.execute("UPDATE issues SET state = ? WHERE google_id = ?", (state, gid))
 
-    """
+    def comments_known(self, gid):
+        with self.lock:
+            row = self.db.execute("SELECT comments_known FROM issues WHERE google_id = ?", (gid,)).fetchone()
+        return bool(row and row[0])
 
-    if comment.content.text:
-        if re.match(r"Issue (\d+) has been merged into this issue.", comment.content.text):
-            return False
-        return True
-    elif comment.updates.mergedIntoUpdate:
-        return True
-    return False
+    def comment_fingerprints(self, gid):
+        with self.lock:
+            rows = self.db.execute("SELECT fingerprint FROM comments WHERE google_id = ?", (gid,)).fetchall()
+        return set(row[0] for row in rows)
 
+    def record_comments(self, gid, fingerprints, complete = False):
 
-def prepare_content(content):
-    # replace blank content (using text from Google Code)
-    if content is None:
-        content = "(No comment was entered for this change.)"
+        """ Records migrated comments; 'complete' means these are all the issue's comments. """
 
-    # clean content
-    content = content.replace('\n#', '\n#&#8203;')
-    content = content.replace('\n #', '\n #&#8203;')
+        with self.lock, self.db:
+            self.db.executemany("INSERT OR IGNORE INTO comments VALUES (?, ?)",
+                                [ (gid, fingerprint) for fingerprint in fingerprints ])
+            if complete:
+                self.db.execute("UPDATE issues SET comments_known = 1 WHERE google_id = ?", (gid,))
 
-    # optionally rewrite issue id text that Google hyperlinks
-    # to issue text that Github hyperlinks ("issue N" -> "#N")
-    if options.rewrite_issue_links:
-        content = re.sub('issue\s+(?P<num>\d+)', '#\g<num>', content, flags=re.I)
-    return content
+    def record_import(self, gid, url, state, labels, comment_keys):
 
+        """ Records an issue submitted to the Github import API, until it's been created. """
 
-def format_comment(comment):
+        created = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO imports VALUES (?, ?, ?, ?, ?, ?)",
+                            (url, gid, created, state, json.dumps(sorted(labels)), json.dumps(comment_keys)))
 
-    """ Returns the Github comment body for the given Google Code comment.
+    def pending_imports(self):
 
-    Most comments are left unchanged, except to add a header identifying their original
-    author and post-date.  Google Code's merged-into comments, used to flag duplicate
-    issues, are replaced with a little message linking to the parent issue.
+        """ Returns a dictionary mapping pending import URLs to (Google ID, submission time). """
 
-    """
+        with self.lock:
+            rows = self.db.execute("SELECT url, google_id, created FROM imports").fetchall()
+        return dict((url, (gid, created)) for url, gid, created in rows)
 
-    author = comment.author[0].name.text
-    date = parse_gcode_date(comment.published.text)
-    content = prepare_content(comment.content.text)
+    def complete_import(self, url, number):
 
-    if comment.updates.mergedIntoUpdate:
-        return "_This issue is a duplicate of #%d_" % (options.base_id + int(comment.updates.mergedIntoUpdate.text))
-    else: return "_From %s on %s_\n%s" % (author, date, content)
+        """ Records the issue created by an import, or forgets a failed one if number is None. """
 
+        with self.lock:
+            row = self.db.execute("SELECT google_id, state, labels, comments FROM imports WHERE url = ?", (url,)).fetchone()
+            if row is None:
+                return
+            gid, state, labels, comment_keys = row
+            if number is not None:
+                self.record_issue(gid, number, state, json.loads(labels))
+                self.record_comments(gid, json.loads(comment_keys), complete = True)
+            with self.db:
+                self.db.execute("DELETE FROM imports WHERE url = ?", (url,))
 
+    def get_setting(self, name, default = None):
+        with self.lock:
+            row = self.db.execute("SELECT value FROM settings WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else default
 
-def add_issue_to_github(issue):
+    def set_setting(self, name, value):
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO settings VALUES (?, ?)", (name, value))
 
-    """ Migrates the given Google Code issue to Github. """
+    def stored_attachment(self, url):
 
-    gid = parse_gcode_id(issue.id.text)
-    status = issue.status.text if issue.status else ""
-    title = issue.title.text
-    link = issue.link[1].href
-    author = issue.author[0].name.text
-    date = parse_gcode_date(issue.published.text)
-    content = prepare_content(issue.content.text)
+        """ Returns the path under which the attachment at 'url' was stored, or None. """
 
-    # Github takes issue with % in the title or body.
-    title = title.replace('%', '&#37;')
+        with self.lock:
+            row = self.db.execute("SELECT path FROM attachments WHERE url = ?", (url,)).fetchone()
+        return row[0] if row else None
 
-    # Github rate-limits API requests to 5000 per hour, and if we hit that limit part-way
-    # through adding an issue it could end up in an incomplete state.  To avoid this we'll
-    # ensure that there are enough requests remaining before we start migrating an issue.
+    def record_attachment(self, url, path, sha256):
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO attachments VALUES (?, ?, ?)", (url, path, sha256))
 
-    if gh.rate_limiting[0] < GITHUB_SPARE_REQUESTS:
-        raise Exception("Aborting to to impending Github API rate-limit cutoff.")
+    def forget_comments(self, gid):
 
-    # Build a list of labels to apply to the new issue, including an 'imported' tag that
-    # we can use to identify this issue as one that's passed through migration.
+        """ Marks an issue's recorded comments as incomplete, so they're checked on Github. """
 
-    labels = ["imported"]
+        with self.lock, self.db:
+            self.db.execute("UPDATE issues SET comments_known = 0 WHERE google_id = ?", (gid,))
 
-    # Convert Google Code labels to Github labels where possible
+    @contextlib.contextmanager
+    def operation(self, gid, operation, detail = None):
 
-    if issue.label:
-        for label in issue.label:
-            if label.text.startswith("Priority-") and options.omit_priority:
-                continue
-            labels.append(GOOGLE_LABEL_MAPPING.get(label.text, label.text))
+        """ Journals a Github write around the block that performs and records it.
 
-    # Add additional labels based on the issue's state
+        The journal entry is removed only if the block completes; if it raises, or the
+        process dies, the entry is left for replay_journal().
 
-    if status in GOOGLE_STATUS_MAPPING:
-        labels.append(GOOGLE_STATUS_MAPPING[status])
-    else:
-        labels.append(status.lower())
+        """
 
-    # Add the new Github issue with its labels and a header identifying it as migrated
+        if not self.journaling:
+            yield
+            return
 
-    github_issue = None
+        started = datetime.utcnow().strftime(GOOGLE_DATE_FORMAT)
+        with self.lock, self.db:
+            entry = self.db.execute("INSERT INTO journal (google_id, operation, detail, started) VALUES (?, ?, ?, ?)",
+                                    (gid, operation, detail, started)).lastrowid
+        yield
+        self.finish_operation(entry)
 
-    header = "_Original author: %s (%s)_" % (author, date)
-    footer = GOOGLE_ISSUE_TEMPLATE % link
-    body = "%s\n\n%s\n\n\n%s" % (header, content, footer)
+    def finish_operation(self, entry):
+        with self.lock:
+            with self.db:
+                self.db.execute("DELETE FROM journal WHERE id = ?", (entry,))
+            self.unsynced += 1
+            if self.unsynced >= STATE_SYNC_OPERATIONS:
+                self.sync()
 
-    output("Adding issue %d" % gid)
+    def unfinished_operations(self):
 
-    if not options.dry_run:
-	# Remove empty values from 'labels' list
-	labels = filter (lambda a: a != '', labels)
+        """ Returns the journal's (entry, Google ID, operation, detail, start time) tuples. """
 
-        github_labels = [ github_label(label) for label in labels ]
-        github_issue = github_repo.create_issue(title, body = body.encode("utf-8"), labels = github_labels)
+        with self.lock:
+            return self.db.execute("SELECT id, google_id, operation, detail, started FROM journal ORDER BY id").fetchall()
 
-    # Assigns issues that originally had an owner to the current user
+    def sync(self):
 
-    if issue.owner and options.assign_owner:
-        assignee = gh.get_user(github_user.login)
-        if not options.dry_run:
-            github_issue.edit(assignee = assignee)
+        """ Flushes everything recorded so far to disk. """
 
-    return github_issue
+        with self.lock:
+            self.db.execute("PRAGMA wal_checkpoint(FULL)")
+            self.unsynced = 0
 
 
-def add_comments_to_issue(github_issue, gid):
+class Metrics(object):
 
-    """ Migrates all comments from a Google Code issue to its Github copy. """
+    """ Counts and times every outbound request, by API, endpoint and migration phase.
 
-    start_index = 1
-    max_results = GOOGLE_MAX_RESULTS
+    Each thread runs in a phase ('create', 'comments', 'labels', ...), set by phase() or
+    the in_phase() decorator, and every Github or Google Code request it makes is recorded
+    under that phase, with the time spent on it.  Time spent held back by the rate-limit
+    scheduler is recorded separately.  Together with counts of migrated issues and
+    comments, this gives throughput, requests per issue and an ETA, reported as a JSON
+    summary and optionally as a Prometheus textfile, rewritten every 'interval' seconds.
 
-    # Retrieve existing Github comments, to figure out which Google Code comments are new
+    """
 
-    existing_comments = [ comment.body for comment in github_issue.get_comments() ]
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.started = time.time()
+        self.requests = {}      # (api, endpoint, phase) -> [count, seconds, errors]
+        self.throttled = {}     # phase -> seconds spent waiting for the rate limit
+        self.counters = dict.fromkeys(("issues_processed", "issues_created", "issues_updated",
+                                       "comments_created", "dummy_issues", "not_modified",
+                                       "attachments_copied", "attachments_deduplicated",
+                                       "google_cache_hits", "issues_verified", "issues_drifted",
+                                       "issues_repaired"), 0)
+        self.expected = None    # Total number of issues in the source, if known
+        self.stopped = threading.Event()
+
+    def current_phase(self):
+        return getattr(self.local, "phase", None) or "other"
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        previous = getattr(self.local, "phase", None)
+        self.local.phase = name
+        try:
+            yield
+        finally:
+            self.local.phase = previous
 
-    # Retain compatibility with earlier versions of migrateissues.py
+    def record(self, api, endpoint, seconds, error = False, phase = None):
+        key = (api, endpoint, phase or self.current_phase())
+        with self.lock:
+            entry = self.requests.setdefault(key, [0, 0.0, 0])
+            entry[0] += 1
+            entry[1] += seconds
+            entry[2] += int(error)
 
-    existing_comments = [ re.sub(r'^(.+):_\n', r'\1_\n', body) for body in existing_comments ]
+    @contextlib.contextmanager
+    def timed(self, api, endpoint, phase = None):
 
-    # Retrieve comments in blocks of GOOGLE_MAX_RESULTS until there are none left
+        """ Records the request made inside the block, and whether it failed. """
 
-    while True:
+        started = time.time()
+        try:
+            yield
+        except Exception:
+            self.record(api, endpoint, time.time() - started, True, phase)
+            raise
+        self.record(api, endpoint, time.time() - started, False, phase)
+
+    def wait(self, seconds):
+        phase = self.current_phase()
+        with self.lock:
+            self.throttled[phase] = self.throttled.get(phase, 0.0) + seconds
+
+    def count(self, name, increment = 1):
+        with self.lock:
+            self.counters[name] += increment
+
+    def summary(self):
+
+        """ Returns the metrics gathered so far as a JSON-serializable dictionary. """
+
+        with self.lock:
+            elapsed = max(time.time() - self.started, 0.001)
+            counters = dict(self.counters)
+            requests = [ { "api": api, "endpoint": endpoint, "phase": phase, "count": count,
+                           "seconds": round(seconds, 3), "errors": errors }
+                         for (api, endpoint, phase), (count, seconds, errors) in sorted(self.requests.items()) ]
+            throttled = dict((phase, round(seconds, 3)) for phase, seconds in self.throttled.items())
+
+        github_requests = sum(request["count"] for request in requests if request["api"] == "github")
+        processed = counters["issues_processed"]
+        summary = { "elapsed": round(elapsed, 3), "counters": counters, "requests": requests,
+                    "throttled": throttled, "github_requests": github_requests,
+                    "google_requests": sum(request["count"] for request in requests if request["api"] == "google"),
+                    "issues_per_second": round(processed / elapsed, 3),
+                    "comments_per_second": round(counters["comments_created"] / elapsed, 3),
+                    "requests_per_issue": round(github_requests / float(processed), 2) if processed else None,
+                    "expected_issues": self.expected, "eta_seconds": None }
+
+        # The ETA follows the current throughput, but if the quota left won't cover the
+        # remaining issues at the current requests per issue, add the wait for the reset
+
+        if self.expected and processed:
+            remaining = max(self.expected - processed, 0)
+            eta = remaining * elapsed / processed
+            if scheduler is not None and scheduler.remaining is not None:
+                summary["quota_remaining"] = scheduler.remaining
+                summary["quota_reset"] = scheduler.reset
+                quota_issues = scheduler.remaining / (github_requests / float(processed) or 1)
+                if quota_issues < remaining:
+                    eta = max(eta, scheduler.reset - time.time() + (remaining - quota_issues) * elapsed / processed)
+            summary["eta_seconds"] = round(eta)
+        return summary
+
+    def prometheus(self, summary):
+
+        """ Returns the summary in the Prometheus text exposition format. """
+
+        lines = []
+        def metric(name, kind, description, samples):
+            lines.append("# HELP migrateissues_%s %s" % (name, description))
+            lines.append("# TYPE migrateissues_%s %s" % (name, kind))
+            for labels, value in samples:
+                label_text = ",".join('%s="%s"' % (key, str(labels[key]).replace('"', '\\"')) for key in sorted(labels))
+                lines.append("migrateissues_%s%s %s" % (name, "{%s}" % label_text if label_text else "", value))
+
+        request_labels = lambda request: dict((key, request[key]) for key in ("api", "endpoint", "phase"))
+        metric("requests_total", "counter", "Requests sent, by API, endpoint and phase.",
+               [ (request_labels(request), request["count"]) for request in summary["requests"] ])
+        metric("request_seconds_total", "counter", "Time spent on requests, by API, endpoint and phase.",
+               [ (request_labels(request), request["seconds"]) for request in summary["requests"] ])
+        metric("request_errors_total", "counter", "Failed requests, by API, endpoint and phase.",
+               [ (request_labels(request), request["errors"]) for request in summary["requests"] ])
+        metric("throttled_seconds_total", "counter", "Time spent waiting for the Github rate limit, by phase.",
+               [ ({ "phase": phase }, seconds) for phase, seconds in sorted(summary["throttled"].items()) ])
+        metric("items_total", "counter", "Issues and comments handled, by kind.",
+               [ ({ "kind": name }, value) for name, value in sorted(summary["counters"].items()) ])
+        metric("issues_per_second", "gauge", "Issues processed per second since the start.", [ ({}, summary["issues_per_second"]) ])
+        metric("comments_per_second", "gauge", "Comments created per second since the start.", [ ({}, summary["comments_per_second"]) ])
+        if summary["eta_seconds"] is not None:
+            metric("eta_seconds", "gauge", "Estimated seconds until the migration finishes.", [ ({}, summary["eta_seconds"]) ])
+        if "quota_remaining" in summary:
+            metric("github_quota_remaining", "gauge", "Github requests left until the rate limit resets.", [ ({}, summary["quota_remaining"]) ])
+        return "\n".join(lines) + "\n"
+
+    def write(self):
+
+        """ Writes the configured reports, replacing each file atomically. """
+
+        summary = self.summary()
+        for path, text in ((options.metrics_file, lambda: json.dumps(summary, indent = 2, sort_keys = True)),
+                           (options.prometheus_file, lambda: self.prometheus(summary))):
+            if path:
+                with open(path + ".tmp", "w") as report:
+                    report.write(text())
+                os.rename(path + ".tmp", path)
+        return summary
+
+    def start(self, interval):
+
+        """ Starts rewriting the reports every 'interval' seconds, until stop(). """
+
+        def report():
+            while not self.stopped.wait(interval):
+                try: self.write()
+                except Exception:
+                    logging.exception('Failed to write metrics')
+
+        if options.metrics_file or options.prometheus_file:
+            writer = threading.Thread(target = report, name = "metrics")
+            writer.daemon = True
+            writer.start()
+
+    def stop(self):
+
+        """ Stops the periodic reports, writes the final ones and logs a summary. """
+
+        self.stopped.set()
+        summary = self.write()
+        logging.info('Processed %d issues in %d seconds (%.2f per second), making %d Github and %d Google Code requests',
+                     summary["counters"]["issues_processed"], summary["elapsed"], summary["issues_per_second"],
+                     summary["github_requests"], summary["google_requests"])
+
+    def log_progress(self):
+        summary = self.summary()
+        eta = summary["eta_seconds"]
+        logging.info('%d issues processed (%.2f per second, %s Github requests per issue)%s',
+                     summary["counters"]["issues_processed"], summary["issues_per_second"],
+                     summary["requests_per_issue"], ", ETA %d seconds" % eta if eta is not None else "")
+
+
+def in_phase(name):
+
+    """ Decorator that runs a function in the given metrics phase. """
+
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with metrics.phase(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def github_endpoint(function, args):
+
+    """ Returns the name under which a Github API call is recorded in the metrics. """
+
+    name = getattr(function, "__name__", repr(function))
+    if (function is list and args) or name == "get_page":
+        paginated_list = args[0] if function is list else function.__self__
+        content_class = getattr(paginated_list, "_PaginatedList__contentClass", None)
+        return "list %s" % (content_class.__name__ if content_class else type(paginated_list).__name__)
+    if name == "requestJsonAndCheck" and len(args) >= 2:
+        return "%s %s" % (args[0], re.sub(r"^https?://[^/]+|/repos/[^/]+/[^/]+|\?.*$", "", args[1]))
+    owner = getattr(function, "__self__", None)
+    if owner is not None:
+        return "%s.%s" % (type(owner).__name__, name)
+    return name
+
+
+class RequestScheduler(object):
+
+    """ Paces Github requests to make the best of the API rate limit without exceeding it.
+
+    Every Github call goes through call(), which takes a token from a bucket refilled at
+    the rate that spreads the remaining quota evenly until its reset time, as reported in
+    the response headers of the previous request.  When the quota runs out we sleep until
+    the reset instead of aborting.  Requests refused by a secondary rate limit, or with a
+    Retry-After header, are retried after the requested delay.
+
+    reserve() holds back enough quota to migrate a whole issue before we start on it, so
+    that an issue is never left half-migrated waiting for the next reset.
 
-        query = gdata.projecthosting.client.Query(start_index = start_index, max_results = max_results)
-        comments_feed = gc.get_comments(google_project, gid, query = query)
+    """
 
-        # Filter out empty and otherwise unnecessary comments, unless they contain the
-        # 'migrated into' update for a duplicate issue; we'll generate a special Github
-        # comment for those.
+    def __init__(self, spare = GITHUB_SPARE_REQUESTS, burst = GITHUB_BURST_REQUESTS):
+        self.spare = spare
+        self.burst = burst
+        self.condition = threading.Condition()
+        self.remaining = None
+        self.limit = None
+        self.reset = 0
+        self.reserved = 0
+        self.tokens = burst
+        self.filled = time.time()
+        self.paused_until = 0
+
+    def observe(self):
+
+        """ Updates the quota from the rate-limit headers of the latest Github response. """
+
+        remaining, limit = gh.rate_limiting
+        reset = getattr(gh, "rate_limiting_resettime", None)
+        with self.condition:
+            if remaining >= 0:
+                self.remaining, self.limit = remaining, limit
+            if reset:
+                self.reset = reset
+            self.condition.notify_all()
+
+    def available(self, now):
+        if self.remaining is None:
+            return self.burst
+        if now >= self.reset and self.limit:
+            # The quota has been reset since our last response; assume it's full again
+            return self.limit - self.reserved - self.spare
+        return self.remaining - self.reserved - self.spare
+
+    def wait_for_reset(self, now):
+        delay = max(self.reset - now, 1) + 1
+        logging.info('Github rate limit reached; waiting %d seconds for it to reset', delay)
+        self.condition.wait(delay)
+
+    def acquire(self):
+
+        """ Blocks until a request may be sent. """
+
+        waited_since = time.time()
+        with self.condition:
+            while True:
+                now = time.time()
+                if now < self.paused_until:
+                    self.condition.wait(self.paused_until - now)
+                    continue
+                if self.remaining is not None and self.available(now) + self.reserved <= 0:
+                    self.wait_for_reset(now)
+                    continue
+
+                # Refill the bucket at the rate that spreads what's left until the reset
+
+                window = max(self.reset - now, 1)
+                rate = max(self.available(now) + self.reserved, 1) / float(window)
+                self.tokens = min(self.burst, self.tokens + (now - self.filled) * rate)
+                self.filled = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    if self.remaining is not None:
+                        self.remaining -= 1
+                    metrics.wait(now - waited_since)
+                    return
+                self.condition.wait((1 - self.tokens) / rate)
+
+    def reserve(self, cost):
+
+        """ Blocks until the quota can cover an operation of the given request cost.
+
+        Returns the cost actually reserved, to be passed to release() later.  Nothing is
+        reserved while the quota is unknown, e.g. when a Github Enterprise server has rate
+        limiting turned off and sends no rate limit headers.
+
+        """
+
+        with self.condition:
+            if self.remaining is None:
+                return 0
+            if self.limit:
+                cost = min(cost, self.limit - self.spare)
+            while self.available(time.time()) < cost:
+                self.wait_for_reset(time.time())
+            self.reserved += cost
+        return cost
+
+    def release(self, cost):
+        with self.condition:
+            self.reserved -= cost
+            self.condition.notify_all()
+
+    def retry_delay(self, exception, attempt):
+
+        """ Returns how long to wait before retrying a rate-limited request, or None. """
+
+        if exception.status not in (403, 429):
+            return None
+        headers = dict((key.lower(), value) for key, value in (getattr(exception, "headers", None) or {}).items())
+        message = repr(exception.data).lower()
+        if "retry-after" in headers:
+            return int(headers["retry-after"])
+        if headers.get("x-ratelimit-remaining") == "0":
+            return max(int(headers.get("x-ratelimit-reset", self.reset)) - time.time(), 0) + 1
+        if "secondary rate limit" in message or "abuse" in message:
+            return GITHUB_SECONDARY_LIMIT_WAIT * 2 ** attempt
+        if "rate limit" in message:
+            return max(self.reset - time.time(), 0) + 1
+        return None
+
+    def call(self, function, *args, **kwargs):
+
+        """ Calls a Github API function, pacing and retrying it as the rate limit requires. """
+
+        attempt = 0
+        endpoint = github_endpoint(function, args)
+        while True:
+            self.acquire()
+            started = time.time()
+            try:
+                result = function(*args, **kwargs)
+            except github.GithubException, exception:
+                metrics.record("github", endpoint, time.time() - started, error = True)
+                delay = self.retry_delay(exception, attempt)
+                if delay is None or attempt >= GITHUB_RATE_LIMIT_RETRIES:
+                    raise
+                logging.warn('Github request rate-limited; retrying in %d seconds', delay)
+                with self.condition:
+                    self.paused_until = max(self.paused_until, time.time() + delay)
+                attempt += 1
+                continue
+            metrics.record("github", endpoint, time.time() - started)
+            self.observe()
+            return result
 
-        comments = [ comment for comment in comments_feed.entry if should_migrate_comment(comment) and format_comment(comment) not in existing_comments ]
 
-        # Add any remaining comments to the Github issue
+def github_call(function, *args, **kwargs):
 
-        if not comments:
-            break
-        if start_index == 1:
-            output(", adding comments")
-        for comment in comments:
-            add_comment_to_github(comment, github_issue)
-            output(".")
+    """ Sends a Github request through the rate-limit scheduler. """
 
-        start_index += max_results
+    return scheduler.call(function, *args, **kwargs)
 
 
-def add_comment_to_github(comment, github_issue):
+def github_list(paginated_list):
 
-    """ Adds a single Google Code comment to the given Github issue. """
+    """ Returns every item of a Github paginated list, fetching its pages through the scheduler. """
 
-    gid = parse_gcode_id(comment.id.text)
-    body = format_comment(comment)
+    return github_call(list, paginated_list)
 
-    logging.info("Adding comment %d", gid)
 
-    if not options.dry_run:
-        github_issue.create_comment(body.encode("utf-8"))
+def github_iter(paginated_list):
 
+    """ Yields the items of a Github paginated list, fetching one page at a time through the
+    scheduler, so that only the current page is held in memory. """
 
-def process_gcode_issues(existing_issues):
-    """ Migrates all Google Code issues in the given dictionary to Github. """
+    page = 0
+    while True:
+        items = github_call(paginated_list.get_page, page)
+        for item in items:
+            yield item
+        if len(items) < GITHUB_PER_PAGE:
+            return
+        page += 1
 
-    start_index = 1
-    previous_gid = 0
-    max_results = GOOGLE_MAX_RESULTS
 
+def github_pages(url, parameters = None, headers = None):
+
+    """ Yields the items of a Github listing as decoded JSON, fetching one page at a time
+    through the scheduler.  This reaches listings that PyGithub doesn't offer, or whose
+    objects lack fields we need. """
+
+    page = 1
     while True:
+        query = dict(parameters or {}, per_page = GITHUB_PER_PAGE, page = page)
+        response_headers, items = github_call(github_repo._requester.requestJsonAndCheck, "GET", url,
+                                              parameters = query, headers = headers)
+        for item in items:
+            yield item
+        if len(items) < GITHUB_PER_PAGE:
+            return
+        page += 1
 
-        query = gdata.projecthosting.client.Query(start_index = start_index, max_results = max_results)
-        issues_feed = gc.get_issues(google_project, query = query)
 
-        if not issues_feed.entry:
-            break
+class ResponseCache(object):
 
-        for issue in issues_feed.entry:
-
-            gid = parse_gcode_id(issue.id.text)
-
-            # If we're trying to do a complete migration to a fresh Github project, and
-            # want to keep the issue numbers synced with Google Code's, then we need to
-            # watch out for the fact that deleted issues on Google Code leave holes in the ID numbering.
-            # We'll work around this by adding dummy issues until the numbers match again.
-
-            if options.synchronize_ids:
-                while previous_gid + 1 < gid:
-                    previous_gid += 1
-                    output("Using dummy entry for missing issue %d\n" % (previous_gid ))
-                    title = "Google Code skipped issue %d" % (previous_gid )
-                    if previous_gid not in existing_issues:
-                        body = "_Skipping this issue number to maintain synchronization with Google Code issue IDs._"
-                        link = GOOGLE_URL % (google_project, previous_gid)
-                        footer = GOOGLE_ISSUE_TEMPLATE % link
-                        body += '\n\n' + footer
-                        github_issue = github_repo.create_issue(title, body = body, labels = [github_label("imported")])
-                        github_issue.edit(state = "closed")
-                        existing_issues[previous_gid]=github_issue
-
-
-            # Add the issue and its comments to Github, if we haven't already
-
-            if gid in existing_issues:
-                github_issue = existing_issues[gid]
-                output("Not adding issue %d (exists)" % gid)
-            # Skipping issue if not in GOOGLE_STATUS_VALUES_FILTERED
-            elif issue.status and issue.status.text in GOOGLE_STATUS_VALUES_FILTERED:
-                github_issue = None
-                output("Skipping issue %d (issue status filtered by GOOGLE_STATUS_VALUES_FILTERED)" % gid)
-            else: github_issue = add_issue_to_github(issue)
-
-            if github_issue:
-                add_comments_to_issue(github_issue, gid)
-                if github_issue.state != issue.state.text:
-                    github_issue.edit(state = issue.state.text)
-            output("\n")
-
-            previous_gid = gid
-
-        start_index += max_results
-        log_rate_info()
+    """ Persistent on-disk cache of Github GET responses, for conditional requests.
 
+    Responses that carry an ETag or Last-Modified header are kept, keyed by URL and the
+    request headers that affect the response, so that the next request for the same URL
+    can send If-None-Match / If-Modified-Since.  Github answers 304 Not Modified when
+    nothing has changed, which doesn't count against the rate limit, and the cached body
+    is used instead.  When the cache grows beyond 'max_size' bytes the least recently
+    used responses are evicted.
 
-def get_existing_github_issues():
-    """ Returns a dictionary of Github issues previously migrated from Google Code.
+    """
 
-    The result maps Google Code issue numbers to Github issue objects.
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS responses (
+            key           TEXT PRIMARY KEY,
+            etag          TEXT,
+            last_modified TEXT,
+            headers       TEXT NOT NULL,
+            body          BLOB NOT NULL,
+            size          INTEGER NOT NULL,
+            used          REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS responses_used ON responses (used);
     """
 
-    output("Retrieving existing Github issues...\n")
-    id_re = re.compile(GOOGLE_ID_RE % google_project)
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread = False)
+        self.db.execute("PRAGMA journal_mode = WAL")
+        self.db.execute("PRAGMA synchronous = NORMAL")
+        self.db.executescript(self.SCHEMA)
+        self.size = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
 
-    try:
-        # Get all issues (opened and closed) from Github, put them toghether and
-        # convert them to a list.
-        existing_issues = list(github_repo.get_issues(state='open')) + list(github_repo.get_issues(state='closed'))
-        
-        existing_count = len(existing_issues)
-        
-        # Each entry from issue_map points from a google issue to a github issue
-        issue_map = {}
-        
-        # Search for issues that have been migrated by looking for id_re in body
-        for issue in existing_issues:
-            id_match = id_re.search(issue.body)
-            
-            # If issue has been migrated
-            if id_match:
-                google_id = int(id_match.group(1))
-                issue_map[google_id] = issue
-                labels = [l.name for l in issue.get_labels()]
-                if not 'imported' in labels:
-                    # TODO we could fix up the label here instead of just warning
-                    logging.warn('Issue missing imported label %s- %s - %s',google_id,repr(labels),issue.title)
-        imported_count = len(issue_map)
-        logging.info('Found %d Github issues, %d imported',existing_count,imported_count)
-        
-    except:
-        logging.error( 'Failed to enumerate existing issues')
-        raise
-        
-    return issue_map
+    def key(self, url, headers):
+        headers = dict((name.lower(), value) for name, value in headers.items())
+        credentials = hashlib.sha1(headers.get("authorization", "")).hexdigest()
+        return "%s %s %s" % (url, headers.get("accept", ""), credentials)
 
-def map_google_id_to_github():
-    output("Retrieving existing Github issues for ID mapping...\n")
-    id_re = re.compile(GOOGLE_ID_RE % google_project)
+    def get(self, key):
 
-    try:
-        # Get all issues (opened and closed) from Github, put them toghether and
-        # convert them to a list.
-        github_issues = list(github_repo.get_issues(state='open')) + list(github_repo.get_issues(state='closed'))
-        
-        # Each pair in google_id_to_github points from a Google-ID (int)
-        # to a Github-ID (int)
-        google_id_to_github = {}
-        
-        # Search for issues that have been migrated by looking for id_re in body
-        for issue in github_issues:
-            id_match = id_re.search(issue.body)
-            
-            # If issue has been migrated store Google- and Github-IDs
-            if id_match:
-                google_id = int(id_match.group(1))
-                github_id = int(issue.number)
-                google_id_to_github[google_id] = github_id
+        """ Returns the cached (etag, last-modified, headers, body) for a key, or None. """
 
-        logging.info('Found %d Github issues, %d imported',len(github_issues),len(google_id_to_github))
-        
-        def replace_issue_number(match):
-            match_string = match.group(0)
-            
-            # Char '&#8203;' is a unicode zero-width whitespace to prevent automatic #<number> to issue-link.
-            
-            # if match_string similar to "issue #1" or "issue 1"
-            if match.group(1) and int(match.group(1)) in google_id_to_github:
-                google_id = int(match.group(1))
-                # Construct note with Github-ID to include after Google-ID ...
-                note_to_include = "&#8203;%d (Github: #%d)" % (google_id, google_id_to_github[google_id])
-                # ... and replace Google-ID in match_string with according Github-ID
-		return re.sub(str(google_id), note_to_include, match_string)
-                
-            # if match_string similar to "#1"
-            elif match.group(2) and int(match.group(2)) in google_id_to_github:
-                google_id = int(match.group(2))
-                note_to_include = "&#8203;%d (Github: #%d)" % (google_id, google_id_to_github[google_id])
-                # ... and replace Google-ID in match_string with according Github-ID
-                return re.sub(str(google_id), note_to_include, match_string)
-                
-            # if match_string similar to "http://code.google.com/p/MYPROJECT/issues/detail?id=1"
-            elif match.group(3) and int(match.group(3)) in google_id_to_github:
-                google_id = int(match.group(3))
-                return "%s (Github: #%d)" %(match_string, google_id_to_github[google_id])
-            else:
-                return match_string
-
-        # Iterate every issue and if it's imported ...
-        for issue in github_issues:
-            if issue.number in google_id_to_github.values():
-                output('Processing Github issue #%d\n' % issue.number)
-                # ... use this regex to find references to issues
-                re_issue_string = r"issue ?#?(\d+(?! \(G))|(?![^\n] )#(\d+(?! \(G))|(?<!_Original issue: )%s(?! \(G)" % GOOGLE_URL_RE % google_project
-                issue_re = re.compile(re_issue_string, re.IGNORECASE)
-                
-                # ... in the issue body and append the Github-ID
-                issue.edit(body=issue_re.sub(replace_issue_number, issue.body))
-
-                # ... and in the comment bodies and append the Github-ID
-                for comment in issue.get_comments():
-                    GOOGLE_URL_RE
-                    comment.edit(body=issue_re.sub(replace_issue_number, comment.body))
-                    output("Editing issue numbers on comments of Github #%d\n" % issue.number)
-            else:
-                output('Skipping Github issue #%d\n' % issue.number)
+        with self.lock, self.db:
+            row = self.db.execute("SELECT etag, last_modified, headers, body FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self.db.execute("UPDATE responses SET used = ? WHERE key = ?", (time.time(), key))
+        etag, last_modified, headers, body = row
+        return etag, last_modified, json.loads(headers), str(body)
 
-    except:
-        logging.error( 'Failed remapping the issue IDs')
-        raise
-    
-    
-    
-def log_rate_info():
-    logging.info( 'Rate limit (remaining/total) %s',repr(gh.rate_limiting))
-    # Note: this requires extended version of PyGithub from tfmorris/PyGithub repo
-    #logging.info( 'Rate limit (remaining/total) %s',repr(gh.rate_limit(refresh=True)))
+    def put(self, key, etag, last_modified, headers, body):
+        if len(body) > self.max_size / 10:
+            return
+        with self.lock, self.db:
+            row = self.db.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self.size += len(body) - (row[0] if row else 0)
+            self.db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+                            (key, etag, last_modified, json.dumps(headers), sqlite3.Binary(body), len(body), time.time()))
 
-if __name__ == "__main__":
+            # Evict the least recently used responses, down to 90% of the limit
 
-    usage = "usage: %prog [options] <google project name> <github username> <github project>"
-    description = "Migrate all issues from a Google Code project to a Github project."
-    parser = optparse.OptionParser(usage = usage, description = description)
+            if self.size > self.max_size:
+                for evicted, size in self.db.execute("SELECT key, size FROM responses ORDER BY used").fetchall():
+                    self.db.execute("DELETE FROM responses WHERE key = ?", (evicted,))
+                    self.size -= size
+                    if self.size <= self.max_size * 0.9:
+                        break
 
-    parser.add_option("-a", "--assign-owner", action = "store_true", dest = "assign_owner", help = "Assign owned issues to the Github user", default = False)
-    parser.add_option("-b", "--base-id", type = "int", action = "store", dest = "base_id", help = "Number of issues in Github before migration", default = 0)
-    parser.add_option("-d", "--dry-run", action = "store_true", dest = "dry_run", help = "Don't modify anything on Github", default = False)
-    parser.add_option("-p", "--omit-priority", action = "store_true", dest = "omit_priority", help = "Don't migrate priority labels", default = False)
-    parser.add_option("-s", "--synchronize-ids", action = "store_true", dest = "synchronize_ids", help = "Ensure that migrated issues keep the same ID", default = False)
-    parser.add_option("-i", "--assign-ids", action = "store_true", dest = "assign_ids", help = "Assign IDs to already imported issues. Run without '-i' first.", default = False)
-    parser.add_option("--rewrite-issue-links", action = "store_true", dest = "rewrite_issue_links", help="Rewrite the text used to link issues (from 'issue N' on Google Code to  '#N' on Github) ", default=False)
 
-    options, args = parser.parse_args()
+class CachedResponse(object):
 
-    if len(args) != 3:
-        parser.print_help()
-        sys.exit()
+    """ A fully read HTTP response, in the shape PyGithub expects from httplib. """
+
+    def __init__(self, status, reason, headers, body):
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.body = body
 
-    label_cache = {}    # Cache Github tags, to avoid unnecessary API requests
+    def getheaders(self):
+        return self.headers
 
-    google_project, github_username, github_project = args
+    def getheader(self, name, default = None):
+        return dict(self.headers).get(name.lower(), default)
 
-    # Ask for password repeatedly and continue when credentials are correct.
-    password_is_wrong = True
-    while password_is_wrong:
-        github_password = getpass.getpass("Github password: ")
+    def read(self):
+        return self.body
+
+
+class PooledConnection(object):
+
+    """ Drop-in for httplib's connections in PyGithub, adding keep-alive and caching.
+
+    PyGithub opens a new connection for every request and closes it afterwards.  This
+    class keeps the underlying connections open and hands them out again for later
+    requests to the same host, saving a TCP and TLS handshake per request.  GET requests
+    are made conditional on the response cached by --http-cache, if any, and a 304 Not
+    Modified answer is turned back into the cached 200 response.
+
+    """
+
+    connection_class = httplib.HTTPSConnection
+    pools = {}
+    pools_lock = threading.Lock()
+
+    def __init__(self, host, port = None, strict = False, timeout = None, **kwargs):
+        self.address = (self.connection_class, host, port)
+        self.timeout = timeout
+        self.connection = None
+
+    def open(self):
+        connection_class, host, port = self.address
+        kwargs = { "timeout": self.timeout } if self.timeout else {}
+        return connection_class(host, port, **kwargs)
+
+    def idle(self):
+        with self.pools_lock:
+            idle = self.pools.setdefault(self.address, [])
+            return idle.pop() if idle else None
+
+    def request(self, verb, url, body = None, headers = {}):
+        headers = dict(headers)
+        self.cache_key = self.cached = None
+
+        if verb == "GET" and http_cache is not None:
+            self.cache_key = http_cache.key(url, headers)
+            self.cached = http_cache.get(self.cache_key)
+            if self.cached:
+                etag, last_modified = self.cached[:2]
+                if etag:
+                    headers["If-None-Match"] = etag
+                if last_modified:
+                    headers["If-Modified-Since"] = last_modified
+
+        # A pooled connection may have been closed by the server while it sat idle; if so,
+        # the request is sent again on a fresh one
+
+        self.sent = (verb, url, body, headers)
+        self.connection = self.idle()
+        self.reused = self.connection is not None
+        if self.reused:
+            try:
+                self.connection.request(*self.sent)
+                return
+            except (httplib.HTTPException, socket.error):
+                self.connection.close()
+                self.reused = False
+        self.connection = self.open()
+        self.connection.request(*self.sent)
+
+    def getresponse(self):
         try:
-            github.Github(github_username, github_password).get_user().login
-            password_is_wrong = False
-        except github.BadCredentialsException, exception:
-            print "Bad credentials, try again."
-        except github.GithubException, exception:
-            logging.exception(exception)
+            response = self.connection.getresponse()
+        except (httplib.BadStatusLine, socket.error):
+            if not self.reused:
+                raise
+            self.connection.close()
+            self.connection = self.open()
+            self.connection.request(*self.sent)
+            response = self.connection.getresponse()
+        body = response.read()
+        headers = response.getheaders()
+        status, reason = response.status, response.reason
+        if response.will_close:
+            self.connection.close()
+            self.connection = None
+
+        if status == 304 and self.cached:
+            etag, last_modified, cached_headers, body = self.cached
+            fresh = dict(headers)
+            headers = [ (name, fresh.pop(name, value)) for name, value in cached_headers ] + fresh.items()
+            status, reason = 200, "OK"
+            metrics.count("not_modified")
+        elif status == 200 and self.cache_key:
+            values = dict(headers)
+            if values.get("etag") or values.get("last-modified"):
+                http_cache.put(self.cache_key, values.get("etag"), values.get("last-modified"), headers, body)
+
+        return CachedResponse(status, reason, headers, body)
+
+    def close(self):
+
+        """ Returns the connection to the pool, rather than closing it. """
+
+        if self.connection is None:
+            return
+        with self.pools_lock:
+            idle = self.pools.setdefault(self.address, [])
+            if len(idle) < HTTP_POOL_SIZE:
+                idle.append(self.connection)
+                self.connection = None
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+class PooledHTTPConnection(PooledConnection):
+    connection_class = httplib.HTTPConnection
+
+
+class StoredIssue(object):
+
+    """ Compact stand-in for a migrated Github issue, from the state store or an issue listing.
+
+    Only the issue's number and state are always known.  An issue listing also gives its
+    Google Code ID, its comment count and the Google Code issues its body refers to; the
+    rest of the listed issue is dropped, so that tens of thousands of issues take little
+    memory.  Comments are listed without fetching the issue itself, and the full issue is
+    fetched from Github only when something else is needed, e.g. to add a comment or change
+    its state.
 
-    # Google Code
-    gc = gdata.projecthosting.client.ProjectHostingClient()
-    
-    # Github
-    gh = github.Github(github_username, github_password)
-    
-    log_rate_info()
-    github_user = gh.get_user()
+    """
 
-    # If the project name is specified as "owner/project", assume that it's
-    # owned by either a different user than the one we have credentials for,
-    # or an organization.
-    if "/" in github_project:
-        owner_name, github_project = github_project.split("/")
-        try: github_owner = gh.get_user(owner_name)
-        except github.GithubException:
-            try: github_owner = gh.get_organization(owner_name)
-            except github.GithubException:
-                github_owner = github_user
-    else: github_owner = github_user
-    
-    # Get Github repository
-    github_repo = github_owner.get_repo(github_project)
+    __slots__ = ("number", "state", "gid", "comment_count", "references", "_issue")
 
-    # Do migration!
-  #  try:
-    existing_issues = get_existing_github_issues()
-    log_rate_info()
-    
-    if not options.assign_ids:
-        # Migrate Google Code issues in the given dictionary to Github.
-        process_gcode_issues(existing_issues)
+    def __init__(self, number, state, gid = None, comment_count = None, references = None):
+        self.number = number
+        self.state = state
+        self.gid = gid
+        self.comment_count = comment_count
+        self.references = references
+        self._issue = None
+
+    def load(self):
+        if self._issue is None:
+            self._issue = github_call(github_repo.get_issue, self.number)
+        return self._issue
+
+    def __getattr__(self, name):
+        return getattr(self.load(), name)
+
+    @property
+    def comments(self):
+        if self.comment_count is None:
+            return self.load().comments
+        return self.comment_count
+
+    def get_comments(self, since = None):
+        parameters = { "since": since.strftime("%Y-%m-%dT%H:%M:%SZ") } if since else None
+        return github.PaginatedList.PaginatedList(github.IssueComment.IssueComment, github_repo._requester,
+                                                  "%s/issues/%d/comments" % (github_repo.url, self.number), parameters)
+
+    def edit(self, **kwargs):
+        self.load().edit(**kwargs)
+        self.state = kwargs.get("state", self.state)
+
+
+class GoogleIssue(object):
+
+    """ A Google Code issue, reduced to the fields we migrate.
+
+    Both the live issue tracker and archive exports are read into these, straight from
+    their Atom or JSON, so the rest of the script doesn't care where an issue came from.
+    'comments' holds the issue's comments when the source provides them along with the
+    issue, and is None otherwise.
+
+    """
+
+    __slots__ = ("id", "title", "status", "state", "link", "author", "published", "updated",
+                 "content", "labels", "owner", "comments", "attachments")
+
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            setattr(self, name, fields.get(name))
+
+
+class GoogleComment(object):
+
+    """ A Google Code comment, reduced to the fields we migrate. """
+
+    __slots__ = ("id", "author", "published", "content", "merged_into", "attachments")
+
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            setattr(self, name, fields.get(name))
+
+
+class GoogleAttachment(object):
+
+    """ A file attached to a Google Code issue or comment: its name, size and where to get it. """
+
+    __slots__ = ("name", "size", "url")
+
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            setattr(self, name, fields.get(name))
+
+
+def enclosure_attachment(href, title, length):
+
+    """ Returns a GoogleAttachment for an Atom enclosure link. """
+
+    return GoogleAttachment(
+        name = title or urllib.unquote(posixpath.basename(urlparse.urlparse(href).path)),
+        size = int(length) if length else None,
+        url = href)
+
+
+def archive_date(timestamp):
+
+    """ Returns the Google Code feed date for an archive timestamp (seconds since the epoch). """
+
+    if isinstance(timestamp, basestring):
+        return timestamp
+    return datetime.utcfromtimestamp(int(timestamp or 0)).strftime(GOOGLE_DATE_FORMAT)
+
+
+def archive_author(author):
+    if isinstance(author, dict):
+        return author.get("name")
+    return author
+
+
+def issue_from_json(data, project, attachment_url = GOOGLE_ATTACHMENT_URL):
+
+    """ Returns a GoogleIssue, with its comments, for a Google Code Archive JSON issue.
+
+    The archive stores the issue's description as its first comment (ID 0), and gives a
+    status but no open/closed state; we derive that from GOOGLE_CLOSED_STATUSES.  It lists
+    attachments by name only; 'attachment_url' is the template of their download URLs.
+
+    """
+
+    gid = int(data["id"])
+    comments = list(data.get("comments") or [])
+    description = comments.pop(0) if comments and int(comments[0].get("id", 0)) == 0 else {}
+    status = data.get("status") or ""
+
+    return GoogleIssue(
+        id = gid,
+        title = data.get("summary") or data.get("title") or "",
+        status = status,
+        state = data.get("state") or ("closed" if status in GOOGLE_CLOSED_STATUSES else "open"),
+        link = GOOGLE_URL % (project, gid),
+        author = archive_author(description.get("author") or data.get("author")),
+        published = archive_date(description.get("timestamp") or data.get("published")),
+        updated = archive_date(data.get("updated") or description.get("timestamp")),
+        content = description.get("content") or None,
+        labels = list(data.get("labels") or []),
+        owner = archive_author(data.get("owner")),
+        comments = [ comment_from_json(comment, project, gid, attachment_url) for comment in comments ],
+        attachments = json_attachments(description, project, gid, attachment_url))
+
+
+def comment_from_json(data, project, gid, attachment_url = GOOGLE_ATTACHMENT_URL):
+
+    """ Returns a GoogleComment for a comment of a Google Code Archive JSON issue. """
+
+    merged_into = (data.get("updates") or {}).get("mergedInto")
+    return GoogleComment(
+        id = int(data["id"]),
+        author = archive_author(data.get("author")),
+        published = archive_date(data.get("timestamp")),
+        content = data.get("content") or None,
+        merged_into = parse_gcode_id(unicode(merged_into)) if merged_into else None,
+        attachments = json_attachments(data, project, gid, attachment_url))
+
+
+def json_attachments(data, project, gid, attachment_url):
+
+    """ Returns the attachments of a Google Code Archive JSON comment that weren't deleted. """
+
+    attachments = []
+    for attachment in data.get("attachments") or []:
+        if attachment.get("isDeleted"):
+            continue
+        name = attachment["fileName"]
+        url = attachment_url % { "project": project, "issue": gid, "comment": int(data.get("id", 0)),
+                                 "name": urllib.quote(name.encode("utf-8")) }
+        attachments.append(GoogleAttachment(name = name, size = attachment.get("fileSize"), url = url))
+    return attachments
+
+
+def atom_text(element, tag):
+    child = element.find(tag)
+    return child.text if child is not None else None
+
+
+def atom_link(element):
+    for link in element.findall(ATOM_NS + "link"):
+        if link.get("rel") == "alternate":
+            return link.get("href")
+    return None
+
+
+def atom_attachments(element):
+    return [ enclosure_attachment(link.get("href"), link.get("title"), link.get("length"))
+             for link in element.findall(ATOM_NS + "link") if link.get("rel") == "enclosure" and link.get("href") ]
+
+
+def issue_from_atom(element):
+
+    """ Returns a GoogleIssue for an <entry> element of a Google Code issues feed. """
+
+    return GoogleIssue(
+        id = parse_gcode_id(atom_text(element, ATOM_NS + "id")),
+        title = atom_text(element, ATOM_NS + "title"),
+        status = atom_text(element, ISSUES_NS + "status") or "",
+        state = atom_text(element, ISSUES_NS + "state"),
+        link = atom_link(element),
+        author = atom_text(element, "%sauthor/%sname" % (ATOM_NS, ATOM_NS)),
+        published = atom_text(element, ATOM_NS + "published"),
+        updated = atom_text(element, ATOM_NS + "updated"),
+        content = atom_text(element, ATOM_NS + "content"),
+        labels = [ label.text for label in element.findall(ISSUES_NS + "label") ],
+        owner = atom_text(element, "%sowner/%susername" % (ISSUES_NS, ISSUES_NS)),
+        attachments = atom_attachments(element))
+
+
+def comment_from_atom(element):
+
+    """ Returns a GoogleComment for an <entry> element of a Google Code comments feed. """
+
+    merged_into = atom_text(element, "%supdates/%smergedIntoUpdate" % (ISSUES_NS, ISSUES_NS))
+    return GoogleComment(
+        id = parse_gcode_id(atom_text(element, ATOM_NS + "id")),
+        author = atom_text(element, "%sauthor/%sname" % (ATOM_NS, ATOM_NS)),
+        published = atom_text(element, ATOM_NS + "published"),
+        content = atom_text(element, ATOM_NS + "content"),
+        merged_into = int(merged_into) if merged_into else None,
+        attachments = atom_attachments(element))
+
+
+def iter_atom_entries(stream, header = None):
+
+    """ Yields the <entry> elements of an Atom feed, discarding each once it's been used.
+
+    If 'header' is a dictionary, the text of each of the feed's own elements, such as its
+    openSearch:totalResults, is stored in it by tag as it's parsed.
+
+    """
+
+    root = None
+    depth = 0
+    for event, element in ElementTree.iterparse(stream, events = ("start", "end")):
+        if event == "start":
+            if root is None:
+                root = element
+            depth += 1
+            continue
+        depth -= 1
+        if element.tag == ATOM_NS + "entry":
+            yield element
+            root.clear()
+        elif depth == 1 and header is not None:
+            header[element.tag] = element.text
+
+
+class FeedCache(object):
+
+    """ Persistent on-disk cache of raw Google Code feed pages.
+
+    The Google Code issue tracker is read-only, so a feed page never changes once fetched.
+    Pages are kept keyed by their URL, which holds the project, the query and the start
+    index, and are read back from here on later runs instead of being fetched again.
+    Bodies are stored by their SHA-256, so identical pages are kept only once, and the hash
+    is checked whenever a body is read back: a corrupt page is dropped, to be fetched again.
+    When the cache grows beyond 'max_size' bytes the least recently used pages are evicted.
+
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS pages (
+            key    TEXT PRIMARY KEY,
+            sha256 TEXT NOT NULL,
+            used   REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS pages_used ON pages (used);
+        CREATE INDEX IF NOT EXISTS pages_sha256 ON pages (sha256);
+        CREATE TABLE IF NOT EXISTS bodies (
+            sha256 TEXT PRIMARY KEY,
+            body   BLOB NOT NULL,
+            size   INTEGER NOT NULL
+        );
+    """
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread = False)
+        self.db.execute("PRAGMA journal_mode = WAL")
+        self.db.execute("PRAGMA synchronous = NORMAL")
+        self.db.executescript(self.SCHEMA)
+        self.size = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM bodies").fetchone()[0]
+
+    def get(self, key):
+
+        """ Returns the cached body of a page, or None if it isn't cached or is corrupt. """
+
+        with self.lock, self.db:
+            row = self.db.execute("SELECT sha256, body FROM pages JOIN bodies USING (sha256) WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            sha256, body = row[0], str(row[1])
+            if hashlib.sha256(body).hexdigest() != sha256:
+                logging.warning("Dropping corrupt cached Google Code page %s", key)
+                self.db.execute("DELETE FROM pages WHERE sha256 = ?", (sha256,))
+                self.release(sha256)
+                return None
+            self.db.execute("UPDATE pages SET used = ? WHERE key = ?", (time.time(), key))
+        return body
+
+    def put(self, key, body):
+        if len(body) > self.max_size / 10:
+            return
+        sha256 = hashlib.sha256(body).hexdigest()
+        with self.lock, self.db:
+            if self.db.execute("SELECT 1 FROM bodies WHERE sha256 = ?", (sha256,)).fetchone() is None:
+                self.db.execute("INSERT INTO bodies VALUES (?, ?, ?)", (sha256, sqlite3.Binary(body), len(body)))
+                self.size += len(body)
+            row = self.db.execute("SELECT sha256 FROM pages WHERE key = ?", (key,)).fetchone()
+            self.db.execute("INSERT OR REPLACE INTO pages VALUES (?, ?, ?)", (key, sha256, time.time()))
+            if row and row[0] != sha256:
+                self.release(row[0])
+
+            # Evict the least recently used pages, down to 90% of the limit
+
+            if self.size > self.max_size:
+                for evicted, evicted_sha256 in self.db.execute("SELECT key, sha256 FROM pages ORDER BY used").fetchall():
+                    self.db.execute("DELETE FROM pages WHERE key = ?", (evicted,))
+                    self.release(evicted_sha256)
+                    if self.size <= self.max_size * 0.9:
+                        break
+
+    def release(self, sha256):
+
+        """ Deletes a body once no page refers to it.  The caller holds the lock. """
+
+        if self.db.execute("SELECT 1 FROM pages WHERE sha256 = ? LIMIT 1", (sha256,)).fetchone() is None:
+            row = self.db.execute("SELECT size FROM bodies WHERE sha256 = ?", (sha256,)).fetchone()
+            if row:
+                self.db.execute("DELETE FROM bodies WHERE sha256 = ?", (sha256,))
+                self.size -= row[0]
+
+
+class GoogleCodeFeed(object):
+
+    """ Reads issues and comments from the live Google Code issue tracker API.
+
+    The feeds are fetched through the gdata client, but parsed incrementally by the same
+    code as archived Atom feeds, straight into GoogleIssue and GoogleComment records,
+    rather than into gdata's object model.
+
+    If 'since' is given, only issues updated after that time are read, and of the issues
+    in 'migrated' (the Google Code IDs already on Github) only the comments since then too;
+    the comments of an issue that's new to Github are read in full.  If 'after' is given,
+    issues up to that ID are skipped without reading their comments, and if 'until' is
+    given, reading stops after that ID.
+
+    If 'cache' is a FeedCache, pages are read from it when they're there, and stored in it
+    when they're fetched; if 'offline' is also set, pages that aren't there are an error.
+
+    """
+
+    def __init__(self, client, project, since = None, after = None, until = None, cache = None, offline = False):
+        self.client = client
+        self.project = project
+        self.since = since
+        self.after = after
+        self.until = until
+        self.cache = cache
+        self.offline = offline
+        self.migrated = set()
+
+    def fetch(self, path, start_index, endpoint, since = None):
+
+        """ Returns a page of the feed at 'path', as a file-like object holding its raw Atom. """
+
+        parameters = [ ("start-index", start_index), ("max-results", GOOGLE_MAX_RESULTS) ]
+        if since:
+            parameters.append(("updated-min", since))
+        uri = "%s?%s" % (path, urllib.urlencode(parameters))
+
+        if self.cache is not None:
+            body = self.cache.get(self.client.host + uri)
+            if body is not None:
+                metrics.count("google_cache_hits")
+                return StringIO(body)
+            if self.offline:
+                raise RuntimeError("%s%s isn't in the Google Code cache, and --offline is set" % (self.client.host, uri))
+
+        with metrics.timed("google", endpoint, phase = "fetch"):
+            body = self.client.request("GET", uri).read()
+        if self.cache is not None:
+            self.cache.put(self.client.host + uri, body)
+        return StringIO(body)
+
+    def issues(self):
+
+        """ Yields every issue of the project, in ID order. """
+
+        start_index = 1
+
+        while True:
+            header = {}
+            page = self.fetch(GOOGLE_ISSUES_FEED % self.project, start_index, "issues feed", self.since)
+            entries = 0
+            for entry in iter_atom_entries(page, header):
+                if not entries and header.get(OPENSEARCH_NS + "totalResults"):
+                    metrics.expected = int(header[OPENSEARCH_NS + "totalResults"])
+                entries += 1
+                issue = issue_from_atom(entry)
+                if self.until and issue.id > self.until:
+                    return
+                if not self.after or issue.id > self.after:
+                    yield issue
+
+            if not entries:
+                break
+            start_index += GOOGLE_MAX_RESULTS
+
+    def comments(self, gid):
+
+        """ Returns every comment of the given issue. """
+
+        start_index = 1
+        comments = []
+        since = self.since if gid in self.migrated else None
+
+        # Retrieve comments in blocks of GOOGLE_MAX_RESULTS until there are none left
+
+        while True:
+            page = self.fetch(GOOGLE_COMMENTS_FEED % (self.project, gid), start_index, "comments feed", since)
+            received = len(comments)
+            comments.extend(comment_from_atom(entry) for entry in iter_atom_entries(page))
+            if len(comments) == received:
+                break
+            start_index += GOOGLE_MAX_RESULTS
+
+        return comments
+
+
+class GoogleCodeArchive(object):
+
+    """ Reads issues and comments from a local export of a Google Code project.
+
+    The export may be a directory, a .zip file or a single (optionally gzipped) file,
+    holding either Google Code Archive JSON (issue-N.json files, or issues-page-N.json
+    files with an 'issues' array) or saved Atom feeds, in which each issue entry is
+    followed by the entries of its comments feed.  Files are parsed incrementally, one
+    issue at a time, so memory use doesn't grow with the size of the project.
+
+    If 'since' is given, only issues updated after that time are read, and of the issues
+    in 'migrated' only the comments since then too, as with GoogleCodeFeed.  If 'after' is
+    given, issues up to that ID are skipped, and so are those after 'until'.
+    JSON exports name attachments without saying where they are; 'attachment_url' is the
+    template of their download URLs.
+
+    """
+
+    def __init__(self, path, project, since = None, after = None, until = None, attachment_url = GOOGLE_ATTACHMENT_URL):
+        self.path = path
+        self.project = project
+        self.since = since
+        self.after = after
+        self.until = until
+        self.attachment_url = attachment_url
+        self.migrated = set()
+
+    def names(self):
+
+        """ Returns the names of the export's data files, in natural sort order. """
+
+        if os.path.isdir(self.path):
+            names = [ os.path.relpath(os.path.join(directory, name), self.path)
+                      for directory, subdirectories, files in os.walk(self.path) for name in files ]
+        elif zipfile.is_zipfile(self.path):
+            archive = zipfile.ZipFile(self.path)
+            names = [ name for name in archive.namelist() if not name.endswith("/") ]
+            archive.close()
+        else:
+            return [ os.path.basename(self.path) ]
+
+        names = [ name for name in names if re.search(r"\.(json|xml|atom)(\.gz)?$", name) ]
+
+        # Full per-issue JSON files make any page summaries redundant
+
+        if any(re.search(r"(^|/)issue-\d+\.json(\.gz)?$", name) for name in names):
+            names = [ name for name in names if re.search(r"(^|/)issue-\d+\.json(\.gz)?$", name) ]
+
+        natural = lambda name: [ int(part) if part.isdigit() else part for part in re.split(r"(\d+)", name) ]
+        return sorted(names, key = natural)
+
+    def open(self, name):
+        if os.path.isdir(self.path):
+            stream = open(os.path.join(self.path, name), "rb")
+        elif zipfile.is_zipfile(self.path):
+            stream = tempfile.SpooledTemporaryFile(ARCHIVE_SPOOL_SIZE)
+            with zipfile.ZipFile(self.path) as archive:
+                member = archive.open(name)
+                shutil.copyfileobj(member, stream, ATTACHMENT_CHUNK_SIZE)
+                member.close()
+            stream.seek(0)
+        else:
+            stream = open(self.path, "rb")
+        if name.endswith(".gz"):
+            compressed = stream
+            stream = gzip.GzipFile(fileobj = compressed, mode = "rb")
+            stream.myfileobj = compressed   # So that closing the GzipFile closes the file too
+        return stream
+
+    def issues(self):
+
+        """ Yields every issue in the export, with its comments attached. """
+
+        for name in self.names():
+            stream = self.open(name)
+            try:
+                if re.search(r"\.json(\.gz)?$", name):
+                    records = self.json_issues(stream, name)
+                else:
+                    records = self.atom_issues(stream)
+                for issue in records:
+                    if self.after and issue.id <= self.after:
+                        continue
+                    if self.until and issue.id > self.until:
+                        continue
+                    if self.since and (issue.updated or issue.published or "") < self.since:
+                        continue
+                    if self.since and issue.id in self.migrated:
+                        issue.comments = [ comment for comment in issue.comments if (comment.published or "") >= self.since ]
+                    yield issue
+            finally:
+                stream.close()
+
+    def json_issues(self, stream, name):
+        if re.search(r"(^|/)issue-\d+\.json(\.gz)?$", name):
+            yield issue_from_json(json.load(stream), self.project, self.attachment_url)
+        elif ijson:
+            for data in ijson.items(stream, "issues.item"):
+                yield issue_from_json(data, self.project, self.attachment_url)
+        else:
+            for data in json.load(stream).get("issues", []):
+                yield issue_from_json(data, self.project, self.attachment_url)
+
+    def atom_issues(self, stream):
+        issue = None
+        for element in iter_atom_entries(stream):
+            if "/comments/" in atom_text(element, ATOM_NS + "id"):
+                if issue is not None:
+                    issue.comments.append(comment_from_atom(element))
+                continue
+            if issue is not None:
+                yield issue
+            issue = issue_from_atom(element)
+            issue.comments = []
+        if issue is not None:
+            yield issue
+
+    def comments(self, gid):
+
+        # Comments always arrive attached to their issue
+
+        return []
+
+
+def prefetch_issues(source, lookahead):
+
+    """ Yields the source's issues, reading them and their comments ahead of the caller.
+
+    A reader thread pages through the issues and hands each one's comment feed to a small
+    pool of fetcher threads, queueing the results in order.  The queue holds at most
+    'lookahead' issues, so the reader waits whenever it gets that far ahead of the Github
+    writes, and memory use stays bounded.
+
+    """
+
+    queue = Queue.Queue(lookahead)
+    stopped = threading.Event()
+    fetchers = ThreadPool(GOOGLE_PREFETCH_THREADS)
+    finished = object()
+
+    def fetch_comments(issue):
+        if issue.comments is None and issue.status not in GOOGLE_STATUS_VALUES_FILTERED:
+            issue.comments = source.comments(issue.id)
+        return issue
+
+    def put(item):
+        while not stopped.is_set():
+            try: return queue.put(item, timeout = 1)
+            except Queue.Full: continue
+
+    def read():
+        try:
+            for issue in source.issues():
+                if stopped.is_set():
+                    return
+                put(fetchers.apply_async(fetch_comments, (issue,)))
+            put(finished)
+        except Exception:
+            put(sys.exc_info())
+
+    reader = threading.Thread(target = read, name = "prefetch")
+    reader.daemon = True
+    reader.start()
+
+    try:
+        while True:
+            item = queue.get()
+            if item is finished:
+                break
+            if isinstance(item, tuple):
+                raise item[0], item[1], item[2]
+            yield item.get()
+    finally:
+        stopped.set()
+        fetchers.terminate()
+
+
+class AttachmentStore(object):
+
+    """ Copies Google Code attachments to a local directory, for migrated issues to link to.
+
+    Files are streamed in ATTACHMENT_CHUNK_SIZE chunks to a temporary file, hashed as they
+    go, and then moved to a path named after their SHA-256 (xx/<sha256>/<file name>), so a
+    file attached to several issues is stored once however it's named.  The state store
+    remembers where each attachment URL went, so re-runs copy nothing twice.  Copies run in
+    a pool of ATTACHMENT_THREADS threads: start() queues a new issue's attachments when it's
+    read, and link() waits for one to be copied while its issue or comment is formatted.
+
+    """
+
+    def __init__(self, root, link_base = None):
+        if not os.path.isdir(root):
+            os.makedirs(root)
+        self.root = root
+        self.link_base = (link_base or "file://" + urllib.pathname2url(os.path.abspath(root))).rstrip("/") + "/"
+        self.partial = root             # Where downloads in progress are written
+        self.lock = threading.Lock()
+        self.pending = {}               # URL -> AsyncResult of the copy
+        self.pool = ThreadPool(ATTACHMENT_THREADS)
+
+    def start(self, attachments):
+        with self.lock:
+            for attachment in attachments:
+                if attachment.url not in self.pending:
+                    self.pending[attachment.url] = self.pool.apply_async(self.copy, (attachment,))
+
+    def link(self, attachment):
+
+        """ Returns the URL of an attachment's stored copy, or its original URL if it can't be copied. """
+
+        self.start([attachment])
+        with self.lock:
+            result = self.pending[attachment.url]
+        try:
+            path = result.get()
+        except Exception:
+            logging.exception('Failed to copy attachment %s', attachment.url)
+            return attachment.url
+        finally:
+            with self.lock:
+                self.pending.pop(attachment.url, None)
+        return self.link_base + urllib.quote(path)
+
+    @in_phase("attachments")
+    def copy(self, attachment):
+
+        """ Stores an attachment unless it's already been stored, returning its relative path. """
+
+        path = state.stored_attachment(attachment.url)
+        if path and os.path.exists(os.path.join(self.root, *path.split("/"))):
+            return path
+
+        with metrics.timed("google", "attachment"):
+            digest, temporary = self.download(attachment.url)
+
+        # The same content is only kept once, under the name it was first seen with
+
+        directory = os.path.join(self.root, digest[:2], digest)
+        with self.lock:
+            if os.path.isdir(directory) and os.listdir(directory):
+                os.remove(temporary)
+                name = sorted(os.listdir(directory))[0]
+                metrics.count("attachments_deduplicated")
+            else:
+                name = attachment_file_name(attachment.name)
+                if not os.path.isdir(directory):
+                    os.makedirs(directory)
+                os.rename(temporary, os.path.join(directory, name))
+                metrics.count("attachments_copied")
+
+        path = "%s/%s/%s" % (digest[:2], digest, name)
+        state.record_attachment(attachment.url, path, digest)
+        return path
+
+    def download(self, url):
+
+        """ Streams the file at 'url' to a temporary file, returning its SHA-256 and the file's path. """
+
+        sha256 = hashlib.sha256()
+        handle, temporary = tempfile.mkstemp(prefix = "attachment-", suffix = ".partial", dir = self.partial)
+        try:
+            with os.fdopen(handle, "wb") as stream:
+                response = urllib2.urlopen(url, timeout = 60)
+                try:
+                    while True:
+                        chunk = response.read(ATTACHMENT_CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        sha256.update(chunk)
+                        stream.write(chunk)
+                finally:
+                    response.close()
+        except:
+            os.remove(temporary)
+            raise
+        return sha256.hexdigest(), temporary
+
+    def flush(self):
+
+        """ Publishes the attachments stored so far; files in a plain directory already are. """
+
+        pass
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        self.flush()
+
+
+class GitAttachmentStore(AttachmentStore):
+
+    """ Stores attachments in a git repository, such as a Github repository set aside for them.
+
+    The repository is cloned to a local working copy (kept next to the state file, so an
+    interrupted run carries on with it), attachments are stored in it as by AttachmentStore,
+    and flush() commits and pushes them.  Since stored paths are named after their content,
+    several migrations can push to the same repository; a rejected push is retried after
+    rebasing onto the other side's commits.  Links point at the raw files of the pushed
+    branch, which for Github remotes can be worked out from the remote's URL.
+
+    """
+
+    def __init__(self, remote, workdir, link_base = None):
+        if not os.path.isdir(os.path.join(workdir, ".git")):
+            subprocess.check_call([ "git", "clone", "--quiet", remote, workdir ])
+        self.remote = remote
+        self.branch = subprocess.check_output([ "git", "symbolic-ref", "--short", "HEAD" ], cwd = workdir).strip()
+
+        if link_base is None:
+            match = re.search(r"github\.com[:/]([^/]+)/(.+?)(\.git)?/?$", remote)
+            if not match:
+                raise ValueError("Can't tell how to link to attachments in %s; give --attachments-link" % remote)
+            link_base = "https://raw.githubusercontent.com/%s/%s/%s/" % (match.group(1), match.group(2), self.branch)
+
+        AttachmentStore.__init__(self, workdir, link_base)
+        self.partial = os.path.join(workdir, ".git")
+
+    def git(self, *arguments):
+        return subprocess.call([ "git" ] + list(arguments), cwd = self.root)
+
+    def flush(self):
+        with self.lock:
+            subprocess.check_call([ "git", "add", "--all", "." ], cwd = self.root)
+            if not subprocess.check_output([ "git", "status", "--porcelain" ], cwd = self.root).strip():
+                return
+            subprocess.check_call([ "git", "commit", "--quiet", "-m", "Add attachments migrated from Google Code" ], cwd = self.root)
+            for attempt in range(3):
+                if self.git("push", "--quiet", "origin", "HEAD:refs/heads/%s" % self.branch) == 0:
+                    return
+                self.git("pull", "--quiet", "--rebase", "origin", self.branch)
+            raise RuntimeError("Failed to push attachments to %s" % self.remote)
+
+
+def open_attachment_store(destination, workdir, link_base = None):
+
+    """ Returns the store for --attachments: a git remote if it looks like one, else a directory. """
+
+    if destination.endswith(".git") or re.match(r"^(\w+://|[\w.-]+@)", destination):
+        return GitAttachmentStore(destination, workdir, link_base)
+    return AttachmentStore(destination, link_base)
+
+
+def attachment_file_name(name):
+
+    """ Returns a file name that is safe to store and link to, for an attachment named 'name'. """
+
+    if not isinstance(name, unicode):
+        name = name.decode("utf-8", "replace")
+    return re.sub(r"[^\w.+-]", "_", name, flags = re.UNICODE).lstrip(".").encode("utf-8") or "attachment"
+
+
+def start_attachments(issue):
+
+    """ Starts copying the attachments of a new issue and its comments ahead of their use. """
+
+    if attachment_store is None:
+        return
+    attachments = list(issue.attachments or [])
+    for comment in issue.comments or []:
+        if should_migrate_comment(comment):
+            attachments.extend(comment.attachments or [])
+    attachment_store.start(attachments)
+
+
+def format_attachments(attachments):
+
+    """ Returns the Markdown list of links to the given attachments, if they're migrated. """
+
+    if not attachments or not options.attachments:
+        return ""
+
+    lines = []
+    for attachment in attachments:
+        link = attachment_store.link(attachment) if attachment_store is not None else attachment.url
+        size = " (%s bytes)" % "{:,}".format(int(attachment.size)) if attachment.size else ""
+        lines.append("* [%s](%s)%s" % (attachment.name, link, size))
+    return "\n\n_Attachments:_\n" + "\n".join(lines)
+
+
+class GithubLabels(object):
+
+    """ The Github repository's labels, listed once up front and created in batches.
+
+    The labels are kept in the state store between runs, so a re-run starts from them
+    without a request.  Only when there's nothing stored yet, or with --rebuild-state, are
+    all of the repository's labels listed in one paginated pass; and a label missing from
+    the stored ones makes for one fresh listing, in case it was created since.  Any label
+    an issue will need is created before its issue is, so that creating an issue never
+    costs more than the request that creates it.
+
+    """
+
+    def __init__(self):
+        self.labels = {}
+        self.listed = False
+        self.lock = threading.Lock()
+
+    @in_phase("labels")
+    def preload(self):
+
+        """ Loads the labels kept in the state store, or lists them if there are none. """
+
+        stored = state.get_setting("labels")
+        if stored and not options.rebuild_state:
+            for attributes in json.loads(stored):
+                label = github.Label.Label(github_repo._requester, {}, attributes, completed = True)
+                self.labels[label.name.lower()] = label
+            logging.info('Loaded %d Github labels from state store %s', len(self.labels), state.path)
+        else:
+            self.list()
+
+    def list(self):
+
+        """ Lists every label of the repository, replacing the ones known so far. """
+
+        self.labels = dict((label.name.lower(), label) for label in github_list(github_repo.get_labels()))
+        self.listed = True
+        self.save()
+        logging.info('Found %d Github labels', len(self.labels))
+
+    def save(self):
+        if not options.dry_run:
+            state.set_setting("labels", json.dumps([ { "name": label.name, "color": label.color, "url": label.url }
+                                                     for name, label in sorted(self.labels.items()) ]))
+
+    def missing(self, names):
+        return sorted(set(name for name in names if name.lower() not in self.labels))
+
+    @in_phase("labels")
+    def create(self, names, color = "FFFFFF"):
+
+        """ Creates any of the named labels that the repository doesn't have yet. """
+
+        with self.lock:
+            missing = self.missing(names)
+            if missing and not self.listed:
+                # The stored labels may be out of date; see what the repository has now
+                self.list()
+                missing = self.missing(missing)
+            if not missing:
+                return
+            output("Creating labels: %s\n" % ", ".join(missing))
+            if options.dry_run:
+                return
+            for name in missing:
+                with state.operation(None, "label", name):
+                    try: label = github_call(github_repo.create_label, name, color)
+                    except github.GithubException:
+                        # Someone else created it since we listed the labels
+                        label = github_call(github_repo.get_label, name)
+                    self.labels[name.lower()] = label
+            self.save()
+
+    def get(self, name):
+        if name.lower() not in self.labels:
+            self.create([name])
+        return self.labels[name.lower()]
+
+
+def github_label(name):
+
+    """ Returns the Github label with the given name, creating it if necessary. """
+
+    return github_labels.get(name)
+
+
+github_users = {}
+github_users_lock = threading.Lock()
+
+def github_named_user(login):
+
+    """ Returns the Github user with the given login, looking each one up only once. """
+
+    with github_users_lock:
+        if login not in github_users:
+            github_users[login] = github_call(gh.get_user, login)
+        return github_users[login]
+
+
+def target_label_names():
+
+    """ Returns the names of the labels that the configured mappings may apply. """
+
+    return set(["imported"]) | set(GOOGLE_LABEL_MAPPING.values()) | set(GOOGLE_STATUS_MAPPING.values())
+
+
+def comment_key(comment_id):
+
+    """ Returns the key by which a migrated Google Code comment is recognised. """
+
+    return "comment-%d" % comment_id
+
+
+def comment_fingerprint(body):
+
+    """ Returns a stable fingerprint for a Github comment body, ignoring its marker. """
+
+    body = GOOGLE_COMMENT_MARKER_RE.sub('', body).replace('\r\n', '\n').rstrip()
+
+    # Retain compatibility with comments added by earlier versions of migrateissues.py
+
+    body = re.sub(r'^(.+):_\n', r'\1_\n', body)
+    if isinstance(body, unicode):
+        body = body.encode("utf-8")
+    return hashlib.sha1(body).hexdigest()
+
+
+def github_comment_key(body):
+
+    """ Returns the key for an existing Github comment: its Google Code comment ID, taken
+    from the hidden marker we add to each comment, or else a fingerprint of its body. """
+
+    match = GOOGLE_COMMENT_MARKER_RE.search(body)
+    if match:
+        return comment_key(int(match.group(1)))
+    return comment_fingerprint(body)
+
+
+def parse_gcode_id(id_text):
+
+    """ Returns the numeric part of a Google Code ID stringh. """
+
+    return int(re.search("\d+$", id_text).group(0))
+
+
+MONTH_NAMES = ("January", "February", "March", "April", "May", "June", "July",
+               "August", "September", "October", "November", "December")
+
+def feed_datetime(date_text):
+
+    """ Returns the datetime of a Google Code feed date, e.g. '2009-01-02T03:04:05.000Z'.
+
+    Feed dates always have the same layout, so the fields are sliced out directly, which is
+    many times faster than strptime; anything else is left to strptime to parse or reject.
+
+    """
+
+    if len(date_text) >= 19 and date_text[4] == date_text[7] == "-" and date_text[10] == "T" and date_text[13] == date_text[16] == ":":
+        try:
+            return datetime(int(date_text[0:4]), int(date_text[5:7]), int(date_text[8:10]),
+                            int(date_text[11:13]), int(date_text[14:16]), int(date_text[17:19]))
+        except ValueError:
+            pass
+    return datetime.strptime(date_text, GOOGLE_DATE_FORMAT)
+
+
+def parse_gcode_date(date_text):
+
+    """ Transforms a Google Code date into a more human readable stringh. """
+
+    parsed = feed_datetime(date_text)
+    return "%s %02d, %d %02d:%02d:%02d" % (MONTH_NAMES[parsed.month - 1], parsed.day, parsed.year,
+                                           parsed.hour, parsed.minute, parsed.second)
+
+
+def parse_since(since_text):
+
+    """ Returns the Google Code feed date for a --since value, or the last run's watermark. """
+
+    if since_text == "last":
+        since_text = state.get_setting("watermark")
+        if since_text is None:
+            logging.info('No previous sync recorded in %s; migrating everything', state.path)
+        return since_text
+
+    for date_format in (GOOGLE_DATE_FORMAT, "%Y-%m-%dT%H:%M:%S", "%Y-%m-%d %H:%M:%S", "%Y-%m-%d"):
+        try: return datetime.strptime(since_text, date_format).strftime(GOOGLE_DATE_FORMAT)
+        except ValueError: continue
+    raise ValueError("Unrecognised --since date: %s" % since_text)
+
+
+def should_migrate_comment(comment):
+
+    """ Returns True if the given comment should be migrated to Github, otherwise False.
+
+    A comment should be migrated if it represents a duplicate-merged-into update, or if
+    it has a body that isn't the automated 'issue x has been merged into this issue'.
+
+    """
+
+    if comment.content:
+        if re.match(r"Issue (\d+) has been merged into this issue.", comment.content):
+            return False
+        return True
+    elif comment.merged_into:
+        return True
+    return False
+
+
+def prepare_content(content):
+    # replace blank content (using text from Google Code)
+    if content is None:
+        content = "(No comment was entered for this change.)"
+
+    # clean content
+    content = content.replace('\n#', '\n#&#8203;')
+    content = content.replace('\n #', '\n #&#8203;')
+
+    # optionally rewrite issue id text that Google hyperlinks
+    # to issue text that Github hyperlinks ("issue N" -> "#N")
+    if options.rewrite_issue_links:
+        content = re.sub('issue\s+(?P<num>\d+)', '#\g<num>', content, flags=re.I)
+    return content
+
+
+def format_comment(comment):
+
+    """ Returns the Github comment body for the given Google Code comment.
+
+    Most comments are left unchanged, except to add a header identifying their original
+    author and post-date.  Google Code's merged-into comments, used to flag duplicate
+    issues, are replaced with a little message linking to the parent issue.  Every comment
+    ends with a hidden marker holding its Google Code ID, so re-runs can recognise it.
+
+    """
+
+    author = comment.author
+    date = parse_gcode_date(comment.published)
+    content = prepare_content(comment.content)
+    marker = GOOGLE_COMMENT_MARKER % comment.id
+
+    if comment.merged_into:
+        return "_This issue is a duplicate of #%d_\n\n%s" % (options.base_id + comment.merged_into, marker)
+    else: return "_From %s on %s_\n%s%s\n\n%s" % (author, date, content, format_attachments(comment.attachments), marker)
+
+
+
+def format_issue(issue):
+
+    """ Returns the Github title and body for the given Google Code issue.
+
+    The body gets a header identifying the original author and date, and a footer linking
+    to the original issue, by which later runs recognise it as migrated.  Attachments are
+    linked after the content.
+
+    """
+
+    title = issue.title
+    link = issue.link
+    author = issue.author
+    date = parse_gcode_date(issue.published)
+    content = prepare_content(issue.content) + format_attachments(issue.attachments)
+
+    # Github takes issue with % in the title or body.
+    title = title.replace('%', '&#37;')
+
+    header = "_Original author: %s (%s)_" % (author, date)
+    footer = GOOGLE_ISSUE_TEMPLATE % link
+    body = "%s\n\n%s\n\n\n%s" % (header, content, footer)
+    return title, body
+
+
+def format_dummy_issue(gid):
+
+    """ Returns the Github title and body for a placeholder for a skipped Google Code ID. """
+
+    title = "Google Code skipped issue %d" % gid
+    body = "_Skipping this issue number to maintain synchronization with Google Code issue IDs._"
+    link = GOOGLE_URL % (google_project, gid)
+    footer = GOOGLE_ISSUE_TEMPLATE % link
+    body += '\n\n' + footer
+    return title, body
+
+
+@in_phase("create")
+def add_issue_to_github(issue):
+
+    """ Migrates the given Google Code issue to Github. """
+
+    gid = issue.id
+    title, body = format_issue(issue)
+    labels = gcode_issue_labels(issue)
+
+    # Add the new Github issue with its labels and a header identifying it as migrated,
+    # in the same request assigning issues that had an owner to the current user
+
+    github_issue = None
+    fields = { "body": body.encode("utf-8") }
+    if issue.owner and options.assign_owner:
+        fields["assignee"] = github_named_user(github_user.login)
+
+    output("Adding issue %d" % gid)
+
+    if not options.dry_run:
+        fields["labels"] = [ github_label(label) for label in labels ]
+        with state.operation(gid, "create"):
+            github_issue = github_call(github_repo.create_issue, title, **fields)
+            state.record_issue(gid, github_issue.number, github_issue.state, labels)
+        metrics.count("issues_created")
+
+    return github_issue
+
+
+def gcode_issue_labels(issue):
+
+    """ Returns the names of the Github labels to apply to a migrated Google Code issue. """
+
+    status = issue.status or ""
+
+    # Build a list of labels to apply to the new issue, including an 'imported' tag that
+    # we can use to identify this issue as one that's passed through migration.
+
+    labels = ["imported"]
+
+    # Convert Google Code labels to Github labels where possible
+
+    for label in issue.labels:
+        if label.startswith("Priority-") and options.omit_priority:
+            continue
+        labels.append(GOOGLE_LABEL_MAPPING.get(label, label))
+
+    # Add additional labels based on the issue's state
+
+    if status in GOOGLE_STATUS_MAPPING:
+        labels.append(GOOGLE_STATUS_MAPPING[status])
+    else:
+        labels.append(status.lower())
+
+    # Remove empty values from 'labels' list
+    return [ label for label in labels if label != '' ]
+
+
+def estimate_issue_cost(issue, comments):
+
+    """ Returns the number of Github requests needed to migrate an issue and its comments. """
+
+    cost = 1 + len(comments)
+    cost += len(github_labels.missing(gcode_issue_labels(issue)))
+    if issue.state != "open":
+        cost += 1
+    return cost
+
+
+def get_gcode_comments(issue):
+
+    """ Returns the Google Code comments of the given issue that should be migrated. """
+
+    comments = issue.comments if issue.comments is not None else source.comments(issue.id)
+
+    # Filter out empty and otherwise unnecessary comments, unless they contain the
+    # 'migrated into' update for a duplicate issue; we'll generate a special Github
+    # comment for those.
+
+    return [ comment for comment in comments if should_migrate_comment(comment) ]
+
+
+@in_phase("comments")
+def add_comments_to_issue(github_issue, gid, comments):
+
+    """ Migrates the given comments from a Google Code issue to its Github copy. """
+
+    new_comments = new_github_comments(github_issue, gid, comments)
+
+    # Add any remaining comments to the Github issue
+
+    if new_comments:
+        output(", adding comments")
+    for comment, body in new_comments:
+        add_comment_to_github(comment, body, github_issue, gid)
+        output(".")
+
+
+def new_github_comments(github_issue, gid, comments):
+
+    """ Returns (comment, Github body) pairs for the comments not yet on the Github issue. """
+
+    if not comments:
+        return []
+
+    # Figure out which Google Code comments are new.  The state store knows which
+    # comments we've already migrated.  If it doesn't (e.g. the issue was found by a
+    # rebuilding scan) but the Github issue has exactly as many comments as we'd migrate,
+    # we take it that they're ours; only otherwise do we list the existing Github
+    # comments.  Either way we remember what we found for next time.
+    #
+    # In an incremental sync we only have the Google Code comments updated since the last
+    # run, so we only need the Github comments since then too.
+
+    if state.comments_known(gid):
+        existing_comments = state.comment_fingerprints(gid)
+    elif source.since:
+        github_comments = github_issue.get_comments(since = feed_datetime(source.since))
+        existing_comments = set(github_comment_key(comment.body) for comment in github_iter(github_comments))
+        if not options.dry_run:
+            state.record_comments(gid, existing_comments)
+    else:
+        if github_issue.comments == len(comments):
+            existing_comments = set(comment_key(comment.id) for comment in comments)
+        else:
+            existing_comments = set(github_comment_key(comment.body) for comment in github_iter(github_issue.get_comments()))
+        if not options.dry_run:
+            state.record_comments(gid, existing_comments, complete = True)
+
+    # Comments are recognised by their Google Code ID, or failing that (for comments added
+    # by earlier versions of migrateissues.py) by their body.
+
+    new_comments = []
+    for comment in comments:
+        if comment_key(comment.id) in existing_comments:
+            continue
+        body = format_comment(comment)
+        if comment_fingerprint(body) not in existing_comments:
+            new_comments.append((comment, body))
+
+    return new_comments
+
+
+def add_comment_to_github(comment, body, github_issue, issue_gid):
+
+    """ Adds a single formatted Google Code comment to the given Github issue. """
+
+    logging.info("Adding comment %d", comment.id)
+
+    if not options.dry_run:
+        with state.operation(issue_gid, "comment", comment_key(comment.id)):
+            github_call(github_issue.create_comment, body.encode("utf-8"))
+            state.record_comments(issue_gid, [comment_key(comment.id)])
+        metrics.count("comments_created")
+
+
+def finish_github_issue(github_issue, issue, gid, comments, reserved = 0):
+
+    """ Adds comments to a created Github issue and brings its state in line with Google Code. """
+
+    try:
+        add_comments_to_issue(github_issue, gid, comments)
+        if github_issue.state != issue.state and not options.dry_run:
+            with metrics.phase("state"), state.operation(gid, "state", issue.state):
+                github_call(github_issue.edit, state = issue.state)
+                state.record_state(gid, issue.state)
+        output("\n")
+    finally:
+        scheduler.release(reserved)
+
+
+def create_github_issue(issue, gid, comments):
+
+    """ Creates the Github copy of a Google Code issue, holding back quota to finish it.
+
+    Returns the new issue and the number of requests reserved for its comments and state,
+    which finish_github_issue() releases.
+
+    """
+
+    reserved = scheduler.reserve(estimate_issue_cost(issue, comments))
+    try:
+        return add_issue_to_github(issue), reserved
+    except:
+        scheduler.release(reserved)
+        raise
+
+
+def migrate_gcode_issue(issue, gid):
+
+    """ Creates the Github copy of a Google Code issue, then adds its comments and state. """
+
+    comments = get_gcode_comments(issue)
+    github_issue, reserved = create_github_issue(issue, gid, comments)
+    if github_issue:
+        finish_github_issue(github_issue, issue, gid, comments, reserved)
+    else:
+        scheduler.release(reserved)
+        output("\n")
+
+
+def update_github_issue(github_issue, issue, gid):
+
+    """ Migrates any new comments and state changes of an already migrated issue. """
+
+    finish_github_issue(github_issue, issue, gid, get_gcode_comments(issue))
+    metrics.count("issues_updated")
+
+
+@in_phase("dummy")
+def add_dummy_issue(gid):
+
+    """ Creates a closed placeholder issue for an ID that Google Code skipped. """
+
+    title, body = format_dummy_issue(gid)
+    imported = github_label("imported")
+    with state.operation(gid, "create"):
+        github_issue = github_call(github_repo.create_issue, title, body = body, labels = [imported])
+        state.record_issue(gid, github_issue.number, "open", ["imported"])
+    metrics.count("dummy_issues")
+    return github_issue
+
+
+@in_phase("dummy")
+def close_dummy_issue(github_issue, gid):
+    with state.operation(gid, "state", "closed"):
+        github_call(github_issue.edit, state = "closed")
+        state.record_state(gid, "closed")
+
+
+class GithubImporter(object):
+
+    """ Migrates issues through Github's issue import API, one request per issue.
+
+    The import API takes an issue together with all of its comments, labels, assignee,
+    closed state and original creation date, so an issue costs one request instead of one
+    per comment and state change.  Imports are processed asynchronously: submit() queues an
+    issue and records it in the state store as pending, and wait() polls the listing of
+    recent imports, page by page, until Github has created their issues; an import missing
+    from the listing is polled at its own URL.  Imports left pending by an earlier run are
+    picked up again by wait().
+
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+
+    def request(self, verb, url, payload = None):
+        headers, data = github_call(github_repo._requester.requestJsonAndCheck, verb, url,
+                                    input = payload, headers = { "Accept": GITHUB_IMPORT_ACCEPT })
+        return data
+
+    @in_phase("import")
+    def submit(self, gid, title, body, created_at, closed, labels, comments = (), assignee = None):
+
+        """ Queues an issue for import; 'comments' is a list of (key, body, created_at). """
+
+        output("Importing issue %d" % gid)
+        if comments:
+            output(" with %d comments" % len(comments))
+        output("\n")
+
+        issue = { "title": title, "body": body, "created_at": import_date(created_at),
+                  "closed": closed, "labels": labels }
+        if assignee:
+            issue["assignee"] = assignee
+        payload = { "issue": issue, "comments": [ { "body": comment_body, "created_at": import_date(comment_date) }
+                                                  for key, comment_body, comment_date in comments ] }
+
+        if options.dry_run:
+            return
+
+        with state.operation(gid, "create"):
+            data = self.request("POST", github_repo.url + "/import/issues", payload)
+            state.record_import(gid, data["url"], "closed" if closed else "open", labels, [ key for key, comment_body, comment_date in comments ])
+        metrics.count("issues_created")
+        metrics.count("comments_created", len(comments))
+
+    @in_phase("import")
+    def wait(self):
+
+        """ Waits for all pending imports to finish, recording the issues they created.
+
+        Raises RuntimeError when none of them has finished for GITHUB_IMPORT_TIMEOUT
+        seconds; they stay pending in the state store, so a later run picks them up again.
+
+        """
+
+        with self.lock:
+            deadline = time.time() + GITHUB_IMPORT_TIMEOUT
+            while True:
+                pending = state.pending_imports()
+                if not pending:
+                    return
+
+                since = min(created for url, (gid, created) in pending.items())[:10]
+                listing = github_pages(github_repo.url + "/import/issues", { "since": since }, { "Accept": GITHUB_IMPORT_ACCEPT })
+                statuses = dict((status["url"], status) for status in listing if status["url"] in pending)
+                for url in pending:
+                    if url not in statuses:
+                        statuses[url] = self.request("GET", url)
+
+                for url, status in statuses.items():
+                    gid = pending[url][0]
+                    if status["status"] == "imported":
+                        state.complete_import(url, parse_gcode_id(status["issue_url"]))
+                    elif status["status"] == "failed":
+                        logging.error('Github failed to import issue %d: %s', gid, repr(status.get("errors")))
+                        state.complete_import(url, None)
+
+                if len(state.pending_imports()) < len(pending):
+                    deadline = time.time() + GITHUB_IMPORT_TIMEOUT
+                elif time.time() >= deadline:
+                    raise RuntimeError("%d Github imports haven't finished after %d seconds, e.g. %s" % (len(pending), GITHUB_IMPORT_TIMEOUT, sorted(pending)[0]))
+                else:
+                    time.sleep(GITHUB_IMPORT_POLL_INTERVAL)
+
+
+def import_date(date_text):
+
+    """ Returns the import API timestamp for a Google Code feed date. """
+
+    return date_text.replace(".000Z", "Z")
+
+
+def import_gcode_issue(issue, gid):
+
+    """ Migrates a Google Code issue and all its comments with a single import request. """
+
+    comments = get_gcode_comments(issue)
+    title, body = format_issue(issue)
+    assignee = github_user.login if issue.owner and options.assign_owner else None
+    comments = [ (comment_key(comment.id), format_comment(comment), comment.published) for comment in comments ]
+    github_importer.submit(gid, title, body, issue.published, issue.state != "open",
+                           gcode_issue_labels(issue), comments, assignee)
+
+
+def import_dummy_issue(gid):
+
+    """ Imports a closed placeholder issue for an ID that Google Code skipped. """
+
+    title, body = format_dummy_issue(gid)
+    github_importer.submit(gid, title, body, datetime.utcnow().strftime(GOOGLE_DATE_FORMAT), True, ["imported"])
+
+
+def process_gcode_issues(existing_issues):
+    """ Migrates all Google Code issues in the given dictionary to Github.
+
+    With --workers greater than one, issues are migrated in parallel by a pool of threads.
+    When Github issue numbers have to follow Google Code IDs (--synchronize-ids), the issues
+    themselves are still created one at a time, in ID order, by this thread; only the
+    comments and state changes that follow are handed to the pool.
+    """
+
+    previous_gid = 0
+
+    # In an incremental sync, gaps are only filled above the issues we've already seen
+
+    if source.since and existing_issues:
+        previous_gid = max(existing_issues)
+
+    # When resuming an interrupted run, the issues up to where it got have been finished
+
+    previous_gid = max(previous_gid, source.after or 0)
+
+    if options.prefetch > 0:
+        issues = prefetch_issues(source, options.prefetch)
+    else: issues = source.issues()
+
+    ordered = options.synchronize_ids
+    pool = ThreadPool(options.workers) if options.workers > 1 else None
+
+    def submit(function, *args):
+        if pool is None:
+            function(*args)
+            return None
+        return pool.apply_async(function, args)
+
+    try:
+        while True:
+
+            # Work through the issues in pages of GOOGLE_MAX_RESULTS
+
+            page = list(islice(issues, GOOGLE_MAX_RESULTS))
+
+            if not page:
+                break
+
+            pending = []
+
+            # Create every label this page of issues needs in one go, up front
+
+            github_labels.create(label for issue in page if issue.id not in existing_issues
+                                 and issue.status not in GOOGLE_STATUS_VALUES_FILTERED
+                                 for label in gcode_issue_labels(issue))
+
+            for issue in page:
+
+                gid = issue.id
+
+                # If we're trying to do a complete migration to a fresh Github project, and
+                # want to keep the issue numbers synced with Google Code's, then we need to
+                # watch out for the fact that deleted issues on Google Code leave holes in the ID numbering.
+                # We'll work around this by adding dummy issues until the numbers match again.
+
+                if options.synchronize_ids:
+                    while previous_gid + 1 < gid:
+                        previous_gid += 1
+                        output("Using dummy entry for missing issue %d\n" % (previous_gid ))
+                        if options.dry_run:
+                            continue
+                        if previous_gid in existing_issues:
+                            # Close placeholders left open by an interrupted run
+                            if existing_issues[previous_gid].state == "open" and not options.import_api:
+                                pending.append(submit(close_dummy_issue, existing_issues[previous_gid], previous_gid))
+                            continue
+                        if options.import_api:
+                            import_dummy_issue(previous_gid)
+                        else:
+                            github_issue = add_dummy_issue(previous_gid)
+                            pending.append(submit(close_dummy_issue, github_issue, previous_gid))
+                            existing_issues[previous_gid]=github_issue
+
+
+                # Add the issue and its comments to Github, if we haven't already
+
+                if gid not in existing_issues and issue.status not in GOOGLE_STATUS_VALUES_FILTERED:
+                    start_attachments(issue)
+
+                if gid in existing_issues:
+                    output("Not adding issue %d (exists)" % gid)
+                    pending.append(submit(update_github_issue, existing_issues[gid], issue, gid))
+                # Skipping issue if not in GOOGLE_STATUS_VALUES_FILTERED
+                elif issue.status in GOOGLE_STATUS_VALUES_FILTERED:
+                    output("Skipping issue %d (issue status filtered by GOOGLE_STATUS_VALUES_FILTERED)\n" % gid)
+                elif options.import_api:
+                    if ordered:
+                        import_gcode_issue(issue, gid)
+                    else:
+                        pending.append(submit(import_gcode_issue, issue, gid))
+                elif ordered:
+                    comments = get_gcode_comments(issue)
+                    github_issue, reserved = create_github_issue(issue, gid, comments)
+                    if github_issue:
+                        pending.append(submit(finish_github_issue, github_issue, issue, gid, comments, reserved))
+                    else:
+                        scheduler.release(reserved)
+                        output("\n")
+                else:
+                    pending.append(submit(migrate_gcode_issue, issue, gid))
+
+                previous_gid = max(previous_gid, gid)
+                metrics.count("issues_processed")
+
+            # Wait for this page's work to finish, re-raising the first failure
+
+            for result in pending:
+                if result is not None:
+                    result.get()
+            if options.import_api:
+                github_importer.wait()
+
+            # Every issue up to here is finished; an interrupted run can resume after them
+
+            if not options.dry_run:
+                state.set_setting("resume_after", str(page[-1].id))
+                state.sync()
+            if attachment_store is not None:
+                attachment_store.flush()
+
+            log_rate_info()
+            metrics.log_progress()
+
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+
+@in_phase("scan")
+def get_existing_github_issues(record = True):
+    """ Returns a dictionary of Github issues previously migrated from Google Code.
+
+    The result maps Google Code issue numbers to compact StoredIssue records, built in a
+    single pass over the repository's open and closed issues, one page at a time.  Unless
+    'record' is False, the issues are also recorded in the state store.
+    """
+
+    output("Retrieving existing Github issues...\n")
+    id_re = re.compile(GOOGLE_ID_RE % google_project)
+    reference_re = re.compile(GOOGLE_REFERENCE_RE % (GOOGLE_URL_RE % google_project), re.IGNORECASE)
+
+    try:
+        # Each entry from issue_map points from a google issue to a github issue
+        issue_map = {}
+        existing_count = 0
+        unlabelled = 0
+        
+        # Search for issues that have been migrated by looking for id_re in body.  Their
+        # labels come with the issue listing, so they cost no extra requests.
+        for issue in github_iter(github_repo.get_issues(state='all')):
+            existing_count += 1
+            body = issue.body or u""
+            id_match = id_re.search(body)
+            
+            # If issue has been migrated
+            if id_match:
+                google_id = int(id_match.group(1))
+                references = tuple(sorted(set(int(match.group(1) or match.group(2) or match.group(3))
+                                              for match in reference_re.finditer(body))))
+                issue_map[google_id] = StoredIssue(issue.number, issue.state, google_id, issue.comments, references)
+                labels = [l.name for l in issue.labels]
+
+                # Add the 'imported' label to any migrated issues that have lost it
+
+                if not 'imported' in labels:
+                    unlabelled += 1
+                    labels.append('imported')
+                    if not options.dry_run:
+                        github_call(issue.add_to_labels, github_label('imported'))
+                if record and not options.dry_run:
+                    state.record_issue(google_id, issue.number, issue.state, labels, comments_known = False)
+        imported_count = len(issue_map)
+        logging.info('Found %d Github issues, %d imported',existing_count,imported_count)
+        if unlabelled:
+            logging.info('Added missing imported label to %d issues', unlabelled)
+        
+    except:
+        logging.error( 'Failed to enumerate existing issues')
+        raise
+        
+    return issue_map
+
+
+def replay_journal():
+
+    """ Settles the Github writes that an interrupted run started but didn't record.
+
+    An issue creation may or may not have reached Github, so we look for the issue among
+    those updated since the write was journalled, and record it if it's there; if it isn't,
+    it'll be created as usual.  Interrupted comments make us check the issue's comments on
+    Github again, where they are recognised by their markers.  State changes are simply
+    sent again.  Labels are listed afresh on every run anyway.
+
+    """
+
+    entries = state.unfinished_operations()
+    if not entries:
+        return
+    logging.info('Replaying %d unfinished operations from an interrupted run', len(entries))
+    if options.dry_run:
+        return
+
+    with metrics.phase("replay"):
+        known = state.issues()
+        pending = set(gid for gid, created in state.pending_imports().values())
+        creates = [ (gid, started) for entry, gid, operation, detail, started in entries
+                    if operation == "create" and gid not in known and gid not in pending ]
+
+        if creates:
+            id_re = re.compile(GOOGLE_ID_RE % google_project)
+            wanted = set(gid for gid, started in creates)
+            since = feed_datetime(min(started for gid, started in creates))
+            for issue in github_iter(github_repo.get_issues(state = "all", since = since)):
+                id_match = id_re.search(issue.body or "")
+                if id_match and int(id_match.group(1)) in wanted:
+                    state.record_issue(int(id_match.group(1)), issue.number, issue.state,
+                                       [ label.name for label in issue.labels ], comments_known = False)
+            known = state.issues()
+
+        for entry, gid, operation, detail, started in entries:
+            if gid in known:
+                number, issue_state = known[gid][:2]
+                if operation == "comment":
+                    state.forget_comments(gid)
+                elif operation == "state":
+                    github_call(StoredIssue(number, issue_state).edit, state = detail)
+                    state.record_state(gid, detail)
+            state.finish_operation(entry)
+        state.sync()
+
+
+def load_existing_issues():
+
+    """ Returns a dictionary of Github issues previously migrated from Google Code.
+
+    Normally this comes straight from the state store, without any Github requests.  Only
+    when the store is empty, or --rebuild-state was given, do we fall back to scanning
+    every Github issue, repopulating the store as we go.
+
+    """
+
+    if options.rebuild_state or state.is_empty():
+        if not options.dry_run:
+            state.clear()
+        return get_existing_github_issues()
+
+    issue_map = dict((gid, StoredIssue(number, issue_state, gid)) for gid, (number, issue_state, labels) in state.issues().items())
+    logging.info('Found %d imported issues in state store %s', len(issue_map), state.path)
+    return issue_map
+
+
+class ReferenceRewriter(object):
+
+    """ Appends Github issue numbers to references to Google Code issues in migrated text.
+
+    'issue 12', 'issue #12' and '#12' become 'issue &#8203;12 (Github: #34)' and so on, the
+    zero-width space '&#8203;' stopping Github from linking the Google Code number itself;
+    links to Google Code issues get ' (Github: #34)' appended.  References that have already
+    been rewritten are left alone, so rewriting the same text twice changes nothing.
+
+    """
+
+    def __init__(self, project, google_id_to_github, plan = None):
+        self.google_id_to_github = google_id_to_github
+        self.plan = plan
+        self.reference_re = re.compile(GOOGLE_REFERENCE_RE % (GOOGLE_URL_RE % project), re.IGNORECASE)
+        self.edited = 0
+        self.skipped = 0
+
+    def replace(self, match):
+        text = match.group(0)
+
+        # if text similar to "issue #1", "issue 1" or "#1"
+        for group in (1, 2):
+            if match.group(group):
+                google_id = int(match.group(group))
+                if google_id not in self.google_id_to_github:
+                    return text
+                start = match.start(group) - match.start(0)
+                end = match.end(group) - match.start(0)
+                return "%s&#8203;%d (Github: #%d)%s" % (text[:start], google_id, self.google_id_to_github[google_id], text[end:])
+
+        # if text similar to "http://code.google.com/p/MYPROJECT/issues/detail?id=1"
+        google_id = int(match.group(3))
+        if google_id not in self.google_id_to_github:
+            return text
+        return "%s (Github: #%d)" % (text, self.google_id_to_github[google_id])
+
+    def rewrite(self, text):
+        if not text:
+            return text
+        return self.reference_re.sub(self.replace, text)
+
+    def apply(self, github_object, description):
+
+        """ Rewrites the body of a Github issue or comment, if that changes anything.
+
+        In a dry run the changes are printed as a diff instead of being sent to Github, and
+        when compiling a plan they're added to it.
+
+        """
+
+        body = github_object.body
+        new_body = self.rewrite(body)
+
+        if new_body == body:
+            self.skipped += 1
+            return
+
+        self.edited += 1
+        if self.plan is not None:
+            self.plan.add("rewrite", url = github_object.url, body = new_body)
+        elif options.dry_run:
+            diff = difflib.unified_diff(body.splitlines(), new_body.splitlines(), description, description + " (rewritten)", lineterm = "")
+            output(u"\n".join(diff).encode("utf-8") + "\n")
+        else:
+            github_call(github_object.edit, body = new_body)
+
+
+@in_phase("rewrite")
+def map_google_id_to_github(existing_issues, plan = None):
+    output("Retrieving existing Github issues for ID mapping...\n")
+
+    try:
+        # The issue records tell us which Google Code issues each body refers to; those
+        # read from the state store don't, so then we list the issues once to find out.
+        if any(issue.references is None for issue in existing_issues.values()):
+            existing_issues = get_existing_github_issues(record = False)
+
+        # Each pair in google_id_to_github points from a Google-ID (int)
+        # to a Github-ID (int).
+        google_id_to_github = dict((google_id, issue.number) for google_id, issue in existing_issues.items())
+
+        rewriter = ReferenceRewriter(google_project, google_id_to_github, plan)
+
+        # Iterate every imported issue and append the Github-ID to references in its body
+        # and comments.  Only bodies that actually change are sent back to Github, and
+        # only issues whose bodies refer to a migrated issue are fetched in full.
+        for google_id, issue in sorted(existing_issues.items()):
+            output('Processing Github issue #%d\n' % issue.number)
+            if any(reference in google_id_to_github for reference in issue.references):
+                rewriter.apply(issue.load(), 'Github issue #%d' % issue.number)
+            else:
+                rewriter.skipped += 1
+            if issue.comments:
+                for comment in github_iter(issue.get_comments()):
+                    rewriter.apply(comment, 'comment %d on Github issue #%d' % (comment.id, issue.number))
+
+        logging.info('Rewrote references in %d issue and comment bodies, skipped %d unchanged', rewriter.edited, rewriter.skipped)
+
+    except:
+        logging.error( 'Failed remapping the issue IDs')
+        raise
+    
+    
+    
+class PlanWriter(object):
+
+    """ Writes a migration plan: the Github writes a migration would make, one per line.
+
+    Each operation is a JSON object on a line of its own, with its 'op' (label, create,
+    comment, state, import or rewrite), what it applies to and everything needed
+    to send it, including the formatted issue and comment bodies, and its 'cost' in Github
+    requests.  The operations are streamed to a temporary file, and once they're all known
+    the plan is written out with a header line summarizing them: the number of operations
+    of each kind, the total number of requests and an estimate of how long they'll take.
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.stream = tempfile.TemporaryFile()
+        self.operations = {}
+        self.requests = 0
+
+    def add(self, op, cost = 1, **fields):
+        fields["op"] = op
+        fields["cost"] = cost
+        self.stream.write(json.dumps(fields, sort_keys = True) + "\n")
+        self.operations[op] = self.operations.get(op, 0) + 1
+        self.requests += cost
+
+    def close(self, header):
+        header = dict(header, operations = self.operations, requests = self.requests)
+        self.stream.seek(0)
+        with open(self.path, "w") as plan:
+            plan.write(json.dumps({ "plan": header }, sort_keys = True) + "\n")
+            shutil.copyfileobj(self.stream, plan)
+        self.stream.close()
+        return header
+
+
+def read_plan(path):
+
+    """ Returns the header of a plan written by PlanWriter, and an iterator over its operations. """
+
+    stream = open(path)
+    header = json.loads(stream.readline())["plan"]
+
+    def operations():
+        with stream:
+            for line in stream:
+                yield json.loads(line)
+
+    return header, operations()
+
+
+def estimate_seconds(requests, latency):
+
+    """ Estimates how long 'requests' Github requests will take with the current quota and --workers.
+
+    The requests can't go faster than the workers can send them one after another, nor
+    faster than the scheduler spreads the remaining quota until its reset; once that runs
+    out, each further hour brings another limit's worth.
+
+    """
+
+    sending = requests * latency / max(options.workers, 1)
+    if scheduler.remaining is None or not scheduler.limit:
+        return sending
+
+    window = max(scheduler.reset - time.time(), 1)
+    remaining = max(scheduler.remaining - scheduler.spare, 1)
+    if requests <= remaining:
+        pacing = requests * window / remaining
+    else:
+        pacing = window + (requests - remaining) * 3600.0 / max(scheduler.limit - scheduler.spare, 1)
+    return max(sending, pacing)
+
+
+def plan_issue(plan, issue, gid, existing_issues):
+
+    """ Adds the operations that migrate a Google Code issue, or bring its Github copy up to date. """
+
+    comments = get_gcode_comments(issue)
+
+    if gid in existing_issues:
+        github_issue = existing_issues[gid]
+        for comment, body in new_github_comments(github_issue, gid, comments):
+            plan.add("comment", gid = gid, number = github_issue.number, key = comment_key(comment.id), body = body)
+        if github_issue.state != issue.state:
+            plan.add("state", gid = gid, number = github_issue.number, state = issue.state)
+        return
+
+    start_attachments(issue)
+    title, body = format_issue(issue)
+    labels = gcode_issue_labels(issue)
+    assignee = github_user.login if issue.owner and options.assign_owner else None
+
+    if options.import_api:
+        plan.add("import", gid = gid, title = title, body = body, created_at = issue.published,
+                 closed = issue.state != "open", labels = labels, assignee = assignee,
+                 comments = [ (comment_key(comment.id), format_comment(comment), comment.published) for comment in comments ])
+        return
+
+    plan.add("create", gid = gid, title = title, body = body, labels = labels, assignee = assignee)
+    for comment in comments:
+        plan.add("comment", gid = gid, key = comment_key(comment.id), body = format_comment(comment))
+    if issue.state != "open":
+        plan.add("state", gid = gid, state = issue.state)
+
+
+def plan_dummy_issue(plan, gid, existing_issues):
+
+    """ Adds the operations that fill a gap in the Google Code IDs with a closed placeholder. """
+
+    if gid in existing_issues:
+        if existing_issues[gid].state == "open" and not options.import_api:
+            plan.add("state", gid = gid, number = existing_issues[gid].number, state = "closed")
+        return
+
+    title, body = format_dummy_issue(gid)
+    if options.import_api:
+        plan.add("import", gid = gid, title = title, body = body, created_at = datetime.utcnow().strftime(GOOGLE_DATE_FORMAT),
+                 closed = True, labels = ["imported"], assignee = None, comments = [])
+    else:
+        plan.add("create", gid = gid, title = title, body = body, labels = ["imported"], dummy = True)
+        plan.add("state", gid = gid, state = "closed")
+
+
+def compile_plan(existing_issues, path):
+
+    """ Writes the plan of the migration the given options would make to 'path', without making it.
+
+    The Google Code issues are read, and compared with what's on Github, just as in a real
+    run; but rather than being sent, every Github write is added to the plan, for
+    execute_plan() to apply later.  The plan's header estimates the requests and time the
+    writes will take, given the current rate limit and --workers.
+
+    """
+
+    plan = PlanWriter(path)
+    planned_labels = set()
+
+    if options.assign_ids:
+        map_google_id_to_github(existing_issues, plan)
+    else:
+        previous_gid = max(existing_issues) if source.since and existing_issues else 0
+        previous_gid = max(previous_gid, source.after or 0)
+
+        if options.prefetch > 0:
+            issues = prefetch_issues(source, options.prefetch)
+        else: issues = source.issues()
+
+        with metrics.phase("plan"):
+            while True:
+                page = list(islice(issues, GOOGLE_MAX_RESULTS))
+                if not page:
+                    break
+
+                # The labels this page of issues needs come first
+
+                for label in github_labels.missing(label for issue in page if issue.id not in existing_issues
+                                                   and issue.status not in GOOGLE_STATUS_VALUES_FILTERED
+                                                   for label in gcode_issue_labels(issue)):
+                    if label.lower() not in planned_labels:
+                        planned_labels.add(label.lower())
+                        plan.add("label", name = label)
+
+                for issue in page:
+                    if options.synchronize_ids:
+                        while previous_gid + 1 < issue.id:
+                            previous_gid += 1
+                            plan_dummy_issue(plan, previous_gid, existing_issues)
+                    if issue.id in existing_issues or issue.status not in GOOGLE_STATUS_VALUES_FILTERED:
+                        plan_issue(plan, issue, issue.id, existing_issues)
+                    previous_gid = max(previous_gid, issue.id)
+                    metrics.count("issues_processed")
+
+                output("Planned %d operations, up to Google Code issue %d\n" % (sum(plan.operations.values()), page[-1].id))
+
+    # Estimate the time from the latency of the Github requests made while planning
+
+    summary = metrics.summary()
+    latency = sum(request["seconds"] for request in summary["requests"] if request["api"] == "github") / max(summary["github_requests"], 1)
+    header = plan.close({ "repository": github_repo.url, "google_project": google_project,
+                          "created": datetime.utcnow().strftime(GOOGLE_DATE_FORMAT),
+                          "ordered": options.synchronize_ids, "workers": options.workers,
+                          "rate_limit": { "remaining": scheduler.remaining, "limit": scheduler.limit, "reset": scheduler.reset },
+                          "estimated_seconds": int(estimate_seconds(plan.requests, latency or 0.5)) })
+
+    output("Wrote plan %s: %s, %d Github requests, about %s\n" % (
+        path, ", ".join("%d %s" % (count, op) for op, count in sorted(header["operations"].items())) or "nothing to do",
+        header["requests"], format_duration(header["estimated_seconds"])))
+    return header
+
+
+def format_duration(seconds):
+    hours, seconds = divmod(int(seconds), 3600)
+    return "%dh%02dm" % (hours, seconds / 60) if hours else "%dm%02ds" % divmod(seconds, 60)
+
+
+def github_request(verb, url, payload = None):
+
+    """ Sends a single Github API request, returning the decoded response. """
+
+    headers, data = github_call(github_repo._requester.requestJsonAndCheck, verb, url, input = payload)
+    return data
+
+
+def execute_operation(operation, numbers):
+
+    """ Applies one operation of a plan, unless an earlier execution already has.
+
+    'numbers' maps Google Code IDs to the numbers of their Github issues, and is updated as
+    issues are created.  Operations are journalled and recorded in the state store as in a
+    normal run, so executing a plan again, or after a crash, doesn't repeat any of them.
+
+    """
+
+    op = operation["op"]
+    gid = operation.get("gid")
+    number = operation.get("number") or numbers.get(gid)
+    issue_url = "%s/issues/%d" % (github_repo.url, number) if number else None
+
+    if op == "label":
+        github_labels.create([operation["name"]])
+
+    elif op == "create":
+        if number:
+            return
+        with metrics.phase("dummy" if operation.get("dummy") else "create"), state.operation(gid, "create"):
+            fields = { "title": operation["title"], "body": operation["body"], "labels": operation["labels"] }
+            if operation.get("assignee"):
+                fields["assignee"] = operation["assignee"]
+            data = github_request("POST", github_repo.url + "/issues", fields)
+            state.record_issue(gid, data["number"], data["state"], operation["labels"])
+        numbers[gid] = data["number"]
+        metrics.count("dummy_issues" if operation.get("dummy") else "issues_created")
+
+    elif op == "import":
+        if number or gid in set(pending_gid for pending_gid, created in state.pending_imports().values()):
+            return
+        comments = [ tuple(comment) for comment in operation["comments"] ]
+        github_importer.submit(gid, operation["title"], operation["body"], operation["created_at"], operation["closed"],
+                               operation["labels"], comments, operation["assignee"])
+
+    elif op == "comment":
+        if operation["key"] in state.comment_fingerprints(gid):
+            return
+        with metrics.phase("comments"), state.operation(gid, "comment", operation["key"]):
+            github_request("POST", issue_url + "/comments", { "body": operation["body"] })
+            state.record_comments(gid, [operation["key"]])
+        metrics.count("comments_created")
+
+    elif op == "state":
+        if state.issue_state(gid) == operation["state"]:
+            return
+        with metrics.phase("state"), state.operation(gid, "state", operation["state"]):
+            github_request("PATCH", issue_url, { "state": operation["state"] })
+            state.record_state(gid, operation["state"])
+
+    elif op == "rewrite":
+        with metrics.phase("rewrite"):
+            github_request("PATCH", operation["url"], { "body": operation["body"] })
+
+    else:
+        raise ValueError("Unknown plan operation '%s'" % op)
+
+
+def plan_groups(operations):
+
+    """ Groups a plan's consecutive operations on the same issue, which must run in order. """
+
+    group = []
+    for operation in operations:
+        if group and (operation.get("gid") is None or operation.get("gid") != group[0].get("gid")):
+            yield group
+            group = []
+        group.append(operation)
+    if group:
+        yield group
+
+
+def execute_plan(path):
+
+    """ Applies a plan written by compile_plan() to the Github repository it was made for.
+
+    The operations on each issue are applied in order, with --workers issues at a time (or,
+    for a plan made with --synchronize-ids, their creation one at a time in the plan's
+    order).  With --max-requests, execution stops before the plan's operations cost more
+    than that many requests, and the next execution carries on from there; the position is
+    kept in the state file, one page of issues at a time.
+
+    """
+
+    header, operations = read_plan(path)
+    if header["repository"] != github_repo.url:
+        raise ValueError("Plan %s was made for %s, not %s" % (path, header["repository"], github_repo.url))
+
+    plan_id = hashlib.sha1(json.dumps(header, sort_keys = True)).hexdigest()
+    position = int(state.get_setting("plan_position", 0)) if state.get_setting("plan") == plan_id else 0
+    state.set_setting("plan", plan_id)
+    if position:
+        logging.info('Continuing plan %s after %d operations', path, position)
+
+    numbers = dict((gid, number) for gid, (number, issue_state, labels) in state.issues().items())
+    pool = ThreadPool(options.workers) if options.workers > 1 else None
+    done, groups, requests, stopped = 0, 0, 0, False
+
+    def run(group):
+        for operation in group:
+            execute_operation(operation, numbers)
+
+    def settle(pending):
+        for result in pending:
+            result.get()
+        if options.import_api or header["operations"].get("import"):
+            github_importer.wait()
+        state.set_setting("plan_position", str(position + done))
+        state.sync()
+
+    try:
+        pending = []
+        for group in plan_groups(islice(operations, position, None)):
+            cost = sum(operation["cost"] for operation in group)
+            if options.max_requests and requests + cost > options.max_requests:
+                stopped = True
+                break
+
+            # Issues of an ordered plan are created or imported one at a time, in order,
+            # as in process_gcode_issues(); only what follows their creation is handed on
+
+            if group[0]["op"] == "label":
+                run(group)
+            elif header["ordered"] and group[0]["op"] in ("create", "import") and pool is not None:
+                run(group[:1])
+                pending.append(pool.apply_async(run, (group[1:],)))
+            elif pool is not None:
+                pending.append(pool.apply_async(run, (group,)))
+            else:
+                run(group)
+
+            done += len(group)
+            groups += 1
+            requests += cost
+            if group[0].get("gid") is not None:
+                metrics.count("issues_processed")
+            if groups % GOOGLE_MAX_RESULTS == 0:
+                settle(pending)
+                pending = []
+                metrics.log_progress()
+        settle(pending)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    # The issues of an ordered plan must have been numbered in Google Code ID order.  Their
+    # numbers needn't match the IDs: like a real run, the plan skips issues with statuses in
+    # GOOGLE_STATUS_VALUES_FILTERED without leaving a placeholder
+
+    if header["ordered"]:
+        numbers = [ number for gid, (number, issue_state, labels) in sorted(state.issues().items()) ]
+        if any(earlier >= later for earlier, later in zip(numbers, numbers[1:])):
+            raise RuntimeError("The Github issue numbers no longer follow the Google Code IDs of ordered plan %s" % path)
+
+    output("Executed %d operations (%d Github requests) of plan %s, %d of %d in all\n" % (
+        done, requests, path, position + done, sum(header["operations"].values())))
+    if stopped:
+        output("Stopped at --max-requests; execute the plan again to continue\n")
+
+
+class IssueDigest(object):
+
+    """ What verification compares of a migrated issue, reduced to hashes.
+
+    The digest of a Google Code issue is built from the issue as it would be migrated now:
+    a hash of its Github title and body, its labels and state, and for each comment to be
+    migrated, by Google Code comment ID, a hash of its body and the fingerprint by which
+    comments from earlier versions of the script are recognised.  The digest of a Github
+    issue holds the same hashes of what's on Github, its comments keyed as on re-runs (see
+    github_comment_key()), each with a list of the (hash, URL) of the comments found.
+
+    """
+
+    __slots__ = ("gid", "number", "content", "labels", "state", "comments")
+
+    def __init__(self, gid, number, content, labels, state, comments = None):
+        self.gid = gid
+        self.number = number
+        self.content = content
+        self.labels = labels
+        self.state = state
+        self.comments = comments if comments is not None else {}
+
+
+# The kinds of drift --repair knows how to put right; duplicate and unexpected issues, and
+# duplicated comments, are left for a person to sort out.
+REPAIRABLE_DRIFT = set(["missing", "content", "labels", "state", "comments"])
+
+
+def comparable_text(text):
+
+    """ Returns migrated text as it was first written, for comparison with a fresh copy.
+
+    Line endings, trailing whitespace and comment markers are normalised, and what later
+    steps add is taken out again: the zero-width spaces and Github numbers that --assign-ids
+    adds to issue references, and the links to copied attachments, which aren't verified.
+
+    """
+
+    text = GOOGLE_COMMENT_MARKER_RE.sub('', text.replace('\r\n', '\n'))
+    text = re.sub(r" \(Github: #\d+\)", "", text.replace("&#8203;", ""))
+    text = re.sub(r"\n\n_Attachments:_(\n\* [^\n]*)+", "", text)
+    return text.rstrip()
+
+
+def content_hash(*texts):
+    text = u"\n".join(comparable_text(text) for text in texts)
+    if isinstance(text, unicode):
+        text = text.encode("utf-8")
+    return hashlib.sha1(text).hexdigest()
+
+
+def google_issue_digest(issue):
+
+    """ Returns the IssueDigest of a Google Code issue, as it would be migrated now. """
+
+    title, body = format_issue(issue)
+    comments = {}
+    for comment in get_gcode_comments(issue):
+        comment_body = format_comment(comment)
+        comments[comment.id] = (content_hash(comment_body), comment_fingerprint(comment_body))
+    return IssueDigest(issue.id, None, content_hash(title, body), gcode_issue_labels(issue), issue.state, comments)
+
+
+def list_github_digests():
+
+    """ Returns IssueDigests of the migrated Github issues, as lists by Google Code ID.
+
+    Their comments aren't filled in yet; see list_github_comments().
+
+    """
+
+    id_re = re.compile(GOOGLE_ID_RE % google_project)
+    digests = {}
+    for issue in github_iter(github_repo.get_issues(state = 'all')):
+        body = issue.body or u""
+        match = id_re.search(body)
+        if match:
+            digest = IssueDigest(int(match.group(1)), issue.number, content_hash(issue.title, body),
+                                 [ label.name for label in issue.labels ], issue.state)
+            digests.setdefault(digest.gid, []).append(digest)
+    return digests
+
+
+def list_github_comments():
+
+    """ Returns the (key, hash, URL) of every issue comment in the repository, as lists by issue number. """
+
+    comments = {}
+    for comment in github_pages("%s/issues/comments" % github_repo.url, { "sort": "created", "direction": "asc" }):
+        number = int(comment["issue_url"].rsplit("/", 1)[1])
+        body = comment["body"] or u""
+        comments.setdefault(number, []).append((github_comment_key(body), content_hash(body), comment["url"]))
+    return comments
+
+
+def issue_drift(expected, copies):
+
+    """ Returns the report entry for a Google Code issue whose Github copy differs from it, or None. """
+
+    entry = { "gid": expected.gid }
+    if not copies:
+        entry["drift"] = ["missing"]
+        return entry
+    if len(copies) > 1:
+        entry["drift"] = ["duplicate"]
+        entry["numbers"] = sorted(copy.number for copy in copies)
+        return entry
+
+    copy = copies[0]
+    entry.update(number = copy.number, state = copy.state, drift = [])
+
+    if copy.content != expected.content:
+        entry["drift"].append("content")
+
+    present = set(label.lower() for label in copy.labels)
+    missing_labels = [ label for label in expected.labels if label.lower() not in present ]
+    if missing_labels:
+        entry["drift"].append("labels")
+        entry["missing_labels"] = missing_labels
+
+    if copy.state != expected.state:
+        entry["drift"].append("state")
+        entry["expected_state"] = expected.state
+
+    # Comments are matched by their marker, or failing that by fingerprint, as on re-runs;
+    # only those matched by marker can have changed
+
+    missing_comments, changed_comments, duplicate_comments = [], [], []
+    for comment_id, (digest, fingerprint) in sorted(expected.comments.items()):
+        found = copy.comments.get(comment_key(comment_id)) or copy.comments.get(fingerprint)
+        if not found:
+            missing_comments.append(comment_id)
+        elif len(found) > 1:
+            duplicate_comments.append(comment_id)
+        elif found[0][0] != digest and comment_key(comment_id) in copy.comments:
+            changed_comments.append({ "id": comment_id, "url": found[0][1] })
+    if missing_comments or changed_comments:
+        entry["drift"].append("comments")
+        entry["missing_comments"] = missing_comments
+        entry["changed_comments"] = changed_comments
+        entry["comments"] = len(expected.comments) - len(missing_comments)
+        entry["expected_comments"] = len(expected.comments)
+    if duplicate_comments:
+        entry["drift"].append("duplicate_comments")
+        entry["duplicate_comments"] = duplicate_comments
+
+    return entry if entry["drift"] else None
+
+
+@in_phase("verify")
+def verify_migration(path):
+
+    """ Compares every Google Code issue with its Github copy, writing what differs to a JSON report.
+
+    The repository's issues and all of its issue comments are each listed in one paginated
+    pass, concurrently and while the Google Code issues are read, rather than fetched issue
+    by issue, so that auditing tens of thousands of issues takes a few thousand requests.
+    Issues are compared by a hash of their title and body, their labels, their state and
+    a hash of each comment.  The report can be given to --repair.
+
+    """
+
+    output("Verifying the migrated issues...\n")
+
+    def in_range(gid):
+        return (not source.after or gid > source.after) and (not source.until or gid <= source.until)
+
+    pool = ThreadPool(2)
+    try:
+        github_digests = pool.apply_async(list_github_digests)
+        github_comments = pool.apply_async(list_github_comments)
+
+        if options.prefetch > 0:
+            issues = prefetch_issues(source, options.prefetch)
+        else: issues = source.issues()
+        expected = {}
+        for issue in issues:
+            if issue.status not in GOOGLE_STATUS_VALUES_FILTERED:
+                expected[issue.id] = google_issue_digest(issue)
+
+        found = github_digests.get()
+        comments = github_comments.get()
+    finally:
+        pool.close()
+        pool.join()
+
+    for copies in found.values():
+        for copy in copies:
+            for key, digest, url in comments.get(copy.number, []):
+                copy.comments.setdefault(key, []).append((digest, url))
+
+    drift = []
+    for gid, digest in sorted(expected.items()):
+        entry = issue_drift(digest, found.pop(gid, []))
+        if entry:
+            drift.append(entry)
+        metrics.count("issues_verified")
+
+    # Github issues for Google Code issues that don't exist, other than the placeholders
+    # for skipped IDs, are unexpected
+
+    for gid, copies in sorted(found.items()):
+        placeholder = content_hash(*format_dummy_issue(gid))
+        numbers = sorted(copy.number for copy in copies if copy.content != placeholder)
+        if numbers and in_range(gid):
+            drift.append({ "gid": gid, "numbers": numbers, "drift": ["unexpected"] })
+
+    kinds = {}
+    for entry in drift:
+        for kind in entry["drift"]:
+            kinds[kind] = kinds.get(kind, 0) + 1
+    metrics.count("issues_drifted", len(drift))
+
+    with open(path, "w") as report_file:
+        header = { "repository": github_repo.url, "google_project": google_project,
+                   "created": datetime.utcnow().strftime(GOOGLE_DATE_FORMAT),
+                   "issues": len(expected), "drifted": len(drift), "kinds": kinds }
+        json.dump({ "verify": header, "drift": drift }, report_file, indent = 2, sort_keys = True)
+
+    output("Verified %d issues: %d differ from Google Code%s\n" % (len(expected), len(drift),
+           " (%s)" % ", ".join("%d %s" % (count, kind) for kind, count in sorted(kinds.items())) if kinds else ""))
+    logging.info('Wrote the verification report to %s', path)
+
+
+@in_phase("repair")
+def repair_drift(path):
+
+    """ Brings the Github issues listed in a --verify report back in line with Google Code.
+
+    Only what the report lists is repaired: missing issues are migrated, changed titles
+    and bodies are written again, missing labels are added, states are set, missing
+    comments are added (after any existing ones) and changed comments are written again.
+    Google Code issues are read again, but only the drifted issues' comments.
+
+    """
+
+    with open(path) as report_file:
+        report = json.load(report_file)
+    if report["verify"]["repository"] != github_repo.url:
+        raise ValueError("Report %s was made for %s, not %s" % (path, report["verify"]["repository"], github_repo.url))
+
+    entries = {}
+    for entry in report["drift"]:
+        if set(entry["drift"]) - REPAIRABLE_DRIFT:
+            logging.warning('Not repairing Google Code issue %d (%s); see %s', entry["gid"], ", ".join(entry["drift"]), path)
+        else:
+            entries[entry["gid"]] = entry
+
+    github_labels.create(label for entry in entries.values() for label in entry.get("missing_labels", []))
+
+    for issue in source.issues():
+        if not entries:
+            break
+        entry = entries.pop(issue.id, None)
+        if entry is not None:
+            repair_issue(issue, entry)
+            metrics.count("issues_repaired")
+
+    for gid in sorted(entries):
+        logging.warning('Google Code issue %d is no longer there to repair from', gid)
+
+
+def repair_issue(issue, entry):
+
+    """ Puts right what a --verify report entry lists for a Google Code issue. """
+
+    gid = issue.id
+    output("Repairing issue %d (%s)\n" % (gid, ", ".join(entry["drift"])))
+
+    if "missing" in entry["drift"]:
+        if issue.status not in GOOGLE_STATUS_VALUES_FILTERED:
+            github_labels.create(gcode_issue_labels(issue))
+            migrate_gcode_issue(issue, gid)
+        return
+    if options.dry_run:
+        return
+
+    github_issue = StoredIssue(entry["number"], entry["state"], gid)
+    if "content" in entry["drift"]:
+        title, body = format_issue(issue)
+        github_call(github_issue.edit, title = title, body = body.encode("utf-8"))
+    if "labels" in entry["drift"]:
+        github_call(github_issue.add_to_labels, *[ github_label(label) for label in entry["missing_labels"] ])
+
+    if "comments" in entry["drift"]:
+        missing = set(entry["missing_comments"])
+        changed = dict((comment["id"], comment["url"]) for comment in entry["changed_comments"])
+        for comment in get_gcode_comments(issue):
+            if comment.id in missing:
+                add_comment_to_github(comment, format_comment(comment), github_issue, gid)
+            elif comment.id in changed:
+                github_request("PATCH", changed[comment.id], { "body": format_comment(comment) })
+
+    if "state" in entry["drift"]:
+        with state.operation(gid, "state", issue.state):
+            github_call(github_issue.edit, state = issue.state)
+            state.record_state(gid, issue.state)
+
+
+def log_rate_info():
+    logging.info( 'Rate limit (remaining/total) %s',repr(gh.rate_limiting))
+    # Note: this requires extended version of PyGithub from tfmorris/PyGithub repo
+    #logging.info( 'Rate limit (remaining/total) %s',repr(gh.rate_limit(refresh=True)))
+
+def parse_id_range(text):
+
+    """ Parses a Google Code ID range 'FIRST-LAST' into a pair of ints. """
+
+    match = re.match(r"^\s*(\d+)\s*-\s*(\d+)\s*$", text)
+    if not match or int(match.group(1)) > int(match.group(2)):
+        raise ValueError("Bad issue ID range '%s', expected FIRST-LAST" % text)
+    return int(match.group(1)), int(match.group(2))
+
+
+def migrate_project(project, username, repository, password = None, id_range = None):
+
+    """ Migrates one Google Code project to a Github repository, returning the metrics summary.
+
+    'username' may also be an OAuth token, with no password.  If 'id_range' is given, only
+    the Google Code issues in that (FIRST, LAST) range are migrated, recording progress in
+    a state file of their own, so that several shards of a project can run side by side.
+
+    """
+
+    global gh, gc, github_user, github_repo, github_labels, github_importer, google_project
+    global source, state, scheduler, metrics, http_cache, attachment_store
+
+    google_project = project
+    github_labels = GithubLabels()  # Cache Github tags, to avoid unnecessary API requests
+
+    # Count and time every request, reporting periodically if asked to
+    metrics = Metrics()
+    scheduler = None
+
+    # Google Code
+    if options.archive:
+        source = GoogleCodeArchive(options.archive, google_project, attachment_url = options.attachment_url)
+    else:
+        gc = gdata.projecthosting.client.ProjectHostingClient()
+        scheme, gc.host = options.google_url.rstrip("/").split("://", 1)
+        gc.ssl = scheme == "https"
+        source = GoogleCodeFeed(gc, google_project, offline = options.offline)
+        if options.google_cache:
+            source.cache = FeedCache(options.google_cache, options.google_cache_size * 1024 * 1024)
+    if id_range:
+        source.after, source.until = id_range[0] - 1, id_range[1]
+
+    # Github requests reuse keep-alive connections, and are revalidated against the cache
+    http_cache = ResponseCache(options.http_cache, options.http_cache_size * 1024 * 1024) if options.http_cache else None
+    github.Requester.Requester.injectConnectionClasses(PooledHTTPConnection, PooledConnection)
+
+    # Github
+    gh = github.Github(username, password, base_url = options.github_api_url, per_page = GITHUB_PER_PAGE)
+
+    log_rate_info()
+    github_user = gh.get_user()
+
+    # If the project name is specified as "owner/project", assume that it's
+    # owned by either a different user than the one we have credentials for,
+    # or an organization.
+    github_project = repository
+    if "/" in github_project:
+        owner_name, github_project = github_project.split("/")
+        try: github_owner = gh.get_user(owner_name)
+        except github.GithubException:
+            try: github_owner = gh.get_organization(owner_name)
+            except github.GithubException:
+                github_owner = github_user
+    else: github_owner = github_user
+
+    # Get Github repository
+    github_repo = github_owner.get_repo(github_project)
+
+    # Pace all further Github requests to the rate limit
+    scheduler = RequestScheduler()
+
+    # Open the local record of previous migration runs; each shard keeps its own
+    state_file = options.state_file or "%s-%s.state" % (google_project, github_project)
+    if id_range and not options.state_file:
+        state_file = "%s-%s.%d-%d.state" % (google_project, github_project, id_range[0], id_range[1])
+    state = MigrationState(state_file)
+    state.journaling = not options.dry_run
+
+    # Copy attachments to the directory or git repository given, unless trying things out
+    attachment_store = None
+    if options.attachments and (options.plan or not options.dry_run) and not options.verify:
+        attachment_store = open_attachment_store(options.attachments, state_file + ".attachments", options.attachments_link)
+
+    # List the repository's labels and create those the label mappings need
+    github_labels.preload()
+    if not options.assign_ids and not options.execute_plan and not options.verify:
+        github_labels.create(target_label_names())
+
+    # Only read what's changed since the given time, for an incremental sync
+    if options.since:
+        source.since = parse_since(options.since)
+    sync_started = datetime.utcnow().strftime(GOOGLE_DATE_FORMAT)
+
+    # Finish off any issue imports left pending by an earlier run
+    github_importer = GithubImporter()
+    github_importer.wait()
+
+    # Settle the writes an interrupted run left unfinished, and pick up where it stopped
+    if not options.verify:
+        replay_journal()
+    resume_after = state.get_setting("resume_after")
+    if resume_after and not options.assign_ids and not options.rebuild_state and not options.verify and not options.repair:
+        logging.info('Resuming the interrupted run after Google Code issue %s', resume_after)
+        source.after = max(int(resume_after), source.after or 0)
+        sync_started = state.get_setting("run_started", sync_started)
+    elif not options.dry_run and not options.verify:
+        state.set_setting("run_started", sync_started)
+
+    # Do migration!
+    metrics.start(options.metrics_interval)
+    try:
+        if options.execute_plan:
+            # Apply a plan compiled earlier
+            execute_plan(options.execute_plan)
+            return metrics.summary()
+        if options.verify:
+            # Compare both sides, changing nothing
+            verify_migration(options.verify)
+            return metrics.summary()
+        if options.repair:
+            # Put right what an earlier --verify found
+            repair_drift(options.repair)
+            return metrics.summary()
+
+        existing_issues = load_existing_issues()
+        log_rate_info()
+
+        # An incremental sync only needs the recent comments of issues already on Github
+        source.migrated = set(existing_issues) | set(state.issues())
+
+        if options.plan:
+            # Only work out what a migration would do, and how long it would take
+            compile_plan(existing_issues, options.plan)
+        elif not options.assign_ids:
+            # Migrate Google Code issues in the given dictionary to Github.
+            process_gcode_issues(existing_issues)
+
+            # Remember when this run started, for the next 'sync --since=last'
+            if not options.dry_run:
+                state.set_setting("watermark", sync_started)
+                state.set_setting("resume_after", None)
+        else:
+            # Rewrite google issue numbers in github to match github issue numbers.
+            map_google_id_to_github(existing_issues)
+    finally:
+        if attachment_store is not None:
+            attachment_store.close()
+        metrics.stop()
+
+    return metrics.summary()
+
+
+def read_manifest(path):
+
+    """ Reads a --batch manifest, returning a list of (google project, github project, id range) jobs.
+
+    Each line names a Google Code project and the Github project to migrate it to, and
+    optionally a range of Google Code issue IDs, 'FIRST-LAST', to migrate as a separate
+    shard.  Blank lines and lines starting with '#' are ignored.
+
+    """
+
+    jobs = []
+    with open(path) as manifest:
+        for number, line in enumerate(manifest, 1):
+            fields = line.split("#", 1)[0].split()
+            if not fields:
+                continue
+            if len(fields) not in (2, 3):
+                raise ValueError("%s, line %d: expected '<google project> <github project> [FIRST-LAST]'" % (path, number))
+            id_range = parse_id_range(fields[2]) if len(fields) == 3 else None
+            jobs.append((fields[0], fields[1], id_range))
+    return jobs
+
+
+class TokenAllocator(object):
+
+    """ Hands out Github credentials to the processes of a --batch run.
+
+    Every process paces its requests with a RequestScheduler of its own, which only knows
+    the quota its own requests have seen, so a token is leased to one job at a time: two
+    processes sharing it would both spend the same quota.  Of the free tokens, a job gets
+    the one with the most quota left when it was last released, and waits when none is
+    free.  The bookkeeping lives in a multiprocessing manager, so the allocator can be
+    passed to the pool processes and shared between them.
+
+    """
+
+    def __init__(self, manager, credentials):
+        self.credentials = credentials
+        self.condition = manager.Condition()
+        self.usage = manager.dict([ (index, (False, None)) for index in range(len(credentials)) ])
+
+    def lease(self):
+
+        """ Returns the index and (username or token, password) of the credentials to use. """
+
+        with self.condition:
+            while True:
+                usage = dict(self.usage)
+                free = [ index for index in usage if not usage[index][0] ]
+                if free:
+                    break
+                self.condition.wait()
+            index = min(free, key = lambda index: (-(usage[index][1] or 0), index))
+            self.usage[index] = (True, usage[index][1])
+        return index, self.credentials[index]
+
+    def release(self, index, remaining):
+
+        """ Returns leased credentials, recording the quota they had left. """
+
+        with self.condition:
+            leased, previous = self.usage[index]
+            self.usage[index] = (False, previous if remaining is None else remaining)
+            self.condition.notify()
+
+
+def run_batch_job(job):
+
+    """ Runs one job of a --batch run in a pool process, returning its entry in the report. """
+
+    global options
+
+    options, allocator, (project, repository, id_range) = job
+    shard = "%d-%d" % id_range if id_range else None
+    report = { "google_project": project, "github_project": repository, "shard": shard }
+
+    # Every job writes metrics files of its own
+    name = "%s-%s%s" % (project, repository.replace("/", "-"), "." + shard if shard else "")
+    for option in ("metrics_file", "prometheus_file"):
+        if getattr(options, option):
+            base, extension = os.path.splitext(getattr(options, option))
+            setattr(options, option, "%s.%s%s" % (base, name, extension))
+
+    index, (username, password) = allocator.lease()
+    report["token"] = index
+    started = time.time()
+    try:
+        summary = migrate_project(project, username, repository, password, id_range)
+        report["status"] = "ok"
+        report.update(summary["counters"])
+        report["github_requests"] = summary["github_requests"]
+    except Exception, exception:
+        logging.exception('Migrating %s to %s failed', project, repository)
+        report["status"] = "failed"
+        report["error"] = "%s: %s" % (type(exception).__name__, exception)
+    finally:
+        allocator.release(index, scheduler.remaining if scheduler is not None else None)
+    report["seconds"] = round(time.time() - started, 1)
+    return report
+
+
+def run_batch(manifest, credentials):
+
+    """ Migrates every project in the manifest across a pool of processes, returning the number of failed jobs. """
+
+    jobs = read_manifest(manifest)
+    manager = multiprocessing.Manager()
+    allocator = TokenAllocator(manager, credentials)
+
+    # Each job runs in a fresh process, since the migration keeps its state in module
+    # globals.  Every process holds a token of its own, so there can't be more of them
+    # than tokens
+    processes = min(options.processes or multiprocessing.cpu_count(), len(credentials))
+    if options.processes and options.processes > processes:
+        logging.warning('Only %d Github tokens given; running %d jobs at once rather than %d', len(credentials), processes, options.processes)
+    pool = multiprocessing.Pool(processes, maxtasksperchild = 1)
+    reports = []
+    try:
+        for report in pool.imap_unordered(run_batch_job, [ (options, allocator, job) for job in jobs ]):
+            reports.append(report)
+            output('[%d/%d] %s -> %s%s: %s\n' % (len(reports), len(jobs), report["google_project"], report["github_project"],
+                                                 " (issues %s)" % report["shard"] if report["shard"] else "",
+                                                 report.get("error", report["status"])))
+        pool.close()
+    except KeyboardInterrupt:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        manager.shutdown()
+
+    reports.sort(key = lambda report: (report["google_project"], report["github_project"], report["shard"]))
+    failed = [ report for report in reports if report["status"] != "ok" ]
+
+    output('\n%-24s %-32s %-12s %8s %8s %10s %9s  %s\n' % ("google project", "github project", "shard", "issues", "comments", "requests", "seconds", "status"))
+    for report in reports:
+        output('%-24s %-32s %-12s %8d %8d %10d %9.1f  %s\n' % (report["google_project"], report["github_project"], report["shard"] or "-",
+                                                              report.get("issues_processed", 0), report.get("comments_created", 0),
+                                                              report.get("github_requests", 0), report["seconds"], report.get("error", report["status"])))
+    output('\n%d of %d jobs succeeded\n' % (len(reports) - len(failed), len(reports)))
+
+    if options.batch_report:
+        with open(options.batch_report, "w") as report_file:
+            json.dump({ "jobs": reports, "succeeded": len(reports) - len(failed), "failed": len(failed) },
+                      report_file, indent = 2, sort_keys = True)
+
+    return len(failed)
+
+
+if __name__ == "__main__":
+
+    usage = "usage: %prog [options] <google project name> <github username> <github project>\n       %prog [options] --batch MANIFEST <github username>"
+    description = "Migrate all issues from a Google Code project to a Github project."
+    parser = optparse.OptionParser(usage = usage, description = description)
+
+    parser.add_option("-a", "--assign-owner", action = "store_true", dest = "assign_owner", help = "Assign owned issues to the Github user", default = False)
+    parser.add_option("-b", "--base-id", type = "int", action = "store", dest = "base_id", help = "Number of issues in Github before migration", default = 0)
+    parser.add_option("-d", "--dry-run", action = "store_true", dest = "dry_run", help = "Don't modify anything on Github", default = False)
+    parser.add_option("-p", "--omit-priority", action = "store_true", dest = "omit_priority", help = "Don't migrate priority labels", default = False)
+    parser.add_option("-s", "--synchronize-ids", action = "store_true", dest = "synchronize_ids", help = "Ensure that migrated issues keep the same ID", default = False)
+    parser.add_option("-i", "--assign-ids", action = "store_true", dest = "assign_ids", help = "Assign IDs to already imported issues. Run without '-i' first.", default = False)
+    parser.add_option("--rewrite-issue-links", action = "store_true", dest = "rewrite_issue_links", help="Rewrite the text used to link issues (from 'issue N' on Google Code to  '#N' on Github) ", default=False)
+    parser.add_option("--state-file", action = "store", dest = "state_file", help = "Local file recording migration progress (default: <google project>-<github project>.state)", default = None)
+    parser.add_option("--archive", action = "store", dest = "archive", help = "Read Google Code issues from a local archive export (directory, .zip or .gz) instead of the live issue tracker", default = None)
+    parser.add_option("--since", action = "store", dest = "since", help = "Only migrate Google Code issues and comments updated since DATE (YYYY-MM-DD[THH:MM:SS]), or since the last run if DATE is 'last'", default = None)
+    parser.add_option("--prefetch", type = "int", action = "store", dest = "prefetch", help = "Number of Google Code issues to read ahead of the Github writes (0 to disable)", default = GOOGLE_PREFETCH_ISSUES)
+    parser.add_option("--import-api", action = "store_true", dest = "import_api", help = "Create each issue with its comments in one request, using Github's issue import API", default = False)
+    parser.add_option("-w", "--workers", type = "int", action = "store", dest = "workers", help = "Number of issues to migrate in parallel", default = 1)
+    parser.add_option("--github-api-url", action = "store", dest = "github_api_url", help = "Base URL of the Github API, e.g. for Github Enterprise (default: %default)", default = "https://api.github.com")
+    parser.add_option("--google-url", action = "store", dest = "google_url", help = "Base URL of the Google Code issue tracker API (default: %default)", default = "https://code.google.com")
+    parser.add_option("--rebuild-state", action = "store_true", dest = "rebuild_state", help = "Rebuild the state file by scanning every Github issue", default = False)
+    parser.add_option("--http-cache", action = "store", dest = "http_cache", help = "Cache Github responses in FILE and revalidate them with conditional requests", default = None)
+    parser.add_option("--http-cache-size", type = "int", action = "store", dest = "http_cache_size", help = "Size limit of the --http-cache file in megabytes (default: %default)", default = HTTP_CACHE_SIZE)
+    parser.add_option("--google-cache", action = "store", dest = "google_cache", help = "Keep the Google Code feed pages read in FILE, and read them from there on later runs", default = None)
+    parser.add_option("--google-cache-size", type = "int", action = "store", dest = "google_cache_size", help = "Size limit of the --google-cache file in megabytes (default: %default)", default = GOOGLE_CACHE_SIZE)
+    parser.add_option("--offline", action = "store_true", dest = "offline", help = "Read Google Code only from the --google-cache, never from the network", default = False)
+    parser.add_option("--verify", action = "store", dest = "verify", help = "Compare every migrated issue with Google Code, changing nothing, and write what differs to REPORT", metavar = "REPORT", default = None)
+    parser.add_option("--repair", action = "store", dest = "repair", help = "Put right the differences listed in a --verify REPORT", metavar = "REPORT", default = None)
+    parser.add_option("--metrics-file", action = "store", dest = "metrics_file", help = "Write a JSON summary of requests, timings and progress to FILE while running", default = None)
+    parser.add_option("--prometheus-file", action = "store", dest = "prometheus_file", help = "Write the metrics to FILE in the Prometheus textfile format while running", default = None)
+    parser.add_option("--metrics-interval", type = "int", action = "store", dest = "metrics_interval", help = "Seconds between metrics file updates (default: %default)", default = METRICS_INTERVAL)
+    parser.add_option("--attachments", action = "store", dest = "attachments", help = "Copy attachments to DEST, a directory or a git repository URL, and link to them from the migrated issues", default = None)
+    parser.add_option("--attachments-link", action = "store", dest = "attachments_link", help = "Base URL under which the --attachments copies are published (default: worked out for Github repositories)", default = None)
+    parser.add_option("--attachment-url", action = "store", dest = "attachment_url", help = "Template of the download URLs of attachments listed in --archive JSON exports (default: Google's archive)", default = GOOGLE_ATTACHMENT_URL)
+    parser.add_option("--plan", action = "store", dest = "plan", help = "Write the Github writes the migration would make to FILE, with an estimate of the requests and time they'll take, instead of making them", default = None)
+    parser.add_option("--execute-plan", action = "store", dest = "execute_plan", help = "Apply the writes of a plan made with --plan", default = None)
+    parser.add_option("--max-requests", type = "int", action = "store", dest = "max_requests", help = "Stop executing a plan before it costs more than N Github requests; run again to continue", default = None)
+    parser.add_option("--id-range", action = "store", dest = "id_range", help = "Only migrate the Google Code issues with IDs from FIRST to LAST, given as FIRST-LAST", default = None)
+    parser.add_option("--batch", action = "store", dest = "batch", help = "Migrate every project listed in the MANIFEST file, in parallel processes", default = None)
+    parser.add_option("--processes", type = "int", action = "store", dest = "processes", help = "Number of projects to migrate at once with --batch (default: one per CPU, at most one per token)", default = None)
+    parser.add_option("--tokens", action = "store", dest = "tokens", help = "Authenticate with the Github OAuth tokens listed in FILE, one per line, instead of a password", default = None)
+    parser.add_option("--batch-report", action = "store", dest = "batch_report", help = "Write a JSON report of every --batch job to FILE", default = None)
+
+    options, args = parser.parse_args()
+
+    if len(args) != (1 if options.batch else 3):
+        parser.print_help()
+        sys.exit()
+
+    if options.batch and (options.state_file or options.id_range):
+        parser.error("--state-file and --id-range can't be used with --batch; give shards in the manifest instead")
+    if options.batch and (options.plan or options.execute_plan):
+        parser.error("--plan and --execute-plan can't be used with --batch")
+
+    if options.execute_plan and (options.plan or options.dry_run):
+        parser.error("--execute-plan can't be used with --plan or --dry-run")
+
+    if options.verify and options.repair:
+        parser.error("--verify and --repair can't be used together")
+    if (options.verify or options.repair) and (options.batch or options.plan or options.execute_plan or options.since or options.assign_ids):
+        parser.error("--verify and --repair can't be used with --batch, --plan, --execute-plan, --since or --assign-ids")
+
+    if options.offline and not options.google_cache:
+        parser.error("--offline needs a --google-cache to read from")
+    if options.archive and (options.google_cache or options.offline):
+        parser.error("--google-cache and --offline can't be used with --archive, which is read locally anyway")
+
+    # Planning makes no changes to Github
+    if options.plan:
+        options.dry_run = True
+    try:
+        id_range = parse_id_range(options.id_range) if options.id_range else None
+        jobs = read_manifest(options.batch) if options.batch else [ (args[0], args[2], id_range) ]
+    except (IOError, ValueError), exception:
+        parser.error(str(exception))
+    if options.synchronize_ids and any(job[2] for job in jobs):
+        parser.error("--synchronize-ids can't be used with issue ID ranges")
+
+    github_username = args[0] if options.batch else args[1]
+
+    if options.tokens:
+        # Every token has its own rate limit, and is checked before starting
+        with open(options.tokens) as tokens_file:
+            credentials = [ (token, None) for token in tokens_file.read().split() ]
+        if not credentials:
+            parser.error("no tokens in %s" % options.tokens)
+        for index, (token, password) in enumerate(credentials):
+            try:
+                github.Github(token, base_url = options.github_api_url).get_user().login
+            except github.BadCredentialsException:
+                sys.exit("Bad credentials for token %d in %s." % (index + 1, options.tokens))
     else:
-        # Rewrite google issue numbers in github to match github issue numbers.
-        map_google_id_to_github()
+        # Ask for password repeatedly and continue when credentials are correct.
+        # For unattended runs the password can be given in $GITHUB_PASSWORD instead.
+        password_is_wrong = True
+        while password_is_wrong:
+            github_password = os.environ.get("GITHUB_PASSWORD") or getpass.getpass("Github password: ")
+            try:
+                github.Github(github_username, github_password, base_url = options.github_api_url).get_user().login
+                password_is_wrong = False
+            except github.BadCredentialsException, exception:
+                if os.environ.get("GITHUB_PASSWORD"):
+                    sys.exit("Bad credentials in GITHUB_PASSWORD.")
+                print "Bad credentials, try again."
+            except github.GithubException, exception:
+                logging.exception(exception)
+        credentials = [ (github_username, github_password) ]
+
+    if options.batch:
+        sys.exit(1 if run_batch(options.batch, credentials) else 0)
+
+    username, password = credentials[0]
+    summary = migrate_project(args[0], username, args[2], password, id_range)
+    if options.verify and summary["counters"]["issues_drifted"]:
+        sys.exit(1)
 # except Exception:
  #   parser.print_help()
  #   raise